@@ -0,0 +1,185 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+import requests
+
+import omero_login
+from async_client import AsyncOmeroClient
+from mock_omero import MockOmero
+from paging import iter_objects
+from raw_pixels import fetch_raw_region
+
+# Metrics where a higher value is better; every other metric is a latency
+HIGHER_IS_BETTER = {"listing_objects_per_s", "tiles_per_s"}
+
+
+# Function to get a percentile (0-100) of a list of samples
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+# Function to measure login latency with cold and warm login caches
+def bench_login(url, rounds):
+    samples = []
+    for _ in range(rounds):
+        sess = requests.session()
+        start = time.perf_counter()
+        res_log, _ = omero_login.login(sess, url, "bench", "bench")
+        samples.append(time.perf_counter() - start)
+        if not res_log.json().get("success"):
+            raise RuntimeError("Login against the mock server failed")
+    return {
+        "login_first_ms": samples[0] * 1000,
+        "login_p50_ms": statistics.median(samples[1:] or samples) * 1000,
+    }
+
+
+# Function to measure how fast a full image listing can be streamed
+def bench_listing(url):
+    sess = requests.session()
+    omero_login.login(sess, url, "bench", "bench")
+    start = time.perf_counter()
+    count = sum(1 for _ in iter_objects(sess, url + "/api/v0/m/images/", prefetch=True))
+    elapsed = time.perf_counter() - start
+    return {"listing_objects_per_s": count / elapsed}
+
+
+# Function to measure tile throughput through the async client
+def bench_tiles(url, tiles, concurrency):
+    async def run():
+        async with AsyncOmeroClient(url, max_concurrency=concurrency) as client:
+            await client.login("bench", "bench")
+            jobs = [
+                dict(image_id=1, tile=(0, i % 64, i // 64, 512, 512))
+                for i in range(tiles)
+            ]
+            start = time.perf_counter()
+            await client.render_regions(jobs)
+            return time.perf_counter() - start
+
+    elapsed = asyncio.run(run())
+    return {"tiles_per_s": tiles / elapsed}
+
+
+# Function to compare raw binary pixels with the same plane as a JSON list
+def bench_pixels(url, size):
+    sess = requests.session()
+    omero_login.login(sess, url, "bench", "bench")
+    start = time.perf_counter()
+    plane = fetch_raw_region(sess, url, 1, 0, 0, 0, ">u2", (size, size))
+    raw_seconds = time.perf_counter() - start
+
+    # The JSON API has no pixel lists; time decoding one built locally
+    body = json.dumps(plane.tolist())
+    start = time.perf_counter()
+    np.array(json.loads(body), dtype=np.uint16)
+    json_seconds = time.perf_counter() - start
+    return {
+        "pixels_raw_ms": raw_seconds * 1000,
+        "pixels_raw_mb": plane.nbytes / 1e6,
+        "pixels_json_decode_ms": json_seconds * 1000,
+        "pixels_json_mb": len(body) / 1e6,
+    }
+
+
+# Function to measure /dashboard latency of the Flask viewer
+def bench_dashboard(url, rounds):
+    import loginflask2
+
+    loginflask2.my_omero_instance_url = url
+    client = loginflask2.app.test_client()
+    client.post("/login", data={"username": "bench", "password": "bench"})
+    results = {}
+    for label, ttl in (("uncached", 0), ("cached", 60)):
+        loginflask2.metadata_cache.ttl = ttl
+        samples = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            res = client.get("/dashboard")
+            # The page is streamed: time until the whole body has arrived
+            res.get_data()
+            samples.append(time.perf_counter() - start)
+            if res.status_code != 200:
+                raise RuntimeError(f"/dashboard returned {res.status_code}")
+        results[f"dashboard_{label}_p50_ms"] = percentile(samples, 50) * 1000
+        results[f"dashboard_{label}_p99_ms"] = percentile(samples, 99) * 1000
+    return results
+
+
+# Function to compare results against a stored baseline
+def compare(results, baseline, tolerance):
+    """Returns a list of human readable regressions beyond `tolerance` (0.2 = 20%)."""
+    regressions = []
+    for name, value in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if name in HIGHER_IS_BETTER:
+            worse = value < base * (1 - tolerance)
+        else:
+            worse = value > base * (1 + tolerance)
+        if worse:
+            regressions.append(f"{name}: {value:.2f} (baseline {base:.2f})")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark against a local mock OMERO.web"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=5, help="per-request latency in ms"
+    )
+    parser.add_argument("--page-size", type=int, default=200)
+    parser.add_argument("--images", type=int, default=5000)
+    parser.add_argument("--tiles", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--plane-size", type=int, default=2048, help="side of the raw pixel plane"
+    )
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--baseline", default="bench_baseline.json")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    with MockOmero(
+        latency=args.latency / 1000,
+        page_size=args.page_size,
+        images=args.images,
+        datasets=args.images // 20,
+    ) as server:
+        results = {}
+        results.update(bench_login(server.url, args.rounds))
+        results.update(bench_listing(server.url))
+        results.update(bench_tiles(server.url, args.tiles, args.concurrency))
+        results.update(bench_pixels(server.url, args.plane_size))
+        results.update(bench_dashboard(server.url, args.rounds))
+
+    for name, value in results.items():
+        print(f"{name:>30}: {value:10.2f}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f" > Saved baseline to {args.baseline}")
+        return 0
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,207 @@
+from collections import namedtuple
+
+import omero
+from omero.rtypes import unwrap
+
+
+ImageRecord = namedtuple(
+    "ImageRecord",
+    [
+        "id",
+        "name",
+        "owner",
+        "project_id",
+        "dataset_id",
+        "pixels_id",
+        "pixels_type",
+        "size_x",
+        "size_y",
+        "size_z",
+        "size_c",
+        "size_t",
+        "channels",
+    ],
+)
+
+ChannelRecord = namedtuple(
+    "ChannelRecord",
+    ["label", "color", "lut", "reverse", "window_start", "window_end", "active"],
+)
+
+# Ids per query, to keep parameter lists reasonably sized
+BATCH_SIZE = 500
+
+
+# Function to run an HQL query on the gateway's query service
+def _query(conn, hql, params):
+    return conn.getQueryService().findAllByQuery(hql, params, conn.SERVICE_OPTS)
+
+
+# Function to split a list of ids into batches
+def _batches(ids):
+    for start in range(0, len(ids), BATCH_SIZE):
+        yield ids[start : start + BATCH_SIZE]
+
+
+# Function to load the Project -> Dataset -> Image hierarchy in one query
+def load_hierarchy(conn, project_name=None, project_ids=None):
+    """
+    Returns a list of (project_id, dataset_id, image) tuples, with `image`
+    an unloaded-children omero.model.ImageI, for the projects matching
+    `project_name` or `project_ids`.
+    """
+    params = omero.sys.ParametersI()
+    clauses = []
+    if project_name is not None:
+        params.addString("name", project_name)
+        clauses.append("p.name = :name")
+    if project_ids is not None:
+        params.addIds(project_ids)
+        clauses.append("p.id in (:ids)")
+    hql = (
+        "select distinct p from Project p"
+        " left outer join fetch p.datasetLinks pdl"
+        " left outer join fetch pdl.child d"
+        " left outer join fetch d.imageLinks dil"
+        " left outer join fetch dil.child i"
+        " left outer join fetch i.details.owner"
+    )
+    if clauses:
+        hql += " where " + " and ".join(clauses)
+
+    rows = []
+    for project in _query(conn, hql, params):
+        for pdl in project.copyDatasetLinks():
+            dataset = pdl.getChild()
+            for dil in dataset.copyImageLinks():
+                rows.append((project.id.val, dataset.id.val, dil.getChild()))
+    return rows
+
+
+# Function to load pixels and channels for many images at once
+def _load_pixels(conn, image_ids):
+    pixels_by_image = {}
+    for batch in _batches(image_ids):
+        params = omero.sys.ParametersI()
+        params.addIds(batch)
+        hql = (
+            "select distinct pix from Pixels pix"
+            " join fetch pix.image i"
+            " join fetch pix.pixelsType"
+            " left outer join fetch pix.channels c"
+            " left outer join fetch c.logicalChannel"
+            " where i.id in (:ids)"
+        )
+        for pix in _query(conn, hql, params):
+            pixels_by_image[pix.getImage().id.val] = pix
+    return pixels_by_image
+
+
+# Function to load rendering settings for many pixels at once
+def _load_rendering_defs(conn, pixels_ids):
+    """
+    Returns {pixels_id: RenderingDef}, preferring the current user's
+    settings over anyone else's, as the viewer does.
+    """
+    user_id = conn.getUserId()
+    rdefs = {}
+    for batch in _batches(pixels_ids):
+        params = omero.sys.ParametersI()
+        params.addIds(batch)
+        hql = (
+            "select rdef from RenderingDef rdef"
+            " join fetch rdef.pixels pix"
+            " join fetch rdef.details.owner"
+            " left outer join fetch rdef.waveRendering cb"
+            " left outer join fetch cb.spatialDomainEnhancement"
+            " where pix.id in (:ids)"
+        )
+        for rdef in _query(conn, hql, params):
+            pixels_id = rdef.getPixels().id.val
+            mine = rdef.details.owner.id.val == user_id
+            if mine or pixels_id not in rdefs:
+                rdefs[pixels_id] = rdef
+    return rdefs
+
+
+# Function to build compact channel records from loaded pixels and settings
+def _channel_records(pixels, rdef):
+    bindings = rdef.copyWaveRendering() if rdef is not None else []
+    records = []
+    for index, channel in enumerate(pixels.copyChannels()):
+        logical = channel.getLogicalChannel()
+        label = unwrap(logical.getName()) if logical is not None else None
+        if not label and logical is not None:
+            emission = unwrap(logical.getEmissionWave())
+            label = str(emission) if emission is not None else None
+        if not label:
+            label = str(index)
+
+        binding = bindings[index] if index < len(bindings) else None
+        if binding is None:
+            records.append(ChannelRecord(label, None, None, False, None, None, True))
+            continue
+        color = (
+            unwrap(binding.getRed()),
+            unwrap(binding.getGreen()),
+            unwrap(binding.getBlue()),
+            unwrap(binding.getAlpha()),
+        )
+        reverse = any(
+            isinstance(ctx, omero.model.ReverseIntensityContextI)
+            and unwrap(ctx.getReverse())
+            for ctx in binding.copySpatialDomainEnhancement()
+        )
+        records.append(
+            ChannelRecord(
+                label,
+                color,
+                unwrap(binding.getLookupTable()),
+                reverse,
+                unwrap(binding.getInputStart()),
+                unwrap(binding.getInputEnd()),
+                unwrap(binding.getActive()),
+            )
+        )
+    return records
+
+
+# Function to load every image of a project (or projects) with a few batched queries
+def load_images(conn, project_name=None, project_ids=None):
+    """
+    Returns a list of ImageRecord for all images under the matching projects.
+    Instead of walking listChildren() and calling getChannels() and
+    getPrimaryPixels() per image, this runs one hierarchy query plus one
+    pixels/channels query and one rendering settings query per batch of
+    images.
+    """
+    rows = load_hierarchy(conn, project_name=project_name, project_ids=project_ids)
+    image_ids = sorted({image.id.val for _, _, image in rows})
+    pixels_by_image = _load_pixels(conn, image_ids)
+    rdefs = _load_rendering_defs(conn, [p.id.val for p in pixels_by_image.values()])
+
+    records = []
+    for project_id, dataset_id, image in rows:
+        pixels = pixels_by_image.get(image.id.val)
+        if pixels is None:
+            continue
+        owner = image.details.owner
+        records.append(
+            ImageRecord(
+                id=image.id.val,
+                name=unwrap(image.getName()),
+                owner=unwrap(owner.getOmeName()) if owner is not None else None,
+                project_id=project_id,
+                dataset_id=dataset_id,
+                pixels_id=pixels.id.val,
+                pixels_type=unwrap(pixels.getPixelsType().getValue()),
+                size_x=unwrap(pixels.getSizeX()),
+                size_y=unwrap(pixels.getSizeY()),
+                size_z=unwrap(pixels.getSizeZ()),
+                size_c=unwrap(pixels.getSizeC()),
+                size_t=unwrap(pixels.getSizeT()),
+                channels=_channel_records(pixels, rdefs.get(pixels.id.val)),
+            )
+        )
+    return records
+
@@ -0,0 +1,171 @@
+import argparse
+import contextlib
+import json
+import os
+import sys
+
+import requests
+from dotenv import load_dotenv
+
+import omero_login
+from resilience import ResilientSession
+
+KINDS = ("projects", "datasets", "images")
+
+
+# Function to parse repeated KEY=VALUE options into OMERO render settings
+def render_params(items):
+    params = {}
+    for item in items or ():
+        key, sep, value = item.partition("=")
+        if not sep:
+            raise SystemExit(f"Expected KEY=VALUE, got {item!r}")
+        params[key] = value
+    return params
+
+
+# Function to get one object from the JSON API, or exit with the error
+def get_object(sess, base_url, kind, object_id):
+    res = sess.get(f"{base_url}/api/v0/m/{kind}/{object_id}/", verify=False)
+    if res.status_code != 200:
+        raise SystemExit(f"Failed to get {kind[:-1]} {object_id}: {res.status_code}")
+    return res.json().get("data", {})
+
+
+def cmd_list(sess, base_url, args, out):
+    from paging import fetch_page, iter_objects
+
+    url = f"{base_url}/api/v0/m/{args.kind}/"
+    if args.all:
+        objects = iter_objects(sess, url, prefetch=True)
+    else:
+        objects = fetch_page(sess, url, args.offset, args.limit).get("data", [])
+    for obj in objects:
+        if args.json:
+            out.write(json.dumps(obj) + "\n")
+        else:
+            out.write(f"{obj['@id']}\t{obj.get('Name', '')}\n")
+    return 0
+
+
+def cmd_get(sess, base_url, args, out):
+    obj = get_object(sess, base_url, args.kind, args.id)
+    out.write(json.dumps(obj, indent=2) + "\n")
+    return 0
+
+
+def cmd_render(sess, base_url, args, out):
+    params = render_params(args.param)
+    if args.quality is not None:
+        params["q"] = args.quality
+    if args.tile:
+        url = f"{base_url}/webgateway/render_image_region/{args.image_id}/{args.z}/{args.t}/"
+        params["tile"] = args.tile
+    else:
+        url = f"{base_url}/webgateway/render_image/{args.image_id}/{args.z}/{args.t}/"
+    res = sess.get(url, params=params, verify=False)
+    if res.status_code != 200:
+        raise SystemExit(f"Failed to render image {args.image_id}: {res.status_code}")
+    if args.output == "-":
+        out.buffer.write(res.content)
+    else:
+        with open(args.output, "wb") as f:
+            f.write(res.content)
+    return 0
+
+
+def cmd_export(sess, base_url, args, out):
+    from export import export_rendered
+
+    pixels = get_object(sess, base_url, "images", args.image_id).get("Pixels", {})
+    shape = export_rendered(
+        sess,
+        base_url,
+        args.image_id,
+        pixels["SizeX"],
+        pixels["SizeY"],
+        args.path,
+        size_z=pixels.get("SizeZ", 1),
+        size_t=pixels.get("SizeT", 1),
+        render_params=render_params(args.param),
+        tile_size=args.tile_size,
+        workers=args.workers,
+        compression=args.compression,
+    )
+    out.write(f"{args.path}: {shape}\n")
+    return 0
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description="Query and render images on OMERO.web")
+    parser.add_argument(
+        "--url",
+        default=os.getenv("OMERO_URL", "https://demo.openmicroscopy.org"),
+        help="OMERO.web URL (default: $OMERO_URL)",
+    )
+    parser.add_argument("--username", default=os.getenv("USERNAME"))
+    parser.add_argument("--password", default=os.getenv("PASSWORD"))
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = commands.add_parser("list", help="list projects, datasets or images")
+    list_parser.add_argument("kind", choices=KINDS)
+    list_parser.add_argument("--offset", type=int, default=0)
+    list_parser.add_argument("--limit", type=int, default=100)
+    list_parser.add_argument("--all", action="store_true", help="follow every page")
+    list_parser.add_argument("--json", action="store_true", help="print whole objects")
+    list_parser.set_defaults(run=cmd_list)
+
+    get_parser = commands.add_parser("get", help="print one object as JSON")
+    get_parser.add_argument("kind", choices=KINDS)
+    get_parser.add_argument("id", type=int)
+    get_parser.set_defaults(run=cmd_get)
+
+    render_parser = commands.add_parser("render", help="save a rendered JPEG")
+    render_parser.add_argument("image_id", type=int)
+    render_parser.add_argument("output", help="JPEG file, or - for stdout")
+    render_parser.add_argument("--z", type=int, default=0)
+    render_parser.add_argument("--t", type=int, default=0)
+    render_parser.add_argument("--tile", help="LEVEL,X,Y,WIDTH,HEIGHT of one tile")
+    render_parser.add_argument("--quality", type=float, help="JPEG quality, 0-1")
+    render_parser.add_argument(
+        "--param", action="append", metavar="KEY=VALUE", help="render setting"
+    )
+    render_parser.set_defaults(run=cmd_render)
+
+    export_parser = commands.add_parser(
+        "export", help="export a rendered image to a BigTIFF or .zarr"
+    )
+    export_parser.add_argument("image_id", type=int)
+    export_parser.add_argument("path")
+    export_parser.add_argument("--tile-size", type=int, default=512)
+    export_parser.add_argument("--workers", type=int, default=4)
+    export_parser.add_argument("--compression", default="zlib")
+    export_parser.add_argument(
+        "--param", action="append", metavar="KEY=VALUE", help="render setting"
+    )
+    export_parser.set_defaults(run=cmd_export)
+    return parser
+
+
+def main(argv=None):
+    load_dotenv()
+    args = make_parser().parse_args(argv)
+    sess = omero_login.LazySession(
+        args.url, args.username, args.password, session_factory=ResilientSession
+    )
+    # Progress messages go to stderr, so stdout only carries the results
+    out = sys.stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        try:
+            return args.run(sess, args.url, args, out)
+        except RuntimeError as e:
+            print(e)
+            return 1
+        except requests.RequestException as e:
+            # Unreachable, timing out, or failing fast once its circuit is open
+            print(f"Failed to reach OMERO.web at {args.url}: {e}")
+            return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Lookup tables by (start, end, color, lut, reverse, dtype), see build_lut,
+# least recently used first; a uint16 table is 192KB
+MAX_CACHED_LUTS = 64
+_lut_cache = OrderedDict()
+_lut_cache_lock = threading.Lock()
+
+
+# Function to read an ImageJ-style binary LUT file (256 reds, greens, blues)
+def load_lut_file(path):
+    with open(path, "rb") as f:
+        data = np.frombuffer(f.read()[-768:], dtype=np.uint8)
+    return np.ascontiguousarray(data.reshape(3, 256).T)
+
+
+# Function to build a color ramp table from an (r, g, b) color
+def color_table(color):
+    ramp = np.arange(256, dtype=np.uint16)
+    return (ramp[:, None] * np.array(color[:3], dtype=np.uint16) // 255).astype(
+        np.uint8
+    )
+
+
+# Function to build a uint8 RGB lookup table for one channel
+def build_lut(start, end, table, reverse=False, dtype=np.uint16):
+    """
+    Returns a (levels, 3) uint8 table mapping every value of an 8 or 16 bit
+    `dtype` straight to RGB: values are windowed to [start, end], optionally
+    inverted, and looked up in `table` (a (256, 3) color ramp or LUT).
+    """
+    info = np.iinfo(dtype)
+    values = np.arange(info.min, info.max + 1, dtype=np.float32)
+    ramp = np.clip((values - start) / max(end - start, 1e-9), 0, 1)
+    if reverse:
+        ramp = 1 - ramp
+    return table[(ramp * 255 + 0.5).astype(np.uint8)]
+
+
+# Function to get the (cached) lookup table for a channel, one row per component
+def channel_lut(channel, start, end, dtype, luts=None):
+    table_key = channel.lut if luts and channel.lut in luts else channel.color
+    key = (start, end, table_key, bool(channel.reverse), np.dtype(dtype).str)
+    with _lut_cache_lock:
+        lut = _lut_cache.get(key)
+        if lut is not None:
+            _lut_cache.move_to_end(key)
+            return lut
+    if luts and channel.lut in luts:
+        table = luts[channel.lut]
+    else:
+        table = color_table(channel.color or (255, 255, 255))
+    lut = np.ascontiguousarray(build_lut(start, end, table, channel.reverse, dtype).T)
+    with _lut_cache_lock:
+        _lut_cache[key] = lut
+        while len(_lut_cache) > MAX_CACHED_LUTS:
+            _lut_cache.popitem(last=False)
+    return lut
+
+
+# Function to composite any number of channels into one RGB image
+def composite(planes, channels, luts=None, out=None):
+    """
+    Renders `planes` (one 2D array per channel) with `channels` (ChannelRecord
+    from bulk_loader, or anything with the same color, lut, reverse,
+    window_start, window_end and active fields) into an (h, w, 3) uint8
+    image. Channel contributions are added and clamped, as OMERO does.
+
+    8 and 16 bit planes go through a precomputed uint8 table per color
+    component, written into one reusable buffer and accumulated in place, so
+    no per-channel float copies are made. Other pixel types are windowed to
+    8 bit first through a single shared float32 buffer. `luts` maps LUT names
+    (channel.lut) to (256, 3) tables, e.g. from load_lut_file().
+    """
+    height, width = planes[0].shape
+    acc = np.zeros((3, height, width), dtype=np.uint16)
+    component = np.empty((height, width), dtype=np.uint8)
+    index = None  # uint16 scratch for signed 16 bit data
+    scaled = None  # float32 scratch for 32 bit and float data
+
+    for plane, channel in zip(planes, channels):
+        if not channel.active:
+            continue
+        start, end = channel.window_start, channel.window_end
+        if start is None or end is None:
+            start, end = float(plane.min()), float(plane.max())
+
+        if plane.dtype.itemsize <= 2 and plane.dtype.kind in "ui":
+            if plane.dtype.byteorder not in "=|":
+                plane = plane.astype(plane.dtype.newbyteorder("="))
+            lut_dtype = plane.dtype
+            if plane.dtype == np.int16:
+                # Flip the sign bit so -32768..32767 indexes the table at 0..65535
+                if index is None:
+                    index = np.empty((height, width), dtype=np.uint16)
+                np.bitwise_xor(plane.view(np.uint16), 0x8000, out=index)
+                plane = index
+            elif plane.dtype == np.int8:
+                plane = (plane.view(np.uint8) ^ 0x80).view(np.uint8)
+            lut = channel_lut(channel, start, end, lut_dtype, luts)
+        else:
+            # Window to 0..255 in one shared float buffer, then use an 8 bit table
+            if scaled is None:
+                scaled = np.empty((height, width), dtype=np.float32)
+            np.subtract(plane, start, out=scaled, casting="unsafe")
+            np.multiply(scaled, 255 / max(end - start, 1e-9), out=scaled)
+            np.clip(scaled, 0, 255, out=scaled)
+            np.add(scaled, 0.5, out=scaled)  # round rather than truncate
+            if index is None:
+                index = np.empty((height, width), dtype=np.uint16)
+            np.copyto(index, scaled, casting="unsafe")
+            plane = index
+            lut = channel_lut(channel, 0, 255, np.uint8, luts)
+
+        for k in range(3):
+            np.take(lut[k], plane, out=component)
+            np.add(acc[k], component, out=acc[k])
+
+    np.minimum(acc, 255, out=acc)
+    if out is None:
+        out = np.empty((height, width, 3), dtype=np.uint8)
+    for k in range(3):
+        np.copyto(out[..., k], acc[k], casting="unsafe")
+    return out
@@ -0,0 +1,250 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from plane_store import open_raw_store
+from raw_pixels import PIXEL_DTYPES
+
+
+class RawRegionReader:
+    """
+    Reads regions of raw pixels of an image (an ImageRecord from
+    bulk_loader) through one BlitzGateway raw pixels store, as native-endian
+    arrays. Call it as reader(z, c, t, x, y, w, h); close() when done.
+    """
+
+    samples = 1
+
+    def __init__(self, conn, record):
+        self.conn = conn
+        self.source_dtype = np.dtype(PIXEL_DTYPES[record.pixels_type])
+        self.dtype = self.source_dtype.newbyteorder("=")
+        self._rps = open_raw_store(conn, record.pixels_id)
+        self._lock = threading.Lock()  # the store keeps per-call state
+
+    def __call__(self, z, c, t, x, y, w, h):
+        with self._lock:
+            data = self._rps.getTile(z, c, t, x, y, w, h, self.conn.SERVICE_OPTS)
+        return (
+            np.frombuffer(data, dtype=self.source_dtype)
+            .reshape(h, w)
+            .astype(self.dtype)
+        )
+
+    def close(self):
+        self._rps.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RenderedRegionReader:
+    """
+    Reads rendered RGB regions of an image through OMERO.web's
+    render_image_region with a requests-style session. The channel argument
+    is ignored: `render_params` (c, m, maps, q, ...) select what is rendered.
+    """
+
+    samples = 3
+    dtype = np.dtype(np.uint8)
+
+    def __init__(self, sess, base_url, image_id, render_params=None, timeout=60):
+        self.sess = sess
+        self.url = f"{base_url}/webgateway/render_image_region/{image_id}"
+        self.render_params = dict(render_params or {})
+        self.timeout = timeout
+
+    def __call__(self, z, c, t, x, y, w, h):
+        params = dict(self.render_params, region=f"{x},{y},{w},{h}")
+        res = self.sess.get(
+            f"{self.url}/{z}/{t}/", params=params, timeout=self.timeout, verify=False
+        )
+        res.raise_for_status()
+        return np.asarray(Image.open(BytesIO(res.content)).convert("RGB"))[:h, :w]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Function to read all regions of some planes in order, fetching ahead in threads
+def iter_blocks(read_region, planes, size_x, size_y, tile_size=512, workers=4):
+    """
+    Yields (plane_index, x, y, block) for every tile_size region of every
+    (z, c, t) in `planes`, plane by plane and row by row. Up to `workers`
+    regions are fetched and decoded in the background while the caller
+    writes, and at most 2 * `workers` are held at once, so memory depends on
+    the tile size and not on the image size.
+    """
+    jobs = (
+        (index, plane, x, y)
+        for index, plane in enumerate(planes)
+        for y in range(0, size_y, tile_size)
+        for x in range(0, size_x, tile_size)
+    )
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for index, (z, c, t), x, y in jobs:
+                w, h = min(tile_size, size_x - x), min(tile_size, size_y - y)
+                future = executor.submit(read_region, z, c, t, x, y, w, h)
+                pending.append((index, x, y, future))
+                if len(pending) >= 2 * workers:
+                    index, x, y, future = pending.popleft()
+                    yield index, x, y, future.result()
+            while pending:
+                index, x, y, future = pending.popleft()
+                yield index, x, y, future.result()
+        finally:
+            for _, _, _, future in pending:
+                future.cancel()
+
+
+# Function to write blocks into a tiled (Big)TIFF
+def _write_tiff(path, blocks, shape, dtype, tile_size, axes, plane_shape, compression):
+    import tifffile
+
+    tile_shape = (tile_size, tile_size) + shape[len(plane_shape) + 2 :]
+
+    def tiles():
+        for _, _, _, block in blocks:
+            if block.shape != tile_shape:
+                # tifffile expects whole tiles; pad the right and bottom edges
+                padded = np.zeros(tile_shape, dtype=dtype)
+                padded[: block.shape[0], : block.shape[1]] = block
+                block = padded
+            yield block
+
+    with tifffile.TiffWriter(path, bigtiff=True) as tif:
+        tif.write(
+            tiles(),
+            shape=shape,
+            dtype=dtype,
+            tile=(tile_size, tile_size),
+            photometric="rgb" if len(tile_shape) == 3 else "minisblack",
+            compression=compression,
+            metadata={"axes": axes},
+        )
+
+
+# Function to write blocks into a chunked Zarr array
+def _write_zarr(path, blocks, shape, dtype, tile_size, axes, plane_shape):
+    import zarr
+
+    chunks = (
+        (1,) * len(plane_shape) + (tile_size, tile_size) + shape[len(plane_shape) + 2 :]
+    )
+    array = zarr.open_array(
+        path, mode="w", shape=shape, chunks=chunks, dtype=dtype, fill_value=0
+    )
+    array.attrs["axes"] = axes
+    for index, x, y, block in blocks:
+        plane = np.unravel_index(index, plane_shape)
+        h, w = block.shape[:2]
+        array[plane + (slice(y, y + h), slice(x, x + w))] = block
+
+
+# Function to stream planes of an image into a tiled TIFF or a Zarr array
+def export_regions(
+    reader,
+    path,
+    size_x,
+    size_y,
+    planes,
+    plane_shape=None,
+    axes=None,
+    tile_size=512,
+    workers=4,
+    compression=None,
+):
+    """
+    Writes `planes` (a list of (z, c, t)) read through `reader` (a
+    RawRegionReader or RenderedRegionReader) to `path`: a Zarr array if it
+    ends with .zarr, a tiled BigTIFF otherwise. The planes are laid out as
+    `plane_shape` (by default one flat axis) in front of Y and X, described
+    by `axes`. Regions are fetched while earlier ones are being written.
+    """
+    plane_shape = tuple(plane_shape or (len(planes),))
+    if axes is None:
+        axes = "I" * len(plane_shape) + "YX"
+    samples = (reader.samples,) if reader.samples > 1 else ()
+    if samples:
+        axes += "S"
+    shape = plane_shape + (size_y, size_x) + samples
+    blocks = iter_blocks(reader, planes, size_x, size_y, tile_size, workers)
+    if path.rstrip(os.sep).endswith(".zarr"):
+        _write_zarr(path, blocks, shape, reader.dtype, tile_size, axes, plane_shape)
+    else:
+        _write_tiff(
+            path, blocks, shape, reader.dtype, tile_size, axes, plane_shape, compression
+        )
+    return shape
+
+
+# Function to export all raw planes of an image through BlitzGateway
+def export_raw(conn, record, path, tile_size=512, workers=4, compression="zlib"):
+    """Exports every plane of `record` (an ImageRecord) as a TZCYX array."""
+    planes = [
+        (z, c, t)
+        for t in range(record.size_t)
+        for z in range(record.size_z)
+        for c in range(record.size_c)
+    ]
+    with RawRegionReader(conn, record) as reader:
+        return export_regions(
+            reader,
+            path,
+            record.size_x,
+            record.size_y,
+            planes,
+            (record.size_t, record.size_z, record.size_c),
+            "TZCYX",
+            tile_size,
+            workers,
+            compression,
+        )
+
+
+# Function to export the rendered planes of an image through OMERO.web
+def export_rendered(
+    sess,
+    base_url,
+    image_id,
+    size_x,
+    size_y,
+    path,
+    size_z=1,
+    size_t=1,
+    render_params=None,
+    tile_size=512,
+    workers=4,
+    compression="zlib",
+):
+    """Exports every rendered (z, t) plane of an image as a TZYXS RGB array."""
+    planes = [(z, 0, t) for t in range(size_t) for z in range(size_z)]
+    with RenderedRegionReader(sess, base_url, image_id, render_params) as reader:
+        return export_regions(
+            reader,
+            path,
+            size_x,
+            size_y,
+            planes,
+            (size_t, size_z),
+            "TZYX",
+            tile_size,
+            workers,
+            compression,
+        )
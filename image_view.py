@@ -1,8 +1,6 @@
 # import ezomero
-from omero.gateway import BlitzGateway
 from dotenv import load_dotenv
 import os
-import matplotlib.pyplot as plt
 
 load_dotenv()
 USERNAME = os.getenv("USERNAME")
@@ -10,6 +8,18 @@ PASSWORD = os.getenv("PASSWORD")
 HOST = os.getenv("HOST")
 PORT = os.getenv("PORT")
 
+# Larger images are shown from a locally built, downsampled pyramid level
+MAX_DISPLAY_SIZE = 2048
+
+# Show a Z projection (max, min, sum or mean) of Z stacks instead of plane 0
+PROJECTION = os.getenv("PROJECTION")
+
+# Local memory-mapped cache of planes, kept between runs
+PLANE_CACHE_DIR = os.getenv(
+    "PLANE_CACHE_DIR", os.path.expanduser("~/.cache/omero_planes")
+)
+PLANE_CACHE_MAX_BYTES = int(os.getenv("PLANE_CACHE_MAX_BYTES", 4 * 1024**3))
+
 
 def print_obj(obj, indent=0):
     """
@@ -28,33 +38,68 @@ def print_obj(obj, indent=0):
     )
 
 
-with BlitzGateway(USERNAME, PASSWORD, host=HOST, port=PORT, secure=True) as conn:
-    print("Connected to server")
-    for project in conn.getObjects("Project", opts={"name": 'imagetest'}):
-        print_obj(project)
-        # We can get Datasets with listChildren, since we have the Project already.
-        # Or conn.getObjects("Dataset", opts={'project', id}) if we have Project ID
-        for dataset in project.listChildren():
-            print_obj(dataset, 2)
-            for image in dataset.listChildren():
-                # my_exp_id = conn.getUser().getId()
-                # images = conn.getObjects("Image", attributes={"name":"row2_col1.tiff"})
-                # for image in images:
-                print_obj(image)
-                print(" X:", image.getSizeX())
-                print(" Y:", image.getSizeY())
-                print(" Z:", image.getSizeZ())
-                print(" C:", image.getSizeC())
-                print(" T:", image.getSizeT())
-                # List Channels (loads the Rendering settings to get channel colors)
-                for channel in image.getChannels():
-                    print('Channel:', channel.getLabel())
-                    print('Color:', channel.getColor().getRGB())
-                    print('Lookup table:', channel.getLut())
-                    print('Is reverse intensity?', channel.isReverseIntensity())
-                pixels = image.getPrimaryPixels()
-                plane = pixels.getPlane(0, 0, 0)
-                plt.imshow(plane, cmap='gray')
-                plt.title(f"Image ID: {image.getId()}, Name: {image.getName()}")
-                plt.axis('off')  # Hide axes
-                plt.show()
+def print_record(record, indent=0):
+    """
+    Helper method to display an ImageRecord from bulk_loader.
+    """
+    print(
+        """%sImage:%s  Name:"%s" (owner=%s)"""
+        % (" " * indent, record.id, record.name, record.owner)
+    )
+
+
+def main():
+    # OMERO, matplotlib and numpy are only imported when the viewer runs
+    import matplotlib.pyplot as plt
+    from omero.gateway import BlitzGateway
+
+    import bulk_loader
+    from compositing import composite
+    from plane_store import PlaneStore, get_plane
+    from projection import project
+    from pyramid import overview
+
+    plane_store = PlaneStore(PLANE_CACHE_DIR, max_bytes=PLANE_CACHE_MAX_BYTES)
+
+    with BlitzGateway(USERNAME, PASSWORD, host=HOST, port=PORT, secure=True) as conn:
+        print("Connected to server")
+        # Load projects, datasets, images, pixels, channels and rendering settings
+        # in a few batched queries instead of walking the tree object by object.
+        records = bulk_loader.load_images(conn, project_name='imagetest')
+        dataset_id = None
+        for record in records:
+            if record.dataset_id != dataset_id:
+                dataset_id = record.dataset_id
+                print(f"Project:{record.project_id} Dataset:{dataset_id}")
+            print_record(record, 2)
+            print(" X:", record.size_x)
+            print(" Y:", record.size_y)
+            print(" Z:", record.size_z)
+            print(" C:", record.size_c)
+            print(" T:", record.size_t)
+            # List Channels (rendering settings were loaded with the batch)
+            for channel in record.channels:
+                print('Channel:', channel.label)
+                print('Color:', channel.color)
+                print('Lookup table:', channel.lut)
+                print('Is reverse intensity?', channel.reverse)
+            # Composite the active channels locally with their rendering settings;
+            # edit record.channels (windows, colors, active) to re-render offline
+            planes = []
+            for c in range(record.size_c):
+                if max(record.size_x, record.size_y) > MAX_DISPLAY_SIZE:
+                    planes.append(
+                        overview(plane_store, conn, record, MAX_DISPLAY_SIZE, c=c)
+                    )
+                elif PROJECTION and record.size_z > 1:
+                    planes.append(project(conn, record, PROJECTION, c=c))
+                else:
+                    planes.append(get_plane(plane_store, conn, record, 0, c, 0))
+            plt.imshow(composite(planes, record.channels))
+            plt.title(f"Image ID: {record.id}, Name: {record.name}")
+            plt.axis('off')  # Hide axes
+            plt.show()
+
+
+if __name__ == "__main__":
+    main()
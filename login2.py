@@ -1,121 +1,64 @@
-import requests
 from dotenv import load_dotenv
 import os
+import omero_login
+from paging import iter_objects
+from resilience import ResilientSession
 
 load_dotenv()
 
 login = os.getenv("USERNAME")
 password = os.getenv("PASSWORD")
-my_omero_instance_url = "https://demo.openmicroscopy.org"
-
-sess = requests.session()
-
-# Step 1: Get the server ID
-print(" > Listing server")
-url = my_omero_instance_url + "/api/v0/servers/"
-server_request = sess.get(url, verify=False)  # Ensure SSL verification
-data = server_request.json()
-id_server = int(data["data"][0]["id"])
-print("     > using server : " + str(id_server))
-
-# Step 2: Get the CSRF token
-print(" > Getting token")
-url = my_omero_instance_url + "/api/v0/token/"
-res = sess.get(url, verify=False)  # Ensure SSL verification
-data = res.json()
-token = data["data"]
-print("     > using token : " + str(token))
-
-# Step 3: Prepare login payload
-url = my_omero_instance_url + "/api/v0/login/"
-login_payload = {
-    "server": id_server,
-    "username": login,
-    "password": password,
-    "csrfmiddlewaretoken": token,  # Include CSRF token
-}
-
-# Step 4: Set headers including Referer
-headers = {
-    "referer": "https://demo.openmicroscopy.org",
-    "X-CSRFToken": token,  # Optionally include CSRF token in headers
-}
-
-# Step 5: Attempt to log in
-print(" > Attempting to log in")
-res_log = sess.post(
-    url, data=login_payload, headers=headers, verify=False
-)  # Ensure SSL verification
-print("Response:", res_log.text)
-
-# Step 6: Check if login was successful
-if res_log.status_code == 200 and res_log.json().get("success"):
-    print("Login successful!")
-    event_context = res_log.json().get("eventContext")
-    print("Event Context:", event_context)
-else:
-    print("Login failed:", res_log.text)
-    exit()  # Exit if login fails
+my_omero_instance_url = os.getenv("OMERO_URL", "https://demo.openmicroscopy.org")
+# OMERO pixel buffer service for raw pixels, usually proxied by OMERO.web
+pixel_buffer_url = os.getenv("PIXEL_BUFFER_URL", my_omero_instance_url)
+
+# Logs in on first use, not at import; upstream calls get timeouts, bounded
+# retries and a circuit breaker
+sess = omero_login.LazySession(
+    my_omero_instance_url, login, password, session_factory=ResilientSession
+)
+
+
+# Function to iterate lazily over all objects of a kind (projects, datasets, images)
+def iter_objects_of(kind, page_size=None, prefetch=False):
+    url = my_omero_instance_url + f"/api/v0/m/{kind}/"
+    return iter_objects(sess, url, page_size=page_size, prefetch=prefetch)
 
 
 # Function to list projects and return the first project ID
 def list_projects():
     print(" > Listing projects")
-    url = my_omero_instance_url + "/api/v0/m/projects/"
-    res = sess.get(url, verify=False)
-    if res.status_code == 200:
-        projects = res.json().get("data", [])
-        if projects:
-            first_project = projects[0]
-            print(
-                f"First Project ID: {first_project['@id']}, Name: {first_project['Name']}"
-            )
-            return first_project['@id']
-        else:
-            print("No projects found.")
-            return None
+    # Only the first page (of one object) is requested
+    first_project = next(iter_objects_of("projects", page_size=1), None)
+    if first_project:
+        print(f"First Project ID: {first_project['@id']}, Name: {first_project['Name']}")
+        return first_project['@id']
     else:
-        print("Failed to list projects:", res.text)
+        print("No projects found.")
         return None
 
 
 # Function to list datasets and return the first dataset ID
 def list_datasets():
     print(" > Listing datasets")
-    url = my_omero_instance_url + "/api/v0/m/datasets/"
-    res = sess.get(url, verify=False)
-    if res.status_code == 200:
-        datasets = res.json().get("data", [])
-        if datasets:
-            first_dataset = datasets[0]
-            print(
-                f"First Dataset ID: {first_dataset['@id']}, Name: {first_dataset['Name']}"
-            )
-            return first_dataset['@id']
-        else:
-            print("No datasets found.")
-            return None
+    first_dataset = next(iter_objects_of("datasets", page_size=1), None)
+    if first_dataset:
+        print(f"First Dataset ID: {first_dataset['@id']}, Name: {first_dataset['Name']}")
+        return first_dataset['@id']
     else:
-        print("Failed to list datasets:", res.text)
+        print("No datasets found.")
         return None
 
 
 # Function to list images and return the first image ID
 def list_images():
     print(" > Listing images")
-    url = my_omero_instance_url + "/api/v0/m/images/"
-    res = sess.get(url, verify=False)
-    if res.status_code == 200:
-        images = res.json().get("data", [])
-        if images:
-            first_image = images[0]
-            print(f"First Image ID: {first_image['@id']}, Name: {first_image['Name']}")
-            return first_image['@id']
-        else:
-            print("No images found.")
-            return None
+    first_image = next(iter_objects_of("images", page_size=1), None)
+    if first_image:
+        print(f"First Image ID: {first_image['@id']}, Name: {first_image['Name']}")
+        return first_image['@id']
     else:
-        print("Failed to list images:", res.text)
+        print("No images found.")
         return None
 
 
@@ -154,11 +97,7 @@ def get_dataset(dataset_id):
         print("Failed to get dataset:", res.text)
 
 
-import numpy as np
-import matplotlib.pyplot as plt
-
-
-# Function to get a single image by ID and render it using pixel data from the API
+# Function to get a single image by ID and render it from its raw pixel data
 def get_image(image_id):
     if image_id is None:
         return
@@ -166,45 +105,50 @@ def get_image(image_id):
     url = my_omero_instance_url + f"/api/v0/m/images/{image_id}/"
     res = sess.get(url, verify=False)
     if res.status_code == 200:
-        data = res.json().get("data", [])
-        if not data:
+        image = res.json().get("data", {})
+        if not image:
             print("No image data found.")
             return
 
-        image = data[0]  # Access the first item in the data list
         image_id = image.get('@id', 'N/A')
         name = image.get('Name', 'N/A')
-        acquisition_date = image.get('AcquisitionDate', 'No acquisition date available')
         pixels = image.get('Pixels', {})
 
         # Extract pixel dimensions
         size_x = pixels.get('SizeX', 1)
         size_y = pixels.get('SizeY', 1)
         size_z = pixels.get('SizeZ', 1)
-        size_c = pixels.get('SizeC', 1)
 
-        # Assuming you want to render the middle slice of the first channel
-        z = size_z / 2  # Middle slice
+        # Render the middle slice of the first channel
+        z = size_z // 2  # Middle slice
+        c = 0  # First channel
         t = 0  # Time point (assuming single time point)
 
-        # Get the pixel data (this assumes the pixel data is available in the response)
-        pixel_data = pixels.get(
-            'data', None
-        )  # Adjust this line based on actual pixel data structure
-
-        if pixel_data is not None:
-            # Convert pixel data to a numpy array for rendering
-            image_array = np.array(pixel_data).reshape(
-                (size_y, size_x)
-            )  # Reshape based on dimensions
+        # numpy and matplotlib are only loaded once an image is shown
+        import matplotlib.pyplot as plt
+        from raw_pixels import fetch_raw_region, pixels_dtype
+
+        # The plane comes as binary pixels in the image's own type and is
+        # wrapped in place by numpy, instead of as a JSON list of numbers
+        image_array = fetch_raw_region(
+            sess,
+            pixel_buffer_url,
+            image_id,
+            z,
+            c,
+            t,
+            pixels_dtype(pixels),
+            (size_x, size_y),
+        )
 
+        if image_array is not None:
             # Render the image
             plt.imshow(image_array, cmap='gray')
             plt.title(f"Image ID: {image_id}, Name: {name}")
             plt.axis('off')  # Hide axes
             plt.show()
         else:
-            print("No pixel data found in the image response.")
+            print("No pixel data found for the image.")
     else:
         print("Failed to get image:", res.text)
 
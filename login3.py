@@ -1,80 +1,47 @@
-import requests
 from dotenv import load_dotenv
 import os
-from PIL import Image
+import omero_login
 from io import BytesIO
-import ssl
-import urllib.request
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from paging import iter_objects
+from progressive import FULL_QUALITY, AdaptiveQuality
+from resilience import ResilientSession
 
 load_dotenv()
 
 login = os.getenv("USERNAME")
 password = os.getenv("PASSWORD")
-my_omero_instance_url = "https://demo.openmicroscopy.org"
-
-sess = requests.session()
-
-# Step 1: Get the server ID
-print(" > Listing server")
-url = my_omero_instance_url + "/api/v0/servers/"
-server_request = sess.get(url, verify=False)  # Ensure SSL verification
-data = server_request.json()
-id_server = int(data["data"][0]["id"])
-print("     > using server : " + str(id_server))
-
-# Step 2: Get the CSRF token
-print(" > Getting token")
-url = my_omero_instance_url + "/api/v0/token/"
-res = sess.get(url, verify=False)  # Ensure SSL verification
-data = res.json()
-token = data["data"]
-print("     > using token : " + str(token))
-
-# Step 3: Prepare login payload
-url = my_omero_instance_url + "/api/v0/login/"
-login_payload = {
-    "server": id_server,
-    "username": login,
-    "password": password,
-    "csrfmiddlewaretoken": token,  # Include CSRF token
-}
-
-# Step 4: Set headers including Referer
-headers = {
-    "referer": "https://demo.openmicroscopy.org",
-    "X-CSRFToken": token,  # Optionally include CSRF token in headers
-}
-
-# Step 5: Attempt to log in
-print(" > Attempting to log in")
-res_log = sess.post(
-    url, data=login_payload, headers=headers, verify=False
-)  # Ensure SSL verification
-print("Response:", res_log.text)
-
-# Step 6: Check if login was successful
-if res_log.status_code == 200 and res_log.json().get("success"):
-    print("Login successful!")
-    event_context = res_log.json().get("eventContext")
-    print("Event Context:", event_context)
-else:
-    print("Login failed:", res_log.text)
-    exit()  # Exit if login fails
+my_omero_instance_url = os.getenv("OMERO_URL", "https://demo.openmicroscopy.org")
+
+# Workers fetching the tiles of a mosaic, each with a pooled keep-alive connection
+MOSAIC_WORKERS = 8
+
+# Logs in on first use, not at import; upstream calls get timeouts, bounded
+# retries, a circuit breaker and hedged tiles
+sess = omero_login.LazySession(
+    my_omero_instance_url,
+    login,
+    password,
+    session_factory=ResilientSession,
+    pool_maxsize=MOSAIC_WORKERS,
+)
+
+
+# Function to iterate lazily over all objects of a kind (projects, datasets, images)
+def iter_objects_of(kind, page_size=None, prefetch=True):
+    url = my_omero_instance_url + f"/api/v0/m/{kind}/"
+    return iter_objects(sess, url, page_size=page_size, prefetch=prefetch)
 
 
 # Function to list projects
 def list_projects():
     print(" > Listing projects")
-    url = my_omero_instance_url + "/api/v0/m/projects/"
-    res = sess.get(url, verify=False)
-    if res.status_code == 200:
-        projects = res.json().get("data", [])
-        for project in projects:
-            print(
-                f"Project ID: {project['@id']}, Name: {project['Name']}, Description: {project['Description']}"
-            )
-    else:
-        print("Failed to list projects:", res.text)
+    for project in iter_objects_of("projects"):
+        print(
+            f"Project ID: {project['@id']}, Name: {project['Name']}, Description: {project['Description']}"
+        )
 
 
 # Function to get a single project by ID
@@ -94,20 +61,14 @@ def get_project(project_id):
 # Function to list datasets
 def list_datasets():
     print(" > Listing datasets")
-    url = my_omero_instance_url + "/api/v0/m/datasets/"
-    res = sess.get(url, verify=False)
-    if res.status_code == 200:
-        datasets = res.json().get("data", [])
-        for dataset in datasets:
-            dataset_id = dataset.get('@id', 'N/A')
-            name = dataset.get('Name', 'N/A')
-            description = dataset.get('Description', 'No description available')
-            print(f"Dataset ID: {dataset_id}, Name: {name}, Description: {description}")
-            print(f"  URL: {dataset.get('url:dataset', 'N/A')}")
-            print(f"  URL to Images: {dataset.get('url:images', 'N/A')}")
-            print(f"  URL to Projects: {dataset.get('url:projects', 'N/A')}")
-    else:
-        print("Failed to list datasets:", res.text)
+    for dataset in iter_objects_of("datasets"):
+        dataset_id = dataset.get('@id', 'N/A')
+        name = dataset.get('Name', 'N/A')
+        description = dataset.get('Description', 'No description available')
+        print(f"Dataset ID: {dataset_id}, Name: {name}, Description: {description}")
+        print(f"  URL: {dataset.get('url:dataset', 'N/A')}")
+        print(f"  URL to Images: {dataset.get('url:images', 'N/A')}")
+        print(f"  URL to Projects: {dataset.get('url:projects', 'N/A')}")
 
 
 # Function to get a single dataset by ID
@@ -130,33 +91,25 @@ def get_dataset(dataset_id):
 # Function to list images
 def list_images():
     print(" > Listing images")
-    url = my_omero_instance_url + "/api/v0/m/images/"
-    res = sess.get(url, verify=False)
-    if res.status_code == 200:
-        images = res.json().get("data", [])
-        for image in images:
-            image_id = image.get('@id', 'N/A')
-            name = image.get('Name', 'N/A')
-            acquisition_date = image.get(
-                'AcquisitionDate', 'No acquisition date available'
-            )
-            image_url = image.get('url:image', 'N/A')
-            pixels = image.get('Pixels', {})
-            size_x = pixels.get('SizeX', 'N/A')
-            size_y = pixels.get('SizeY', 'N/A')
-            size_z = pixels.get('SizeZ', 'N/A')
-            size_c = pixels.get('SizeC', 'N/A')
-            size_t = pixels.get('SizeT', 'N/A')
+    for image in iter_objects_of("images"):
+        image_id = image.get('@id', 'N/A')
+        name = image.get('Name', 'N/A')
+        acquisition_date = image.get('AcquisitionDate', 'No acquisition date available')
+        image_url = image.get('url:image', 'N/A')
+        pixels = image.get('Pixels', {})
+        size_x = pixels.get('SizeX', 'N/A')
+        size_y = pixels.get('SizeY', 'N/A')
+        size_z = pixels.get('SizeZ', 'N/A')
+        size_c = pixels.get('SizeC', 'N/A')
+        size_t = pixels.get('SizeT', 'N/A')
 
-            print(
-                f"Image ID: {image_id}, Name: {name}, Acquisition Date: {acquisition_date}"
-            )
-            print(f"  URL: {image_url}")
-            print(
-                f"  Pixel Dimensions: SizeX={size_x}, SizeY={size_y}, SizeZ={size_z}, SizeC={size_c}, SizeT={size_t}"
-            )
-    else:
-        print("Failed to list images:", res.text)
+        print(
+            f"Image ID: {image_id}, Name: {name}, Acquisition Date: {acquisition_date}"
+        )
+        print(f"  URL: {image_url}")
+        print(
+            f"  Pixel Dimensions: SizeX={size_x}, SizeY={size_y}, SizeZ={size_z}, SizeC={size_c}, SizeT={size_t}"
+        )
 
 
 # Function to get a single image by ID
@@ -221,25 +174,141 @@ def get_image(image_id):
 
 
 # Function to render a single tile of an image
-def render_image_tile(image_id, tile_x, tile_y, tile_width, tile_height, channel=1):
+def render_image_tile(
+    image_id, tile_x, tile_y, tile_width, tile_height, channel=1, quality=FULL_QUALITY
+):
     # Construct the URL for the tile
-    url = f"{my_omero_instance_url}/webgateway/render_image_region/{image_id}/0/0/?tile={tile_x},{tile_y},0,{tile_width},{tile_height}&c={channel}|0:255$808080&maps=[{{%22inverted%22:{{%22enabled%22:false}}}}]&m=g&p=normal&q=0.9"
+    url = f"{my_omero_instance_url}/webgateway/render_image_region/{image_id}/0/0/?tile={tile_x},{tile_y},0,{tile_width},{tile_height}&c={channel}|0:255$808080&maps=[{{%22inverted%22:{{%22enabled%22:false}}}}]&m=g&p=normal&q={quality}"
 
     print(f"Fetching image tile from: {url}")
 
-    # Fetch the image data
-    # response = requests.get(url, verify=False)
-    context = ssl._create_unverified_context()
-    with urllib.request.urlopen(url, context=context) as response:
+    from PIL import Image
 
+    # Fetch the image data through the session, with its timeouts and retries
+    response = sess.get(url, verify=False)
+    if response.status_code == 200 and response.content:
         # Open the image using PIL
-        img_d = response.read()
-        # img = Image.open("gfg.png")
-        if img_d:
-            img = Image.open(BytesIO(img_d))
-            img.show()
-        else:
-            print("Failed to fetch image tile")
+        img = Image.open(BytesIO(response.content))
+        img.show()
+    else:
+        print(f"Failed to fetch image tile: {response.status_code}")
+
+
+# Latency of full tile fetches, used to pick the quality of tile previews
+adaptive_quality = AdaptiveQuality()
+
+
+# Function to fetch a tile progressively: a quick preview, then the full tile
+def iter_progressive_tile(
+    image_id, tile_x, tile_y, tile_width, tile_height, channel=1, moving=False
+):
+    """
+    Yields (quality, PIL image) for tile (tile_x, tile_y) of level 0: first
+    a low-quality preview, then the full-quality tile unless `moving` (the
+    caller asks again once the view settles). On a fast link the preview
+    is skipped, and its quality drops as the measured latency grows.
+    """
+    url = f"{my_omero_instance_url}/webgateway/render_image_region/{image_id}/0/0/"
+    params = {
+        "tile": f"0,{tile_x},{tile_y},{tile_width},{tile_height}",
+        "c": f"{channel}|0:255$808080",
+        "m": "g",
+        "p": "normal",
+    }
+    qualities = []
+    if adaptive_quality.wants_preview(my_omero_instance_url, moving):
+        qualities.append(
+            adaptive_quality.preview_quality(my_omero_instance_url, moving)
+        )
+    if not moving:
+        qualities.append(FULL_QUALITY)
+    for quality in qualities:
+        start = time.perf_counter()
+        res = sess.get(url, params=dict(params, q=quality), verify=False)
+        if res.status_code != 200:
+            print(f"Failed to fetch tile {tile_x},{tile_y}: {res.status_code}")
+            return
+        if quality == FULL_QUALITY:
+            adaptive_quality.observe(my_omero_instance_url, time.perf_counter() - start)
+        from PIL import Image
+
+        yield quality, Image.open(BytesIO(res.content))
+
+
+# Function to get the full-resolution size of an image
+def get_image_size(image_id):
+    url = my_omero_instance_url + f"/api/v0/m/images/{image_id}/"
+    res = sess.get(url, verify=False)
+    if res.status_code != 200:
+        print("Failed to get image:", res.text)
+        return None
+    pixels = res.json().get("data", {}).get('Pixels', {})
+    return pixels.get('SizeX', 0), pixels.get('SizeY', 0)
+
+
+# Function to fetch and decode one tile into its slot of the mosaic
+def _fetch_tile_into(mosaic, url, tile_x, tile_y, tile_size):
+    import numpy as np
+    from PIL import Image
+
+    res = sess.get(url, verify=False)
+    if res.status_code != 200:
+        print(f"Failed to fetch tile {tile_x},{tile_y}: {res.status_code}")
+        return False
+    tile = np.asarray(Image.open(BytesIO(res.content)).convert("RGB"))
+    top = tile_y * tile_size
+    left = tile_x * tile_size
+    # Edge tiles are smaller than tile_size, so use the decoded shape
+    tile = tile[: mosaic.shape[0] - top, : mosaic.shape[1] - left]
+    mosaic[top : top + tile.shape[0], left : left + tile.shape[1]] = tile
+    return True
+
+
+# Function to render a whole image plane by fetching all its tiles in parallel
+def render_image_mosaic(
+    image_id, z=0, t=0, level=0, tile_size=512, max_workers=MOSAIC_WORKERS, channel=1
+):
+    """
+    Fetches every tile of plane (z, t) at resolution `level` and stitches
+    them into a single preallocated (height, width, 3) uint8 array.
+    `level` follows OMERO's tile parameter: level 0 is full resolution and
+    each level above it halves the width and height.
+    """
+    import numpy as np
+
+    size = get_image_size(image_id)
+    if size is None:
+        return None
+    scale = 2**level
+    width = math.ceil(size[0] / scale)
+    height = math.ceil(size[1] / scale)
+    cols = math.ceil(width / tile_size)
+    rows = math.ceil(height / tile_size)
+    print(f" > Fetching {cols}x{rows} tiles for image {image_id} ({width}x{height})")
+
+    mosaic = np.zeros((height, width, 3), dtype=np.uint8)
+    base_url = f"{my_omero_instance_url}/webgateway/render_image_region/{image_id}/{z}/{t}/"
+    render_args = f"&c={channel}|0:255$808080&maps=[{{%22inverted%22:{{%22enabled%22:false}}}}]&m=g&p=normal&q=0.9"
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                _fetch_tile_into,
+                mosaic,
+                f"{base_url}?tile={level},{tile_x},{tile_y},{tile_size},{tile_size}{render_args}",
+                tile_x,
+                tile_y,
+                tile_size,
+            )
+            for tile_y in range(rows)
+            for tile_x in range(cols)
+        ]
+        for future in as_completed(futures):
+            if not future.result():
+                failed += 1
+    if failed:
+        print(f"Failed to fetch {failed} of {len(futures)} tiles")
+    return mosaic
 
 
 # Example usage
@@ -251,3 +320,8 @@ if __name__ == "__main__":
     list_images()  # List all images
     get_image(28725)  # Get a specific image by ID
     render_image_tile(28725, 3, 2, 512, 512)  # render a tile
+    from PIL import Image
+
+    mosaic = render_image_mosaic(28725)  # render the whole plane
+    if mosaic is not None:
+        Image.fromarray(mosaic).show()
@@ -1,8 +1,39 @@
-from flask import Flask, redirect, request, render_template_string, session, url_for
-import requests
+from flask import (
+    Flask,
+    Response,
+    g,
+    jsonify,
+    redirect,
+    request,
+    render_template_string,
+    session,
+    stream_with_context,
+    url_for,
+)
+import base64
 import certifi
+import contextvars
+import hashlib
+import json
+import math
 import os
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+from metadata_cache import MetadataCache
+from metadata_index import MetadataIndex
+from metrics import Registry, endpoint_label
+import omero_login
+import requests
+from prefetch import PrefetchScheduler, TileGrid, TilePosition
+from progressive import AdaptiveQuality, upscale_quadrant
+from resilience import CircuitOpenError, Resilience, ResilientSession
+from session_registry import SessionExpired, SessionRegistry
+from singleflight import SingleFlight
+from tile_cache import TileCache, make_image_key, make_thumbnail_key, make_tile_key
 
 # Load environment variables from .env file
 load_dotenv()
@@ -12,44 +43,585 @@ app.secret_key = os.urandom(24)  # Secret key for session management
 
 my_omero_instance_url = "https://cerviai-omero.duckdns.org"
 
+# Prometheus metrics, exposed on /metrics
+metrics = Registry()
+route_latency = metrics.histogram(
+    "omero_viewer_request_seconds", "Flask request latency", ["route", "status"]
+)
+requests_in_flight = metrics.gauge(
+    "omero_viewer_requests_in_flight", "Flask requests being served", ["route"]
+)
+response_bytes = metrics.counter(
+    "omero_viewer_response_bytes_total", "Bytes sent to clients", ["route"]
+)
+upstream_latency = metrics.histogram(
+    "omero_viewer_upstream_seconds",
+    "OMERO.web request latency",
+    ["method", "endpoint", "status"],
+)
+upstream_bytes = metrics.counter(
+    "omero_viewer_upstream_bytes_total", "Bytes received from OMERO.web", ["endpoint"]
+)
+login_phase_latency = metrics.histogram(
+    "omero_viewer_login_phase_seconds", "OMERO.web login latency by phase", ["phase"]
+)
+cache_hit_ratio = metrics.gauge(
+    "omero_viewer_cache_hit_ratio", "Share of lookups served from cache", ["cache"]
+)
+active_sessions = metrics.gauge(
+    "omero_viewer_sessions", "Pooled OMERO.web sessions in the registry"
+)
 
-# Function to list projects
-def list_projects(sess_cookies):
-    print(" > Listing projects")
-    url = my_omero_instance_url + "/api/v0/m/projects/"
-    res = requests.get(url, cookies=sess_cookies, verify=False)
-    if res.status_code == 200:
-        projects = res.json().get("data", [])
-        return projects
-    else:
-        print("Failed to list projects:", res.text)
-        return []
-
-
-# Function to list datasets
-def list_datasets(sess_cookies):
-    print(" > Listing datasets")
-    url = my_omero_instance_url + "/api/v0/m/datasets/"
-    res = requests.get(url, cookies=sess_cookies, verify=False)
-    if res.status_code == 200:
-        datasets = res.json().get("data", [])
-        return datasets
-    else:
-        print("Failed to list datasets:", res.text)
-        return []
-
-
-# Function to list images
-def list_images(sess_cookies):
-    print(" > Listing images")
-    url = my_omero_instance_url + "/api/v0/m/images/"
-    res = requests.get(url, cookies=sess_cookies, verify=False)
-    if res.status_code == 200:
-        images = res.json().get("data", [])
-        return images
+# Add a Server-Timing header with the upstream time spent per phase
+SERVER_TIMING = os.getenv("SERVER_TIMING", "1") == "1"
+
+# Upstream time per phase for the request being served (copied into workers)
+request_timings = contextvars.ContextVar("request_timings", default=None)
+
+# Two-tier cache (memory LRU + disk) for rendered tiles and images
+tile_cache = TileCache(
+    os.getenv(
+        "TILE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "omero_tile_cache")
+    ),
+    max_memory_bytes=int(os.getenv("TILE_CACHE_MEMORY_BYTES", 64 * 1024 * 1024)),
+    max_disk_bytes=int(os.getenv("TILE_CACHE_DISK_MAX_BYTES", 1024**3)),
+)
+
+# Thumbnails get their own cache so they are not evicted by tile traffic
+thumbnail_cache = TileCache(
+    os.path.join(tile_cache.cache_dir, "thumbnails"),
+    max_memory_bytes=int(os.getenv("THUMBNAIL_CACHE_MEMORY_BYTES", 16 * 1024 * 1024)),
+    max_disk_bytes=int(os.getenv("THUMBNAIL_CACHE_DISK_MAX_BYTES", 256 * 1024**2)),
+)
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", 96))
+THUMBNAILS_PER_PAGE = int(os.getenv("THUMBNAILS_PER_PAGE", 60))
+# Projects and datasets fetched per page of the dashboard and /listing
+LISTING_PAGE_SIZE = int(os.getenv("LISTING_PAGE_SIZE", 100))
+
+# Each image's render settings (OMERO's rendering definition for the user, as
+# in imgData) are looked up again after RENDER_SETTINGS_TTL seconds, so that
+# is how long a change made in OMERO can take to reach the cached renderings
+RENDER_SETTINGS_TTL = float(os.getenv("RENDER_SETTINGS_TTL", 60))
+# Entries kept by each metadata cache before the least recently used go
+METADATA_CACHE_MAX_ENTRIES = int(os.getenv("METADATA_CACHE_MAX_ENTRIES", 10000))
+image_data_cache = MetadataCache(
+    ttl=RENDER_SETTINGS_TTL, max_entries=METADATA_CACHE_MAX_ENTRIES
+)
+
+# Cache-Control of rendered responses; use e.g. "public, s-maxage=86400" to
+# let a CDN or reverse proxy share them, if every user may see every image.
+# Their URLs carry the render settings version (v=), and a change of the
+# settings gives new URLs, so a rendered URL never has to be revalidated
+RENDER_CACHE_CONTROL = os.getenv(
+    "RENDER_CACHE_CONTROL", "private, max-age=31536000, immutable"
+)
+TILE_CACHE_CONTROL = os.getenv(
+    "TILE_CACHE_CONTROL", "private, max-age=31536000, immutable"
+)
+# Thumbnail URLs carry a digest of the thumbnail itself, so a new one gets a
+# new URL and the old one never has to be revalidated
+THUMBNAIL_CACHE_CONTROL = os.getenv(
+    "THUMBNAIL_CACHE_CONTROL", "private, max-age=31536000, immutable"
+)
+
+# Per-user cache of project/dataset/image listings
+metadata_cache = MetadataCache(
+    ttl=float(os.getenv("METADATA_CACHE_TTL", 30)),
+    max_entries=METADATA_CACHE_MAX_ENTRIES,
+)
+
+# Per-user local SQLite index of projects, datasets and images for /search,
+# synced in the background once it is older than the sync interval
+METADATA_INDEX_DIR = os.getenv(
+    "METADATA_INDEX_DIR",
+    os.path.join(tempfile.gettempdir(), "omero_metadata_index"),
+)
+METADATA_INDEX_SYNC_INTERVAL = float(os.getenv("METADATA_INDEX_SYNC_INTERVAL", 300))
+metadata_indexes = {}
+metadata_indexes_lock = threading.Lock()
+
+# Identical concurrent upstream render requests share one fetch, and later
+# ones the cached result. Both are only shared within a user ("user"), or
+# within an OMERO group ("group") for groups whose members can all read
+# each other's images
+COALESCE_SCOPE = os.getenv("COALESCE_SCOPE", "user")
+upstream_flights = SingleFlight()
+
+# Progressive tiles: a preview first, then the full tile, with the preview
+# quality (or skipping it) chosen from each viewer's measured tile latency
+adaptive_quality = AdaptiveQuality(
+    fast=float(os.getenv("PREVIEW_FAST_LATENCY", 0.1)),
+    slow=float(os.getenv("PREVIEW_SLOW_LATENCY", 0.5)),
+)
+
+# Timeouts, jittered retries within a retry budget, circuit breaking and (for
+# tiles) hedged requests around every upstream call of the pooled sessions.
+# UPSTREAM_TIMEOUTS overrides read timeouts per kind, e.g. "tile=5,render=60"
+upstream_resilience = Resilience(
+    timeouts={
+        kind: (3.05, float(seconds))
+        for kind, seconds in (
+            item.split("=")
+            for item in os.getenv("UPSTREAM_TIMEOUTS", "").split(",")
+            if item
+        )
+    },
+    retries=int(os.getenv("UPSTREAM_RETRIES", 2)),
+    failure_threshold=int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5)),
+    reset_timeout=float(os.getenv("CIRCUIT_RESET_TIMEOUT", 10)),
+    hedge=[kind for kind in os.getenv("UPSTREAM_HEDGE", "tile").split(",") if kind],
+)
+
+# Worker pool for issuing upstream lookups concurrently
+upstream_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("UPSTREAM_WORKERS", 16))
+)
+
+
+# Function to record a phase of upstream time for the current request
+def add_request_timing(phase, seconds):
+    timings = request_timings.get()
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0) + seconds
+
+
+# Function to record metrics for every upstream OMERO.web request
+def observe_upstream(method, url, res, seconds):
+    endpoint = endpoint_label(url)
+    upstream_latency.observe(seconds, method, endpoint, str(res.status_code))
+    upstream_bytes.inc(endpoint, amount=len(res.content))
+    if endpoint.startswith("/webgateway/"):
+        add_request_timing("render", seconds)
     else:
-        print("Failed to list images:", res.text)
-        return []
+        add_request_timing("list", seconds)
+
+
+# Function to run `fn` on the upstream pool, keeping the request's timing context
+def submit_upstream(fn, *args):
+    return upstream_executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+# Function to log a requests session in to OMERO.web
+def login_session(sess, username, password):
+    res_log, timings = omero_login.login(
+        sess, my_omero_instance_url, username, password
+    )
+    for phase, seconds in timings.items():
+        login_phase_latency.observe(seconds, phase)
+    add_request_timing("login", timings["total"])
+    if res_log.status_code != 200 or not res_log.json().get("success"):
+        return None
+    # The event context identifies the user and group for request coalescing
+    return res_log.json().get("eventContext") or {"success": True}
+
+
+# Function to check whether a session is still logged in to OMERO.web
+def session_logged_in(sess):
+    res = sess.get(
+        f"{my_omero_instance_url}/api/v0/m/projects/",
+        params={"limit": 1},
+        verify=False,
+    )
+    return res.status_code not in (401, 403)
+
+
+# Function to log a fresh requests session in again by joining the OMERO session
+def rejoin_session(sess, username, context):
+    # OMERO.web accepts the session key (bsession) instead of a password, for
+    # as long as the OMERO session itself is alive
+    session_key = context.get("sessionUuid")
+    if not session_key:
+        return None
+    res = sess.get(
+        f"{my_omero_instance_url}/api/v0/m/projects/",
+        params={"limit": 1, "bsession": session_key},
+        verify=False,
+    )
+    if res.status_code != 200:
+        return None
+    return context
+
+
+# Registry of pooled, long-lived OMERO.web sessions, one per logged-in user.
+# Idle sessions are dropped before OMERO's own session timeout (10 minutes
+# by default) so that an expired session can still be rejoined by its key
+session_registry = SessionRegistry(
+    login_session,
+    pool_size=int(os.getenv("SESSION_POOL_SIZE", 10)),
+    idle_timeout=float(os.getenv("SESSION_IDLE_TIMEOUT", 540)),
+    max_sessions=int(os.getenv("MAX_SESSIONS", 500)),
+    observer=observe_upstream,
+    session_factory=lambda: ResilientSession(upstream_resilience),
+    logged_in=session_logged_in,
+    reauth=rejoin_session,
+)
+
+
+# Function to get the pooled session of the logged-in user, or None
+def current_session():
+    sid = session.get('sid')
+    if sid is None:
+        return None
+    return session_registry.get(sid)
+
+
+# Function to fetch a rendered image from OMERO.web, going through the tile cache
+def fetch_rendered(cache_key, url, params, user_sess):
+    # Keys carry the permission context, so a cached image is only served
+    # to the users an identical in-flight request would be shared with
+    data = tile_cache.get(cache_key)
+    if data is not None:
+        return data
+    return fetch_upstream(cache_key, url, params, user_sess)
+
+
+# Function to get the permission context that requests may be shared within
+def permission_context(user_sess):
+    context = user_sess.login_context
+    if COALESCE_SCOPE == "group" and context.get("groupId") is not None:
+        return ("group", context["groupId"])
+    return ("user", context.get("userId", user_sess.sid))
+
+
+# Function to render an image on OMERO.web, sharing identical in-flight requests
+def fetch_upstream(cache_key, url, params, user_sess):
+    # The cache key carries the permission context (see tile_request)
+    return upstream_flights.do(
+        cache_key,
+        fetch_and_cache,
+        cache_key,
+        url,
+        params,
+        user_sess,
+    )
+
+
+# Function to render an image on OMERO.web and store it in the tile cache
+def fetch_and_cache(cache_key, url, params, user_sess):
+    res = user_sess.get(url, params=params, verify=False)
+    if res.status_code != 200:
+        print("Failed to render image:", res.status_code)
+        return None
+    tile_cache.put(cache_key, res.content)
+    return res.content
+
+
+# Function to fetch an image's imgData (size, pyramid levels, render settings)
+def fetch_image_data(image_id, user_sess):
+    url = f"{my_omero_instance_url}/webgateway/imgData/{image_id}/"
+    res = user_sess.get(url, verify=False)
+    if res.status_code != 200:
+        print("Failed to get image data:", res.status_code)
+        return None, {}
+    return res.json(), {}
+
+
+# Function to get an image's imgData, cached for RENDER_SETTINGS_TTL seconds
+def image_data(image_id, user_sess):
+    # OMERO keeps render settings per user, so they are not shared in a group
+    user = user_sess.login_context.get("userId", user_sess.sid)
+    return image_data_cache.get_or_fetch(
+        (("user", user), "imgData", image_id),
+        lambda validators: fetch_image_data(image_id, user_sess),
+    )
+
+
+# Function to get the version of an image's render settings, or None
+def render_version(image_id, user_sess):
+    """
+    Returns a digest of the render settings OMERO applies to the image for
+    this user (channel windows and colors, model, projection, ...), which
+    changes whenever they are changed in OMERO.
+    """
+    data = image_data(image_id, user_sess)
+    if data is None:
+        return None
+    settings = {"channels": data.get("channels"), "rdefs": data.get("rdefs")}
+    digest = hashlib.sha1(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+# Function to get the grid of an image's tiles of width x height, or None
+def tile_grid(image_id, user_sess, width, height):
+    data = image_data(image_id, user_sess)
+    if data is None:
+        return None
+    size = data.get("size", {})
+    return TileGrid(
+        size.get("width", 0),
+        size.get("height", 0),
+        size.get("z", 1),
+        # Images without a pyramid only have level 0
+        data.get("levels") or 1,
+        width,
+        height,
+    )
+
+
+# Function to get the validator of a rendered response, without going upstream
+def render_validator(cache_key):
+    """
+    Returns the ETag of `cache_key` (image, plane, region, permission
+    context and the version of the image's render settings in OMERO), which
+    changes whenever the rendered bytes would. There is no Last-Modified: OMERO
+    does not say when the render settings changed.
+    """
+    return hashlib.sha1(cache_key.encode("utf-8")).hexdigest()
+
+
+# Function to redirect to this request's URL with a render settings version
+def versioned_redirect(version):
+    args = dict(request.args.to_dict(), v=version)
+    return redirect(url_for(request.endpoint, **request.view_args, **args))
+
+
+# Function to answer a conditional request with 304 if the client is up to date
+def not_modified(etag, cache_control):
+    if not request.if_none_match.contains(etag):
+        return None
+    return cacheable(Response(status=304), etag, cache_control)
+
+
+# Function to add a validator and a Cache-Control policy to a response
+def cacheable(response, etag, cache_control):
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = cache_control
+    return response
+
+
+# Function to get the version of a thumbnail: a digest of the thumbnail itself
+def thumbnail_version(data):
+    return hashlib.sha1(data).hexdigest()[:16]
+
+
+# Function to cache the thumbnails of many images in one upstream call
+def prefetch_thumbnails(user_sess, image_ids, size=THUMBNAIL_SIZE):
+    """
+    Fetches the thumbnails of `image_ids` with a single get_thumbnails call
+    and returns {image id: thumbnail version} for those OMERO returned. The
+    versions go into the thumbnail URLs, so they are the only thing needing
+    a round trip: no render settings are looked up per image.
+    """
+    if not image_ids:
+        return {}
+    scope = permission_context(user_sess)
+    # OMERO.web returns {image id: data URI} for every id= given
+    url = f"{my_omero_instance_url}/webgateway/get_thumbnails/{size}/"
+    res = user_sess.get(url, params={"id": list(image_ids)}, verify=False)
+    if res.status_code != 200:
+        print("Failed to get thumbnails:", res.status_code)
+        return {}
+    versions = {}
+    for image_id, data_uri in res.json().items():
+        if not data_uri:
+            continue
+        image_id = int(image_id)
+        data = base64.b64decode(data_uri.split(",", 1)[1])
+        version = thumbnail_version(data)
+        key = make_thumbnail_key(image_id, size, version, scope)
+        if not thumbnail_cache.contains(key):
+            thumbnail_cache.put(key, data)
+        versions[image_id] = version
+    return versions
+
+
+# Function to build the cache key, URL and parameters of a tile request
+def tile_request(
+    tile, render_params, width, height, version, user_sess, preview_quality=None
+):
+    image_id, z, t, x, y, level = tile
+    url = f"{my_omero_instance_url}/webgateway/render_image_region/{image_id}/{z}/{t}/"
+    params = dict(render_params, tile=f"{level},{x},{y},{width},{height}")
+    # The key carries the render settings version so a change is not served stale
+    key_params = dict(params, v=version)
+    if preview_quality is not None:
+        # One preview is cached per tile, whatever quality it was made at
+        params["q"] = preview_quality
+        key_params["preview"] = 1
+    # Cached tiles are only served within the permission context they were for
+    scope = permission_context(user_sess)
+    key = make_tile_key(image_id, z, t, x, y, level, key_params, scope)
+    return key, url, params
+
+
+# Function to get the preview of a tile, from its parent tile if that is cached
+def fetch_preview(tile, render_params, width, height, version, quality, user_sess):
+    cache_key, url, params = tile_request(
+        tile, render_params, width, height, version, user_sess, quality
+    )
+    data = tile_cache.get(cache_key)
+    if data is not None:
+        return data
+    # Level 0 is full resolution: the tile one level up covers this one (and
+    # its three siblings) at half the resolution
+    parent = tile._replace(x=tile.x // 2, y=tile.y // 2, level=tile.level + 1)
+    grid = tile_grid(tile.image_id, user_sess, width, height)
+    if grid is not None and grid.contains(parent):
+        for parent_quality in (None, quality):
+            parent_key, _, _ = tile_request(
+                parent, render_params, width, height, version, user_sess, parent_quality
+            )
+            parent_data = tile_cache.get(parent_key)
+            if parent_data is None:
+                continue
+            data = upscale_quadrant(
+                parent_data, tile.x % 2, tile.y % 2, width, height, quality
+            )
+            if data is not None:
+                tile_cache.put(cache_key, data)
+                return data
+    return fetch_upstream(cache_key, url, params, user_sess)
+
+
+# Function used by the prefetcher to warm one predicted tile into the cache
+def prefetch_tile(tile, context):
+    user_sess, render_params, width, height, version = context
+    # Tiles of settings changed since the viewer was opened are not wanted
+    if render_version(tile.image_id, user_sess) != version:
+        return 0
+    cache_key, url, params = tile_request(
+        tile, render_params, width, height, version, user_sess
+    )
+    if tile_cache.contains(cache_key):
+        return 0
+    data = fetch_upstream(cache_key, url, params, user_sess)
+    return len(data) if data else 0
+
+
+# Background prefetching of neighboring tiles, zoom levels and Z planes
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", 2))
+prefetcher = PrefetchScheduler(
+    prefetch_tile,
+    max_workers=PREFETCH_WORKERS,
+    max_bytes_per_second=int(os.getenv("PREFETCH_BYTES_PER_SECOND", 8 * 1024 * 1024)),
+)
+
+
+# Function to fetch one page of a listing, unless OMERO.web says it is unchanged
+def fetch_listing_page(kind, user_sess, offset, limit, validators):
+    url = my_omero_instance_url + f"/api/v0/m/{kind}/"
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    res = user_sess.get(
+        url,
+        params={"offset": offset, "limit": limit},
+        headers=headers,
+        verify=False,
+    )
+    if res.status_code == 304:
+        return None, validators
+    if res.status_code != 200:
+        print(f"Failed to list {kind}:", res.text)
+        return None, {}
+    validators = {
+        "etag": res.headers.get("ETag"),
+        "last_modified": res.headers.get("Last-Modified"),
+    }
+    return res.json(), validators
+
+
+# Function to get one page ({"data": [...], "meta": {...}}) of a listing, cached per user
+def list_page(kind, username, user_sess, offset=0, limit=LISTING_PAGE_SIZE):
+    print(f" > Listing {kind} {offset}-{offset + limit}")
+    page = metadata_cache.get_or_fetch(
+        (username, kind, offset, limit),
+        lambda validators: fetch_listing_page(
+            kind, user_sess, offset, limit, validators
+        ),
+    )
+    return page or {"data": [], "meta": {"offset": offset, "totalCount": 0}}
+
+
+# Function to list a page of projects
+def list_projects(user_sess, username, offset=0, limit=LISTING_PAGE_SIZE):
+    return list_page("projects", username, user_sess, offset, limit)
+
+
+# Function to list a page of datasets
+def list_datasets(user_sess, username, offset=0, limit=LISTING_PAGE_SIZE):
+    return list_page("datasets", username, user_sess, offset, limit)
+
+
+# Function to list a page of images
+def list_images(user_sess, username, offset=0, limit=THUMBNAILS_PER_PAGE):
+    return list_page("images", username, user_sess, offset, limit)
+
+
+# Function to get the offset of the page after `page`, or None at the end
+def next_offset(page):
+    meta = page.get("meta", {})
+    offset = meta.get("offset", 0) + len(page.get("data", []))
+    total = meta.get("totalCount")
+    more = page.get("data") and (total is None or offset < total)
+    return offset if more else None
+
+
+# Function to get a user's metadata index, syncing it if it is stale
+def user_index(username, user_sess):
+    with metadata_indexes_lock:
+        index = metadata_indexes.get(username)
+        if index is None:
+            os.makedirs(METADATA_INDEX_DIR, exist_ok=True)
+            name = hashlib.sha256(username.encode("utf-8")).hexdigest()[:32]
+            index = MetadataIndex(os.path.join(METADATA_INDEX_DIR, name + ".sqlite"))
+            metadata_indexes[username] = index
+    # Even the first sync runs in the background; /search waits for it
+    last_sync = index.last_sync()
+    stale = last_sync is None or time.time() - last_sync > METADATA_INDEX_SYNC_INTERVAL
+    if stale and not index.syncing():
+        submit_upstream(index.sync, user_sess, my_omero_instance_url)
+    return index
+
+
+@app.before_request
+def start_request_metrics():
+    g.start = time.perf_counter()
+    g.route = request.url_rule.rule if request.url_rule else "unmatched"
+    requests_in_flight.inc(g.route)
+    request_timings.set({})
+
+
+@app.after_request
+def record_request_metrics(response):
+    elapsed = time.perf_counter() - g.start
+    route_latency.observe(elapsed, g.route, str(response.status_code))
+    # Measuring a streamed body would buffer all of it before sending
+    if not response.is_streamed:
+        response_bytes.inc(g.route, amount=response.calculate_content_length() or 0)
+    if SERVER_TIMING:
+        timings = dict(request_timings.get() or {}, total=elapsed)
+        response.headers["Server-Timing"] = ", ".join(
+            f"{phase};dur={seconds * 1000:.1f}" for phase, seconds in timings.items()
+        )
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    if "route" in g:
+        requests_in_flight.dec(g.route)
+
+
+@app.errorhandler(requests.RequestException)
+def upstream_unavailable(e):
+    # Failing fast while OMERO.web is down keeps requests from piling up
+    if isinstance(e, CircuitOpenError):
+        response = Response("OMERO is unavailable, try again later", status=503)
+        response.headers["Retry-After"] = str(max(1, round(e.retry_after)))
+        return response
+    if isinstance(e, requests.Timeout):
+        return "OMERO did not answer in time", 504
+    return "Failed to reach OMERO", 502
+
+
+@app.errorhandler(SessionExpired)
+def session_expired(e):
+    # The pooled session was dropped while the request was being served
+    session.pop('sid', None)
+    return redirect(url_for('home'))
 
 
 @app.route('/')
@@ -75,103 +647,212 @@ def login():
     username = request.form['username']
     password = request.form['password']
 
-    sess = requests.session()
-
-    # Step 1: Get the server ID
-    url = my_omero_instance_url + "/api/v0/servers/"
-    server_request = sess.get(url, verify=False)
-    data = server_request.json()
-    id_server = int(data["data"][0]["id"])
-
-    # Step 2: Get the CSRF token
-    url = my_omero_instance_url + "/api/v0/token/"
-    res = sess.get(url, verify=False)
-    data = res.json()
-    token = data["data"]
-
-    # Step 3: Prepare login payload
-    url = my_omero_instance_url + "/api/v0/login/"
-    login_payload = {
-        "server": id_server,
-        "username": username,
-        "password": password,
-        "csrfmiddlewaretoken": token,
-    }
+    sid = session_registry.create(username, password)
+    if sid is None:
+        return "Login failed", 400
+    session['sid'] = sid
+    session['username'] = username
+    metadata_cache.invalidate(username)
+    return redirect(url_for('dashboard'))
+
 
-    # Step 4: Set headers including Referer
-    headers = {
-        "referer": my_omero_instance_url,
-        "X-CSRFToken": token,
+# Function to describe an image for the dashboard and /listing
+def image_entry(image, thumbnails):
+    image_id = image['@id']
+    return {
+        "id": image_id,
+        "name": image.get('Name'),
+        "render": url_for('render_image', image_id=image_id),
+        # Without a version, /thumbnail looks the thumbnail up and redirects
+        "thumbnail": url_for(
+            'thumbnail',
+            image_id=image_id,
+            size=THUMBNAIL_SIZE,
+            v=thumbnails.get(image_id),
+        ),
     }
 
-    # Step 5: Attempt to log in
-    res_log = sess.post(url, data=login_payload, headers=headers, verify=False)
 
-    # Step 6: Check if login was successful
-    if res_log.status_code == 200 and res_log.json().get("success"):
-        session['authenticated'] = True
-        session['sess_cookies'] = sess.cookies.get_dict()  # Save cookies
-        return redirect(url_for('dashboard'))
-    else:
-        return "Login failed", 400
+# Function to wait for a page of images and describe them, thumbnails cached
+def image_entries(user_sess, page):
+    images = page.get("data", [])
+    thumbnails = prefetch_thumbnails(user_sess, [image['@id'] for image in images])
+    return [image_entry(image, thumbnails) for image in images]
 
 
 @app.route('/dashboard')
 def dashboard():
-    if not session.get('authenticated'):
+    user_sess = current_session()
+    if user_sess is None:
         return redirect(url_for('home'))
 
-    sess_cookies = session.get('sess_cookies')
-    projects = list_projects(sess_cookies)
-    datasets = list_datasets(sess_cookies)
-    images = list_images(sess_cookies)
-    return render_template_string(
-        '''
-        <h1>Projects, Datasets, and Images</h1>
-        <h2>Projects</h2>
-        <ul>
-            {% for project in projects %}
-                <li>Project ID: {{ project['@id'] }}, Name: {{ project['Name'] }}</li>
-            {% else %}
-                <li>No projects found.</li>
-            {% endfor %}
-        </ul>
-        <h2>Datasets</h2>
-        <ul>
-            {% for dataset in datasets %}
-                <li>Dataset ID: {{ dataset['@id'] }}, Name: {{ dataset['Name'] }}</li>
-            {% else %}
-                <li>No datasets found.</li>
-            {% endfor %}
-        </ul>
-        <h2>Images</h2>
-        <ul>
-            {% for image in images %}
-                <li>Image ID: {{ image['@id'] }}, Name: {{ image['Name'] }}</li>
-            {% else %}
-                <li>No images found.</li>
-            {% endfor %}
-        </ul>
-        <h2>Enter Image ID</h2>
-        <form action="/redirect_image" method="post">
-            <label for="image_id">Image ID:</label>
-            <input type="text" id="image_id" name="image_id" required>
-            <input type="submit" value="View Image">
-        </form>
-        ''',
-        projects=projects,
-        datasets=datasets,
-        images=images,
+    username = session.get('username')
+    page = max(1, request.args.get('page', 1, type=int))
+    # Only one page of each listing is fetched, all three concurrently; the
+    # response is streamed so the header goes out before any of them is back
+    projects = submit_upstream(list_projects, user_sess, username)
+    datasets = submit_upstream(list_datasets, user_sess, username)
+    images = submit_upstream(
+        list_images,
+        user_sess,
+        username,
+        (page - 1) * THUMBNAILS_PER_PAGE,
+    )
+
+    # Each section is rendered whole once its data is in, and sent right away
+    def generate():
+        yield render_template_string('''
+            <h1>Projects, Datasets, and Images</h1>
+            <h2>Enter Image ID</h2>
+            <form action="/redirect_image" method="post">
+                <label for="image_id">Image ID:</label>
+                <input type="text" id="image_id" name="image_id" required>
+                <input type="submit" value="View Image">
+            </form>
+            ''')
+        for kind, label, future in (
+            ("projects", "Project", projects),
+            ("datasets", "Dataset", datasets),
+        ):
+            listing = future.result()
+            yield render_template_string(
+                '''
+                <h2>{{ label }}s</h2>
+                <ul id="{{ kind }}">
+                    {% for obj in listing['data'] %}
+                        <li>{{ label }} ID: {{ obj['@id'] }}, Name: {{ obj['Name'] }}</li>
+                    {% else %}
+                        <li>No {{ kind }} found.</li>
+                    {% endfor %}
+                </ul>
+                <div class="more" data-kind="{{ kind }}" data-next="{{ next if next is not none else '' }}"></div>
+                ''',
+                kind=kind,
+                label=label,
+                listing=listing,
+                next=next_offset(listing),
+            )
+
+        listing = images.result()
+        entries = image_entries(user_sess, listing)
+        total = listing.get('meta', {}).get('totalCount') or 0
+        yield render_template_string(
+            '''
+            <h2>Images</h2>
+            <div id="images" style="display: flex; flex-wrap: wrap; gap: 8px;">
+                {% for entry in entries %}
+                    <figure style="width: {{ size }}px; margin: 0;">
+                        <a href="{{ entry.render }}" target="_blank">
+                            <img src="{{ entry.thumbnail }}"
+                                 width="{{ size }}" height="{{ size }}" loading="lazy"
+                                 alt="{{ entry.name }}">
+                        </a>
+                        <figcaption style="font-size: small; overflow-wrap: anywhere;">
+                            {{ entry.id }}: {{ entry.name }}
+                        </figcaption>
+                    </figure>
+                {% else %}
+                    <p>No images found.</p>
+                {% endfor %}
+            </div>
+            <div class="more" data-kind="images" data-next="{{ next if next is not none else '' }}"></div>
+            {% if pages > 1 %}
+                <p id="pager">
+                    {% if page > 1 %}<a href="{{ url_for('dashboard', page=page - 1) }}">Previous</a>{% endif %}
+                    Page {{ page }} of {{ pages }}
+                    {% if page < pages %}<a href="{{ url_for('dashboard', page=page + 1) }}">Next</a>{% endif %}
+                </p>
+            {% endif %}
+            <script>
+                // Infinite scroll: load the next page of a listing when its end is in view
+                const size = {{ size }};
+                function append(kind, item) {
+                    const list = document.getElementById(kind);
+                    if (kind !== "images") {
+                        const li = document.createElement("li");
+                        li.textContent = `${kind === "projects" ? "Project" : "Dataset"} ID: ${item.id}, Name: ${item.name}`;
+                        list.appendChild(li);
+                        return;
+                    }
+                    const figure = document.createElement("figure");
+                    figure.style.cssText = `width: ${size}px; margin: 0;`;
+                    const link = document.createElement("a");
+                    link.href = item.render;
+                    link.target = "_blank";
+                    const img = document.createElement("img");
+                    img.src = item.thumbnail;
+                    img.width = img.height = size;
+                    img.loading = "lazy";
+                    img.alt = item.name;
+                    const caption = document.createElement("figcaption");
+                    caption.style.cssText = "font-size: small; overflow-wrap: anywhere;";
+                    caption.textContent = `${item.id}: ${item.name}`;
+                    link.appendChild(img);
+                    figure.append(link, caption);
+                    list.appendChild(figure);
+                }
+                const observer = new IntersectionObserver(entries => {
+                    for (const entry of entries) {
+                        const more = entry.target;
+                        if (!entry.isIntersecting || !more.dataset.next || more.dataset.loading) continue;
+                        more.dataset.loading = "1";
+                        fetch(`/listing/${more.dataset.kind}?offset=${more.dataset.next}`)
+                            .then(res => res.json())
+                            .then(page => {
+                                page.data.forEach(item => append(more.dataset.kind, item));
+                                more.dataset.next = page.next_offset ?? "";
+                            })
+                            .finally(() => { delete more.dataset.loading; });
+                    }
+                }, {rootMargin: "400px"});
+                document.querySelectorAll(".more").forEach(more => observer.observe(more));
+                // Pages now load as the list scrolls, so the pager would only go stale
+                document.getElementById("pager")?.remove();
+            </script>
+            ''',
+            entries=entries,
+            next=next_offset(listing),
+            page=page,
+            pages=max(1, -(-total // THUMBNAILS_PER_PAGE)),
+            size=THUMBNAIL_SIZE,
+        )
+
+    return Response(stream_with_context(generate()), mimetype="text/html")
+
+
+@app.route('/listing/<kind>')
+def listing(kind):
+    user_sess = current_session()
+    if user_sess is None:
+        return jsonify({"error": "Not logged in"}), 401
+    if kind not in ("projects", "datasets", "images"):
+        return jsonify({"error": f"Unknown kind {kind!r}"}), 404
+    offset = max(0, request.args.get('offset', 0, type=int))
+    default_limit = THUMBNAILS_PER_PAGE if kind == "images" else LISTING_PAGE_SIZE
+    limit = min(max(1, request.args.get('limit', default_limit, type=int)), 500)
+    page = list_page(kind, session.get('username'), user_sess, offset, limit)
+    if kind == "images":
+        data = image_entries(user_sess, page)
+    else:
+        data = [{"id": obj['@id'], "name": obj.get('Name')} for obj in page["data"]]
+    return jsonify(
+        {
+            "data": data,
+            "offset": offset,
+            "limit": limit,
+            "total": page.get("meta", {}).get("totalCount"),
+            "next_offset": next_offset(page),
+        }
     )
 
 
 @app.route('/redirect_image', methods=['POST'])
 def redirect_image():
-    if not session.get('authenticated'):
+    if current_session() is None:
         return redirect(url_for('home'))
 
     image_id = request.form['image_id']
-    redirect_url = f"{my_omero_instance_url}/webgateway/render_image/{image_id}/"
+    redirect_url = url_for('render_image', image_id=image_id)
 
     return render_template_string(
         '''
@@ -191,5 +872,326 @@ def redirect_image():
     )
 
 
+@app.route('/render/<int:image_id>')
+def render_image(image_id):
+    user_sess = current_session()
+    if user_sess is None:
+        return redirect(url_for('home'))
+
+    # Any other query arguments are passed through as OMERO render settings;
+    # v is the version of the settings, so an up to date client is answered
+    # without asking OMERO
+    render_params = request.args.to_dict()
+    version = render_params.pop('v', None)
+    cache_key = make_image_key(
+        image_id, dict(render_params, v=version), permission_context(user_sess)
+    )
+    etag = render_validator(cache_key)
+    if version is not None:
+        response = not_modified(etag, RENDER_CACHE_CONTROL)
+        if response is not None:
+            return response
+    if version is None or not tile_cache.contains(cache_key):
+        # Not rendered yet: make sure the URL has the current version
+        current = render_version(image_id, user_sess)
+        if current is None:
+            return "Failed to get render settings", 502
+        if current != version:
+            return versioned_redirect(current)
+    url = f"{my_omero_instance_url}/webgateway/render_image/{image_id}/"
+    data = fetch_rendered(cache_key, url, render_params, user_sess)
+    if data is None:
+        return "Failed to render image", 502
+    return cacheable(Response(data, mimetype="image/jpeg"), etag, RENDER_CACHE_CONTROL)
+
+
+@app.route('/tile/<int:image_id>/<int:z>/<int:t>/<int:x>/<int:y>/<int:level>')
+def render_tile(image_id, z, t, x, y, level):
+    user_sess = current_session()
+    if user_sess is None:
+        return redirect(url_for('home'))
+
+    render_params = request.args.to_dict()
+    # The render settings version, as in /render
+    version = render_params.pop('v', None)
+    width = int(render_params.pop('w', 512))
+    height = int(render_params.pop('h', 512))
+    # quality=preview asks for a quick preview; moving=1 while the viewport pans
+    preview = render_params.pop('quality', 'full') == 'preview'
+    moving = render_params.pop('moving', '0') == '1'
+    viewer = session['sid']
+    tile = TilePosition(image_id, z, t, x, y, level)
+    if version is None:
+        current = render_version(image_id, user_sess)
+        if current is None:
+            return "Failed to get render settings", 502
+        return versioned_redirect(current)
+    cache_key, url, params = tile_request(
+        tile, render_params, width, height, version, user_sess
+    )
+    cached = tile_cache.contains(cache_key)
+    # A cached full tile is as quick as a preview, and a fast link gets it directly
+    preview = preview and not cached and adaptive_quality.wants_preview(viewer, moving)
+    if preview:
+        quality = adaptive_quality.preview_quality(viewer, moving)
+        cache_key = tile_request(
+            tile, render_params, width, height, version, user_sess, quality
+        )[0]
+    etag = render_validator(cache_key)
+    response = not_modified(etag, TILE_CACHE_CONTROL)
+    if response is not None:
+        response.headers["X-Tile-Quality"] = "preview" if preview else "full"
+        return response
+    if not cached:
+        # Not rendered yet: make sure the URL has the current version
+        current = render_version(image_id, user_sess)
+        if current is None:
+            return "Failed to get render settings", 502
+        if current != version:
+            return versioned_redirect(current)
+    prefetcher.foreground_started()
+    try:
+        if preview:
+            data = fetch_preview(
+                tile, render_params, width, height, version, quality, user_sess
+            )
+        else:
+            start = time.perf_counter()
+            data = fetch_rendered(cache_key, url, params, user_sess)
+            if not cached and data is not None:
+                adaptive_quality.observe(viewer, time.perf_counter() - start)
+    finally:
+        prefetcher.foreground_finished()
+    if PREFETCH_WORKERS:
+        prefetcher.record(
+            session['sid'],
+            tile,
+            (user_sess, render_params, width, height, version),
+            tile_grid(image_id, user_sess, width, height),
+        )
+    if data is None:
+        return "Failed to render tile", 502
+    response = cacheable(
+        Response(data, mimetype="image/jpeg"), etag, TILE_CACHE_CONTROL
+    )
+    response.headers["X-Tile-Quality"] = "preview" if preview else "full"
+    return response
+
+
+@app.route('/viewer/<int:image_id>')
+def viewer(image_id):
+    user_sess = current_session()
+    if user_sess is None:
+        return redirect(url_for('home'))
+
+    # level follows OMERO's tile levels (0 is full resolution); other
+    # arguments are render settings
+    render_params = request.args.to_dict()
+    z = int(render_params.pop('z', 0))
+    t = int(render_params.pop('t', 0))
+    level = int(render_params.pop('level', 0))
+    tile_size = int(render_params.pop('tile_size', 512))
+    # imgData is cached and shared with the tile requests the viewer makes next
+    data = image_data(image_id, user_sess)
+    if data is None:
+        return "Failed to get image data", 502
+    size = data.get("size", {})
+    # Tile URLs carry the render settings version, see /render
+    render_params["v"] = render_version(image_id, user_sess)
+    scale = 2**level
+    return render_template_string(
+        '''
+        <style>
+            #viewport { position: relative; width: 100%; height: 90vh; overflow: hidden;
+                        background: #222; cursor: grab; touch-action: none; }
+            #plane { position: absolute; left: 0; top: 0; }
+            #plane img { position: absolute; }
+        </style>
+        <div id="viewport"><div id="plane"></div></div>
+        <script>
+            const width = {{ width }}, height = {{ height }}, size = {{ tile_size }};
+            const base = "/tile/{{ image_id }}/{{ z }}/{{ t }}/";
+            const query = {{ query|tojson }};
+            const viewport = document.getElementById("viewport");
+            const plane = document.getElementById("plane");
+            const tiles = new Map();  // "x,y" -> {img, quality}
+            let left = 0, top = 0, moving = false, idle = null;
+
+            function tileUrl(x, y, preview) {
+                let url = `${base}${x}/${y}/{{ level }}?w=${size}&h=${size}&${query}`;
+                if (preview) url += `&quality=preview&moving=${moving ? 1 : 0}`;
+                return url;
+            }
+            // Fetches a tile and shows it, unless a better version is already shown
+            function fetchTile(x, y, tile, preview) {
+                return fetch(tileUrl(x, y, preview)).then(res => {
+                    if (!res.ok) throw new Error(res.status);
+                    const quality = res.headers.get("X-Tile-Quality") || "full";
+                    return res.blob().then(blob => {
+                        if (tile.quality === "full") return;
+                        URL.revokeObjectURL(tile.img.src);
+                        tile.img.src = URL.createObjectURL(blob);
+                        tile.quality = quality;
+                    });
+                });
+            }
+            function upgrade(x, y, tile) {
+                if (tile.quality !== "preview" || tile.upgrading) return;
+                tile.upgrading = true;
+                fetchTile(x, y, tile, false).finally(() => { tile.upgrading = false; });
+            }
+            // Shows every tile in view: a preview first, the full tile once still
+            function update() {
+                plane.style.transform = `translate(${-left}px, ${-top}px)`;
+                const x0 = Math.max(0, Math.floor(left / size));
+                const y0 = Math.max(0, Math.floor(top / size));
+                const x1 = Math.min(Math.ceil(width / size), Math.ceil((left + viewport.clientWidth) / size));
+                const y1 = Math.min(Math.ceil(height / size), Math.ceil((top + viewport.clientHeight) / size));
+                for (let y = y0; y < y1; y++) {
+                    for (let x = x0; x < x1; x++) {
+                        let tile = tiles.get(`${x},${y}`);
+                        if (!tile) {
+                            const img = document.createElement("img");
+                            img.style.left = `${x * size}px`;
+                            img.style.top = `${y * size}px`;
+                            img.style.width = `${Math.min(size, width - x * size)}px`;
+                            img.style.height = `${Math.min(size, height - y * size)}px`;
+                            plane.appendChild(img);
+                            tile = {img, quality: null};
+                            tiles.set(`${x},${y}`, tile);
+                            fetchTile(x, y, tile, true).then(() => { if (!moving) upgrade(x, y, tile); });
+                        } else if (!moving) {
+                            upgrade(x, y, tile);
+                        }
+                    }
+                }
+            }
+            viewport.addEventListener("pointerdown", down => {
+                viewport.setPointerCapture(down.pointerId);
+                let lastX = down.clientX, lastY = down.clientY;
+                const move = e => {
+                    left = Math.max(0, Math.min(width - viewport.clientWidth, left - (e.clientX - lastX)));
+                    top = Math.max(0, Math.min(height - viewport.clientHeight, top - (e.clientY - lastY)));
+                    lastX = e.clientX;
+                    lastY = e.clientY;
+                    moving = true;
+                    clearTimeout(idle);
+                    // The viewport counts as still 150ms after the last move
+                    idle = setTimeout(() => { moving = false; update(); }, 150);
+                    update();
+                };
+                viewport.addEventListener("pointermove", move);
+                viewport.addEventListener("pointerup", () => viewport.removeEventListener("pointermove", move), {once: true});
+            });
+            window.addEventListener("resize", update);
+            update();
+        </script>
+        ''',
+        image_id=image_id,
+        z=z,
+        t=t,
+        level=level,
+        tile_size=tile_size,
+        width=math.ceil(size.get("width", 0) / scale),
+        height=math.ceil(size.get("height", 0) / scale),
+        query=urlencode(render_params),
+    )
+
+
+@app.route('/thumbnail/<int:image_id>')
+def thumbnail(image_id):
+    user_sess = current_session()
+    if user_sess is None:
+        return redirect(url_for('home'))
+
+    size = request.args.get('size', THUMBNAIL_SIZE, type=int)
+    version = request.args.get('v')
+    if version is not None:
+        # The version is a digest of the thumbnail, checked without OMERO
+        key = make_thumbnail_key(image_id, size, version, permission_context(user_sess))
+        etag = render_validator(key)
+        response = not_modified(etag, THUMBNAIL_CACHE_CONTROL)
+        if response is not None:
+            return response
+        data = thumbnail_cache.get(key)
+        if data is not None:
+            return cacheable(
+                Response(data, mimetype="image/jpeg"), etag, THUMBNAIL_CACHE_CONTROL
+            )
+    # Unversioned, evicted or outdated: fetch the current one and redirect to it
+    current = prefetch_thumbnails(user_sess, [image_id], size).get(image_id)
+    if current is None:
+        return "Failed to get thumbnail", 502
+    if current != version:
+        return redirect(url_for('thumbnail', image_id=image_id, size=size, v=current))
+    key = make_thumbnail_key(image_id, size, current, permission_context(user_sess))
+    data = thumbnail_cache.get(key)
+    if data is None:
+        return "Failed to get thumbnail", 502
+    etag = render_validator(key)
+    return cacheable(
+        Response(data, mimetype="image/jpeg"), etag, THUMBNAIL_CACHE_CONTROL
+    )
+
+
+@app.route('/search')
+def search():
+    user_sess = current_session()
+    if user_sess is None:
+        return redirect(url_for('home'))
+    index = user_index(session['username'], user_sess)
+    if index.last_sync() is None:
+        # A partly written index would give incomplete results
+        response = jsonify({"status": "syncing"})
+        response.status_code = 503
+        response.headers["Retry-After"] = "5"
+        return response
+    try:
+        images = index.search_images(
+            name=request.args.get('name'),
+            min_size_x=request.args.get('min_width', type=int),
+            max_size_x=request.args.get('max_width', type=int),
+            min_size_y=request.args.get('min_height', type=int),
+            max_size_y=request.args.get('max_height', type=int),
+            acquired_after=request.args.get('acquired_after'),
+            acquired_before=request.args.get('acquired_before'),
+            project_id=request.args.get('project', type=int),
+            dataset_id=request.args.get('dataset', type=int),
+            limit=min(request.args.get('limit', 100, type=int), 1000),
+            offset=request.args.get('offset', 0, type=int),
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"images": images, "last_sync": index.last_sync()})
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    tile_stats = tile_cache.stats()
+    tile_hits = tile_stats["memory_hits"] + tile_stats["disk_hits"]
+    tile_lookups = tile_hits + tile_stats["misses"]
+    cache_hit_ratio.set(tile_hits / tile_lookups if tile_lookups else 0, "tile")
+    metadata_lookups = metadata_cache.hits + metadata_cache.misses
+    cache_hit_ratio.set(
+        metadata_cache.hits / metadata_lookups if metadata_lookups else 0, "metadata"
+    )
+    active_sessions.set(session_registry.stats()["sessions"])
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/cache_stats')
+def cache_stats():
+    return jsonify(
+        dict(
+            tile_cache.stats(),
+            sessions=session_registry.stats(),
+            prefetch=prefetcher.stats(),
+            coalescing=upstream_flights.stats(),
+            progressive=adaptive_quality.stats(),
+            resilience=upstream_resilience.stats(),
+        )
+    )
+
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+
+from singleflight import SingleFlight
+
+
+class MetadataCache:
+    """
+    Short-lived cache for upstream metadata (project/dataset/image lists).
+    Entries are fresh for `ttl` seconds; after that they are revalidated
+    with the validators (ETag/Last-Modified) saved from the last response.
+    Concurrent misses for one key wait for a single fetch. At most
+    `max_entries` are kept, least recently used first out, and expired
+    entries are swept out as new ones are stored.
+    """
+
+    def __init__(self, ttl=30, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._next_sweep = 0.0
+        self._lock = threading.Lock()
+        self._flights = SingleFlight()
+
+    def get_or_fetch(self, key, fetch):
+        """
+        Returns the cached value for `key`, calling `fetch(validators)` when
+        it is missing or stale. `fetch` returns `(value, validators)`, with
+        `value` None when the server says nothing changed (or the fetch
+        failed), in which case the previous value is kept.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            fresh = entry is not None and time.monotonic() < entry["expires"]
+            if fresh:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if fresh:
+            return entry["value"]
+
+        # Concurrent misses for the same key share one upstream fetch
+        return self._flights.do(key, self._refresh, key, entry, fetch)
+
+    def _refresh(self, key, entry, fetch):
+        value, validators = fetch(entry["validators"] if entry else {})
+        if value is None:
+            if entry is None:
+                return None
+            value = entry["value"]
+        now = time.monotonic()
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = {
+                "value": value,
+                "validators": validators,
+                "expires": now + self.ttl,
+            }
+            self._evict(now)
+        return value
+
+    def _evict(self, now):
+        # Caller holds the lock; a full sweep at most once per ttl
+        if now >= self._next_sweep:
+            for key in [k for k, e in self._entries.items() if e["expires"] <= now]:
+                del self._entries[key]
+            self._next_sweep = now + self.ttl
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user):
+        # Keys are tuples starting with the user
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == user]:
+                del self._entries[key]
@@ -0,0 +1,375 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from paging import ListingError, iter_objects
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS projects (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    description TEXT,
+    fingerprint TEXT
+);
+CREATE TABLE IF NOT EXISTS datasets (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    description TEXT,
+    fingerprint TEXT
+);
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    acquisition_date INTEGER,
+    pixels_type TEXT,
+    size_x INTEGER,
+    size_y INTEGER,
+    size_z INTEGER,
+    size_c INTEGER,
+    size_t INTEGER,
+    fingerprint TEXT
+);
+CREATE TABLE IF NOT EXISTS channels (
+    image_id INTEGER REFERENCES images(id) ON DELETE CASCADE,
+    channel_index INTEGER,
+    name TEXT,
+    emission_wavelength REAL,
+    excitation_wavelength REAL,
+    PRIMARY KEY (image_id, channel_index)
+);
+CREATE TABLE IF NOT EXISTS project_datasets (
+    project_id INTEGER REFERENCES projects(id) ON DELETE CASCADE,
+    dataset_id INTEGER,
+    PRIMARY KEY (project_id, dataset_id)
+);
+CREATE TABLE IF NOT EXISTS dataset_images (
+    dataset_id INTEGER REFERENCES datasets(id) ON DELETE CASCADE,
+    image_id INTEGER,
+    PRIMARY KEY (dataset_id, image_id)
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS images_name ON images(name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS images_acquisition_date ON images(acquisition_date);
+CREATE INDEX IF NOT EXISTS images_size ON images(size_x, size_y);
+CREATE INDEX IF NOT EXISTS project_datasets_dataset ON project_datasets(dataset_id);
+CREATE INDEX IF NOT EXISTS dataset_images_image ON dataset_images(image_id);
+"""
+
+
+# Function to turn a date into UTC milliseconds since the epoch, or None
+def epoch_ms(value):
+    """
+    Accepts milliseconds since the epoch (as the JSON API reports dates, also
+    as a string of digits) or an ISO 8601 date; one without a UTC offset is
+    taken to be in UTC, whatever the local time zone. Raises ValueError for
+    anything else.
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if value.isdigit():
+        return int(value)
+    date = datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(date.timestamp() * 1000)
+
+
+# Function to fingerprint a listed object, to tell whether it changed
+def fingerprint(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class MetadataIndex:
+    """
+    Local SQLite index of projects, datasets, images (dimensions, pixel
+    type, acquisition date), channels and their links, for filtering
+    without crawling the JSON API.
+
+    sync() pages through the listings and compares a fingerprint of every
+    listed object with the stored one. Only new or changed objects are
+    written, only changed projects and datasets have their children
+    listed again, and only new or changed images are fetched one by one
+    for their channels. Objects no longer listed are removed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA foreign_keys=ON")
+            self._db.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def syncing(self):
+        """Returns whether a sync is running."""
+        return self._sync_lock.locked()
+
+    def last_sync(self):
+        """Returns the time.time() of the last completed sync, or None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM sync_state WHERE key = 'last_sync'"
+            ).fetchone()
+        return row["value"] if row else None
+
+    def _fingerprints(self, table):
+        with self._lock:
+            rows = self._db.execute(f"SELECT id, fingerprint FROM {table}").fetchall()
+        return {row["id"]: row["fingerprint"] for row in rows}
+
+    def _list(self, sess, url, **request_kwargs):
+        """
+        Returns (objects, complete) for a listing. When a page fails, the
+        objects fetched so far are returned with `complete` false.
+        """
+        objects = []
+        try:
+            for obj in iter_objects(sess, url, prefetch=True, **request_kwargs):
+                objects.append(obj)
+        except ListingError as e:
+            print(e)
+            return objects, False
+        return objects, True
+
+    def _changed(self, table, objects, complete=True):
+        """
+        Returns the objects that are new or changed, and the ids that are
+        gone. Nothing is gone unless the listing of `objects` is complete.
+        """
+        known = self._fingerprints(table)
+        changed = [obj for obj in objects if known.get(obj["@id"]) != fingerprint(obj)]
+        gone = set()
+        if complete:
+            gone = set(known) - {obj["@id"] for obj in objects}
+        return changed, gone
+
+    def _delete(self, table, ids):
+        if ids:
+            self._db.executemany(
+                f"DELETE FROM {table} WHERE id = ?", [(i,) for i in ids]
+            )
+
+    def _replace_links(self, table, parent_column, child_column, parent_id, child_ids):
+        self._db.execute(f"DELETE FROM {table} WHERE {parent_column} = ?", (parent_id,))
+        self._db.executemany(
+            f"INSERT INTO {table} ({parent_column}, {child_column}) VALUES (?, ?)",
+            [(parent_id, child_id) for child_id in child_ids],
+        )
+
+    def _sync_containers(self, sess, base_url, kind, child_kind, link_table):
+        url = f"{base_url}/api/v0/m/{kind}/"
+        objects, complete = self._list(sess, url, params={"childCount": "true"})
+        changed, gone = self._changed(kind, objects, complete)
+        children = {}
+        for obj in changed:
+            child_objects, child_complete = self._list(
+                sess, f"{url}{obj['@id']}/{child_kind}/"
+            )
+            # Links are only replaced from a complete listing; the object is
+            # left as it was, to be synced again next time
+            if child_complete:
+                children[obj["@id"]] = [child["@id"] for child in child_objects]
+        changed = [obj for obj in changed if obj["@id"] in children]
+        parent_column, child_column = f"{kind[:-1]}_id", f"{child_kind[:-1]}_id"
+        with self._lock, self._db:
+            self._delete(kind, gone)
+            for obj in changed:
+                self._db.execute(
+                    f"INSERT OR REPLACE INTO {kind} (id, name, description, fingerprint)"
+                    " VALUES (?, ?, ?, ?)",
+                    (
+                        obj["@id"],
+                        obj.get("Name"),
+                        obj.get("Description"),
+                        fingerprint(obj),
+                    ),
+                )
+                self._replace_links(
+                    link_table,
+                    parent_column,
+                    child_column,
+                    obj["@id"],
+                    children[obj["@id"]],
+                )
+        return {
+            "changed": len(changed),
+            "removed": len(gone),
+            "total": len(objects),
+            "complete": complete,
+        }
+
+    def _sync_images(self, sess, base_url, detail_workers):
+        url = f"{base_url}/api/v0/m/images/"
+        objects, complete = self._list(sess, url)
+        changed, gone = self._changed("images", objects, complete)
+
+        def details(obj):
+            res = sess.get(f"{url}{obj['@id']}/", verify=False)
+            if res.status_code != 200:
+                print(f"Failed to get image {obj['@id']}:", res.status_code)
+                return obj, {}
+            return obj, res.json().get("data", {})
+
+        with ThreadPoolExecutor(max_workers=detail_workers) as executor:
+            fetched = list(executor.map(details, changed))
+
+        with self._lock, self._db:
+            self._delete("images", gone)
+            for obj, detail in fetched:
+                pixels = detail.get("Pixels") or obj.get("Pixels") or {}
+                pixels_type = pixels.get("Type")
+                if isinstance(pixels_type, dict):
+                    pixels_type = pixels_type.get("value")
+                self._db.execute(
+                    "INSERT OR REPLACE INTO images (id, name, acquisition_date,"
+                    " pixels_type, size_x, size_y, size_z, size_c, size_t, fingerprint)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        obj["@id"],
+                        obj.get("Name"),
+                        epoch_ms(obj.get("AcquisitionDate")),
+                        pixels_type,
+                        pixels.get("SizeX"),
+                        pixels.get("SizeY"),
+                        pixels.get("SizeZ"),
+                        pixels.get("SizeC"),
+                        pixels.get("SizeT"),
+                        # Failed detail fetches are retried on the next sync
+                        fingerprint(obj) if detail else None,
+                    ),
+                )
+                self._db.execute(
+                    "DELETE FROM channels WHERE image_id = ?", (obj["@id"],)
+                )
+                self._db.executemany(
+                    "INSERT INTO channels (image_id, channel_index, name,"
+                    " emission_wavelength, excitation_wavelength)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (
+                            obj["@id"],
+                            index,
+                            channel.get("Name"),
+                            (channel.get("EmissionWavelength") or {}).get("Value"),
+                            (channel.get("ExcitationWavelength") or {}).get("Value"),
+                        )
+                        for index, channel in enumerate(pixels.get("Channels", []))
+                    ],
+                )
+        return {
+            "changed": len(changed),
+            "removed": len(gone),
+            "total": len(objects),
+            "complete": complete,
+        }
+
+    def sync(self, sess, base_url, detail_workers=8):
+        """
+        Brings the index up to date with OMERO.web through `sess` (anything
+        with a requests-style get()). Returns per-kind counts of changed,
+        removed and total objects and whether the listing was complete
+        (nothing is removed after an incomplete one), or None if a sync is
+        already running.
+        """
+        if not self._sync_lock.acquire(blocking=False):
+            return None
+        try:
+            start = time.perf_counter()
+            stats = {
+                "projects": self._sync_containers(
+                    sess, base_url, "projects", "datasets", "project_datasets"
+                ),
+                "datasets": self._sync_containers(
+                    sess, base_url, "datasets", "images", "dataset_images"
+                ),
+                "images": self._sync_images(sess, base_url, detail_workers),
+            }
+            with self._lock, self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO sync_state (key, value)"
+                    " VALUES ('last_sync', ?)",
+                    (time.time(),),
+                )
+            stats["seconds"] = time.perf_counter() - start
+            return stats
+        finally:
+            self._sync_lock.release()
+
+    def search_images(
+        self,
+        name=None,
+        min_size_x=None,
+        max_size_x=None,
+        min_size_y=None,
+        max_size_y=None,
+        acquired_after=None,
+        acquired_before=None,
+        project_id=None,
+        dataset_id=None,
+        limit=100,
+        offset=0,
+    ):
+        """
+        Returns matching images as dicts, by id. `name` matches a
+        case-insensitive substring; acquisition dates are anything epoch_ms()
+        accepts, and are compared in UTC.
+        """
+        acquired_after = epoch_ms(acquired_after)
+        acquired_before = epoch_ms(acquired_before)
+        where, args = [], []
+        if name:
+            where.append("images.name LIKE ? COLLATE NOCASE")
+            args.append(f"%{name}%")
+        for column, op, value in (
+            ("size_x", ">=", min_size_x),
+            ("size_x", "<=", max_size_x),
+            ("size_y", ">=", min_size_y),
+            ("size_y", "<=", max_size_y),
+            ("acquisition_date", ">=", acquired_after),
+            ("acquisition_date", "<=", acquired_before),
+        ):
+            if value is not None:
+                where.append(f"images.{column} {op} ?")
+                args.append(value)
+        if dataset_id is not None:
+            where.append(
+                "images.id IN (SELECT image_id FROM dataset_images WHERE dataset_id = ?)"
+            )
+            args.append(dataset_id)
+        if project_id is not None:
+            where.append(
+                "images.id IN (SELECT image_id FROM dataset_images"
+                " JOIN project_datasets USING (dataset_id) WHERE project_id = ?)"
+            )
+            args.append(project_id)
+        query = "SELECT * FROM images"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY id LIMIT ? OFFSET ?"
+        with self._lock:
+            rows = self._db.execute(query, args + [limit, offset]).fetchall()
+        return [dict(row) for row in rows]
+
+    def channels(self, image_id):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM channels WHERE image_id = ? ORDER BY channel_index",
+                (image_id,),
+            ).fetchall()
+        return [dict(row) for row in rows]
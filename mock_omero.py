@@ -0,0 +1,357 @@
+import base64
+import json
+import random
+import re
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from PIL import Image
+
+
+# Function to build a synthetic JPEG to serve as a rendered tile
+def make_tile(width=512, height=512, quality=90):
+    # A gradient compresses like a real tile, unlike a flat color or noise
+    gradient = Image.linear_gradient("L").resize((width, height))
+    buf = BytesIO()
+    Image.merge("RGB", (gradient, gradient.rotate(90), gradient)).save(
+        buf, format="JPEG", quality=quality
+    )
+    return buf.getvalue()
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops connections when many clients connect at once
+    request_queue_size = 256
+
+
+class MockOmero:
+    """
+    Local stand-in for OMERO.web implementing the endpoints these scripts
+    use: servers, token, login, paged projects/datasets/images listings
+    (also of the datasets of a project and the images of a dataset),
+    image metadata, imgData, get_thumbnails, render_image_region,
+    render_image and the pixel buffer service's raw /tile/ endpoint. Logins return an OMERO
+    session key, which logs a new web session in when given as bsession=
+    (clear `sessions` to expire every web session). Every request sleeps
+    for `latency` seconds first to simulate the network and server; a
+    `slow_rate` share of them sleeps `slow_latency` more (a tail), and a
+    `failure_rate` share of logged-in GETs fails with 503. With `patterned`,
+    render_image_region renders the requested region and level of a smooth
+    synthetic image instead of serving one fixed tile.
+
+        with MockOmero(latency=0.02) as server:
+            run_something(server.url)
+    """
+
+    def __init__(
+        self,
+        latency=0.0,
+        page_size=200,
+        projects=10,
+        datasets=50,
+        images=1000,
+        image_size=(4096, 4096),
+        tile_size=512,
+        port=0,
+        slow_rate=0.0,
+        slow_latency=1.0,
+        failure_rate=0.0,
+        patterned=False,
+    ):
+        self.latency = latency
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.failure_rate = failure_rate
+        self.patterned = patterned
+        self.page_size = page_size
+        self.counts = {"projects": projects, "datasets": datasets, "images": images}
+        self.image_size = image_size
+        self.tile_size = tile_size
+        self.tile = make_tile(tile_size, tile_size)
+        self._tiles = {}  # JPEG quality -> tile, for requests with q=
+        self.thumbnail = base64.b64encode(make_tile(96, 96)).decode("ascii")
+        self.image = make_tile(*image_size) if max(image_size) <= 4096 else self.tile
+        self.requests = 0
+        self.csrf_cookie = secrets.token_hex(16)
+        self.sessions = set()
+        # OMERO session keys, which log a new web session in as bsession=
+        self.session_keys = set()
+        # Image id -> render settings revision; bump one to change its imgData
+        self.render_revisions = {}
+        self._lock = threading.Lock()
+        self._server = _Server(("127.0.0.1", port), self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def make_object(self, kind, object_id):
+        obj = {"@id": object_id, "Name": f"{kind[:-1]}_{object_id}"}
+        if kind == "images":
+            obj["AcquisitionDate"] = 1600000000000 + object_id * 1000
+            obj["Pixels"] = {
+                "SizeX": self.image_size[0],
+                "SizeY": self.image_size[1],
+                "SizeZ": 10,
+                "SizeC": 3,
+                "SizeT": 1,
+                "Type": {"value": "uint16"},
+                "Channels": [{"Name": f"ch{c}"} for c in range(3)],
+            }
+        else:
+            obj["Description"] = ""
+        return obj
+
+    def render_region(self, level, x, y, width, height, quality=90):
+        # Level 0 is full resolution; edge tiles are cut to the plane
+        scale = 2**level
+        size_x = -(-self.image_size[0] // scale)
+        size_y = -(-self.image_size[1] // scale)
+        left, top = x * width, y * height
+        right, bottom = min(left + width, size_x), min(top + height, size_y)
+        if right <= left or bottom <= top:
+            return None
+        # Each pixel samples the full resolution image at its center
+        xs = (np.arange(left, right) + 0.5) * scale
+        ys = (np.arange(top, bottom) + 0.5) * scale
+        values = 128 + 100 * np.outer(
+            np.cos(2 * np.pi * ys / 500), np.sin(2 * np.pi * xs / 700)
+        )
+        buf = BytesIO()
+        Image.fromarray(values.astype(np.uint8)).convert("RGB").save(
+            buf, format="JPEG", quality=quality
+        )
+        return buf.getvalue()
+
+    def image_data(self, image_id):
+        width, height = self.image_size
+        levels = 1
+        while max(width, height) > self.tile_size << (levels - 1):
+            levels += 1
+        revision = self.render_revisions.get(image_id, 0)
+        return {
+            "id": image_id,
+            "size": {"width": width, "height": height, "z": 10, "t": 1, "c": 3},
+            "tiles": levels > 1,
+            "tile_size": {"width": self.tile_size, "height": self.tile_size},
+            "levels": levels,
+            "channels": [
+                {
+                    "label": f"ch{c}",
+                    "active": True,
+                    "color": "FFFFFF",
+                    "window": {"min": 0, "max": 65535, "start": revision, "end": 4095},
+                }
+                for c in range(3)
+            ],
+            "rdefs": {"model": "color", "projection": "normal", "defaultZ": 0},
+        }
+
+    def children(self, kind, object_id):
+        # Datasets and images are spread round-robin over their parents
+        child_kind = "datasets" if kind == "projects" else "images"
+        return range(object_id, self.counts[child_kind] + 1, self.counts[kind])
+
+    def _handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately; without this, delayed
+            # ACKs add ~40ms to every keep-alive response
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, content_type, headers=None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                if self._new_session is not None:
+                    self.send_header(
+                        "Set-Cookie", f"sessionid={self._new_session}; Path=/"
+                    )
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _json(self, data, status=200, headers=None):
+                body = json.dumps(data).encode("utf-8")
+                self._send(status, body, "application/json", headers)
+
+            def _cookies(self):
+                cookies = {}
+                for part in self.headers.get("Cookie", "").split(";"):
+                    if "=" in part:
+                        name, value = part.strip().split("=", 1)
+                        cookies[name] = value
+                return cookies
+
+            def _logged_in(self, query):
+                if self._cookies().get("sessionid") in mock.sessions:
+                    return True
+                if query.get("bsession") not in mock.session_keys:
+                    return False
+                self._new_session = secrets.token_hex(16)
+                with mock._lock:
+                    mock.sessions.add(self._new_session)
+                return True
+
+            def _start(self):
+                self._new_session = None
+                with mock._lock:
+                    mock.requests += 1
+                if mock.latency:
+                    time.sleep(mock.latency)
+                if mock.slow_rate and random.random() < mock.slow_rate:
+                    time.sleep(mock.slow_latency)
+                parsed = urlparse(self.path)
+                return parsed.path, {
+                    k: v[-1] for k, v in parse_qs(parsed.query).items()
+                }
+
+            def do_GET(self):
+                path, query = self._start()
+                if path == "/api/v0/servers/":
+                    return self._json({"data": [{"id": 1, "host": "localhost"}]})
+                if path == "/api/v0/token/":
+                    cookie = f"csrftoken={mock.csrf_cookie}; Path=/"
+                    return self._json(
+                        {"data": mock.csrf_cookie}, headers={"Set-Cookie": cookie}
+                    )
+                if not self._logged_in(query):
+                    return self._json({"message": "Not logged in"}, status=403)
+                if mock.failure_rate and random.random() < mock.failure_rate:
+                    return self._json({"message": "Unavailable"}, status=503)
+
+                match = re.fullmatch(
+                    r"/api/v0/m/(projects|datasets|images)/(\d+)?/?"
+                    r"(?:(datasets|images)/)?",
+                    path,
+                )
+                if match:
+                    kind, object_id, child_kind = match.groups()
+                    if object_id is not None and child_kind is None:
+                        return self._json(
+                            {"data": mock.make_object(kind, int(object_id))}
+                        )
+                    if child_kind is not None:
+                        kind, ids = child_kind, mock.children(kind, int(object_id))
+                    else:
+                        ids = range(1, mock.counts[kind] + 1)
+                    offset = int(query.get("offset", 0))
+                    limit = min(int(query.get("limit", mock.page_size)), mock.page_size)
+                    data = []
+                    for i in ids[offset : offset + limit]:
+                        obj = mock.make_object(kind, i)
+                        if query.get("childCount") == "true" and kind != "images":
+                            obj["omero:childCount"] = len(mock.children(kind, i))
+                        data.append(obj)
+                    return self._json(
+                        {
+                            "data": data,
+                            "meta": {
+                                "offset": offset,
+                                "limit": limit,
+                                "maxLimit": mock.page_size,
+                                "totalCount": len(ids),
+                            },
+                        }
+                    )
+                match = re.fullmatch(r"/webgateway/imgData/(\d+)/", path)
+                if match:
+                    return self._json(mock.image_data(int(match.group(1))))
+                if path.startswith("/webgateway/get_thumbnails/"):
+                    ids = parse_qs(urlparse(self.path).query).get("id", [])
+                    uri = "data:image/jpeg;base64," + mock.thumbnail
+                    return self._json({image_id: uri for image_id in ids})
+                if path.startswith("/webgateway/render_image_region/"):
+                    if mock.patterned:
+                        level, x, y, w, h = map(int, query["tile"].split(","))
+                        quality = int(float(query.get("q", 0.9)) * 100)
+                        tile = mock.render_region(level, x, y, w, h, quality)
+                        if tile is None:
+                            return self._json({"message": "Bad tile"}, status=400)
+                        return self._send(200, tile, "image/jpeg")
+                    if "q" not in query:
+                        return self._send(200, mock.tile, "image/jpeg")
+                    quality = max(1, min(100, int(float(query["q"]) * 100)))
+                    tile = mock._tiles.get(quality)
+                    if tile is None:
+                        tile = mock._tiles[quality] = make_tile(
+                            mock.tile_size, mock.tile_size, quality
+                        )
+                    return self._send(200, tile, "image/jpeg")
+                if path.startswith("/webgateway/render_image/"):
+                    return self._send(200, mock.image, "image/jpeg")
+                if path.startswith("/tile/"):
+                    # Pixel buffer service: raw big-endian uint16 pixels
+                    x, y = int(query.get("x", 0)), int(query.get("y", 0))
+                    w = int(query.get("w", mock.image_size[0]))
+                    h = int(query.get("h", mock.image_size[1]))
+                    plane = np.add.outer(np.arange(y, y + h), np.arange(x, x + w))
+                    body = plane.astype(">u2").tobytes()
+                    return self._send(200, body, "application/octet-stream")
+                return self._json({"message": "Not found"}, status=404)
+
+            def do_POST(self):
+                path, _ = self._start()
+                length = int(self.headers.get("Content-Length", 0))
+                form = {
+                    k: v[-1]
+                    for k, v in parse_qs(self.rfile.read(length).decode()).items()
+                }
+                if path != "/api/v0/login/":
+                    return self._json({"message": "Not found"}, status=404)
+                if (
+                    form.get("csrfmiddlewaretoken") != mock.csrf_cookie
+                    or self._cookies().get("csrftoken") != mock.csrf_cookie
+                ):
+                    return self._json(
+                        {"message": "CSRF verification failed"}, status=403
+                    )
+                if not form.get("username") or not form.get("password"):
+                    return self._json({"success": False}, status=403)
+                sessionid = secrets.token_hex(16)
+                session_key = secrets.token_hex(16)
+                with mock._lock:
+                    mock.sessions.add(sessionid)
+                    mock.session_keys.add(session_key)
+                context = {
+                    "userName": form["username"],
+                    # Stable per-name user id; everyone is in group 1
+                    "userId": sum(form["username"].encode("utf-8")),
+                    "groupId": 1,
+                    "sessionUuid": session_key,
+                }
+                return self._json(
+                    {"success": True, "eventContext": context},
+                    headers={"Set-Cookie": f"sessionid={sessionid}; Path=/"},
+                )
+
+        return Handler
@@ -0,0 +1,155 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# How long the server list and a CSRF token are reused, in seconds
+SERVERS_TTL = 3600
+TOKEN_TTL = 3600
+
+_servers = {}  # base_url -> (server id, fetched at)
+_tokens = {}  # base_url -> (token, csrftoken cookie, fetched at)
+_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=4)
+
+
+# Function to get the server ID, from the process-wide cache when possible
+def _get_server_id(sess, base_url, timings):
+    with _lock:
+        cached = _servers.get(base_url)
+    if cached and time.monotonic() - cached[1] < SERVERS_TTL:
+        return cached[0]
+    start = time.perf_counter()
+    res = sess.get(base_url + "/api/v0/servers/", verify=False)
+    id_server = int(res.json()["data"][0]["id"])
+    timings["servers"] = time.perf_counter() - start
+    with _lock:
+        _servers[base_url] = (id_server, time.monotonic())
+    return id_server
+
+
+# Function to get a CSRF token and make sure `sess` carries the matching cookie
+def _get_token(sess, base_url, timings):
+    with _lock:
+        cached = _tokens.get(base_url)
+    if cached and time.monotonic() - cached[2] < TOKEN_TTL:
+        # Django only checks that the token matches the csrftoken cookie,
+        # so a token can be reused by any session that sends the cookie
+        token, cookie, _ = cached
+        sess.cookies.set("csrftoken", cookie)
+        return token
+    start = time.perf_counter()
+    res = sess.get(base_url + "/api/v0/token/", verify=False)
+    token = res.json()["data"]
+    timings["token"] = time.perf_counter() - start
+    cookie = sess.cookies.get("csrftoken")
+    if cookie is not None:
+        with _lock:
+            _tokens[base_url] = (token, cookie, time.monotonic())
+    return token
+
+
+# Function to forget a cached token, e.g. after it was rejected
+def invalidate_token(base_url):
+    with _lock:
+        _tokens.pop(base_url, None)
+
+
+# Function to log a requests session in to OMERO.web
+def login(sess, base_url, username, password):
+    """
+    Logs `sess` in and returns `(login response, timings)`. The server list
+    and CSRF token are cached process-wide, so in steady state the login
+    POST is the only round trip; when both are missing they are fetched
+    concurrently. `timings` maps each phase that ran (servers, token,
+    login, total) to its duration in seconds.
+    """
+    timings = {}
+    start = time.perf_counter()
+    server_future = _executor.submit(_get_server_id, sess, base_url, timings)
+    token = _get_token(sess, base_url, timings)
+    id_server = server_future.result()
+
+    login_start = time.perf_counter()
+    res_log = _post_login(sess, base_url, id_server, token, username, password)
+    if res_log.status_code == 403 and "token" not in timings:
+        # The reused token was rejected (e.g. the server rotated its secret)
+        invalidate_token(base_url)
+        sess.cookies.pop("csrftoken", None)
+        token = _get_token(sess, base_url, timings)
+        login_start = time.perf_counter()
+        res_log = _post_login(sess, base_url, id_server, token, username, password)
+    timings["login"] = time.perf_counter() - login_start
+    timings["total"] = time.perf_counter() - start
+    phases = ", ".join(f"{k}={v * 1000:.1f}ms" for k, v in timings.items())
+    print("     > login timings: " + phases)
+    return res_log, timings
+
+
+# Function to post the login form itself
+def _post_login(sess, base_url, id_server, token, username, password):
+    login_payload = {
+        "server": id_server,
+        "username": username,
+        "password": password,
+        "csrfmiddlewaretoken": token,  # Include CSRF token
+    }
+    headers = {
+        "referer": base_url,
+        "X-CSRFToken": token,  # Optionally include CSRF token in headers
+    }
+    return sess.post(
+        base_url + "/api/v0/login/", data=login_payload, headers=headers, verify=False
+    )
+
+
+class LazySession:
+    """
+    Requests-style session that logs in to OMERO.web on first use instead
+    of when it is created, so importing a module that holds one costs no
+    round trips. Attribute access (get, post, cookies, mount, ...) goes to
+    the logged-in session made by `session_factory` (default:
+    requests.Session). With `pool_maxsize`, the session keeps up to that
+    many keep-alive connections for concurrent requests. Raises
+    RuntimeError if the login fails.
+    """
+
+    def __init__(
+        self, base_url, username, password, session_factory=None, pool_maxsize=None
+    ):
+        self.base_url = base_url
+        self.username = username
+        self.password = password
+        self.session_factory = session_factory
+        self.pool_maxsize = pool_maxsize
+        self.event_context = None
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                if self.session_factory is None:
+                    import requests
+
+                    self.session_factory = requests.Session
+                sess = self.session_factory()
+                if self.pool_maxsize is not None:
+                    from requests.adapters import HTTPAdapter
+
+                    adapter = HTTPAdapter(
+                        pool_connections=1, pool_maxsize=self.pool_maxsize
+                    )
+                    sess.mount("https://", adapter)
+                    sess.mount("http://", adapter)
+                print(f" > Logging in to {self.base_url}")
+                res_log, _ = login(sess, self.base_url, self.username, self.password)
+                if res_log.status_code != 200 or not res_log.json().get("success"):
+                    sess.close()
+                    raise RuntimeError(f"Login failed: {res_log.text}")
+                self.event_context = res_log.json().get("eventContext")
+                self._session = sess
+            return self._session
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
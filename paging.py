@@ -0,0 +1,76 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ListingError(RuntimeError):
+    """Raised when a page of a listing cannot be fetched, or pages are missing."""
+
+
+# Function to fetch a single page of a JSON API listing
+def fetch_page(sess, url, offset, limit=None, **request_kwargs):
+    """Returns the page at `offset`; raises ListingError if it cannot be fetched."""
+    params = dict(request_kwargs.pop("params", None) or {}, offset=offset)
+    if limit is not None:
+        params["limit"] = limit
+    res = sess.get(url, params=params, verify=False, **request_kwargs)
+    if res.status_code != 200:
+        raise ListingError(
+            f"Failed to list {url} at offset {offset}: {res.status_code} {res.text}"
+        )
+    return res.json()
+
+
+# Function to iterate lazily over every object of a paged JSON API listing
+def iter_objects(
+    sess, url, page_size=None, prefetch=False, first_page=None, **request_kwargs
+):
+    """
+    Yields the objects of `url` (e.g. /api/v0/m/images/) one by one,
+    following the `offset`/`limit` paging described in the response `meta`.
+    `sess` is anything with a requests-style get() (a Session or the
+    requests module itself). With `prefetch`, the next page is requested in
+    the background while the current one is being consumed, so at most two
+    pages are held in memory at once. A `first_page` that the caller has
+    already fetched (offset 0) is used instead of requesting it again.
+
+    Raises ListingError if a page fails, or if the listing ends before the
+    `totalCount` it announced, so that callers never mistake a partial
+    listing for a complete one.
+    """
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    try:
+        offset = 0
+        page = first_page
+        if page is None:
+            page = fetch_page(sess, url, offset, page_size, **request_kwargs)
+        while page:
+            objects = page.get("data", [])
+            meta = page.get("meta", {})
+            # The server may cap the page size below what we asked for
+            limit = meta.get("limit") or len(objects)
+            total = meta.get("totalCount")
+            offset += len(objects)
+            more = bool(objects) and (
+                offset < total if total is not None else len(objects) >= limit
+            )
+
+            next_page = None
+            if more and executor is not None:
+                next_page = executor.submit(
+                    fetch_page, sess, url, offset, limit, **request_kwargs
+                )
+
+            yield from objects
+
+            if not more:
+                if total is not None and offset < total:
+                    raise ListingError(
+                        f"Listing of {url} ended at {offset} of {total} objects"
+                    )
+                break
+            if next_page is not None:
+                page = next_page.result()
+            else:
+                page = fetch_page(sess, url, offset, limit, **request_kwargs)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,145 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from raw_pixels import PIXEL_DTYPES
+
+# Largest block read from the raw pixels store at once while filling a plane
+CHUNK_BYTES = 16 * 1024 * 1024
+
+
+class PlaneStore:
+    """
+    Local on-disk cache of pixel data keyed by image/z/c/t/region. Each
+    entry is a .npy file handed back as a read-only np.memmap, so repeat
+    reads come from the page cache without copies. Least recently used
+    entries are deleted once the store grows past `max_bytes`.
+    """
+
+    def __init__(self, root, max_bytes=4 * 1024**3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()  # path -> size, least recently used first
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        # Rebuild the LRU order from modification times left by earlier runs
+        found = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith(".npy"):
+                    stat = os.stat(os.path.join(dirpath, filename))
+                    found.append(
+                        (stat.st_mtime, os.path.join(dirpath, filename), stat.st_size)
+                    )
+        for _, path, size in sorted(found):
+            self._entries[path] = size
+            self.total_bytes += size
+
+    def path_for(self, image_id, z, c, t, region=None, level=0):
+        name = f"{z}_{c}_{t}"
+        if level:
+            name += f"_L{level}"  # downsampled pyramid level
+        if region is not None:
+            name += "_" + "_".join(str(v) for v in region)  # x, y, w, h
+        return os.path.join(self.root, str(image_id), name + ".npy")
+
+    def get(self, image_id, z, c, t, region=None, level=0):
+        path = self.path_for(image_id, z, c, t, region, level)
+        with self._lock:
+            if path not in self._entries:
+                return None
+            self._entries.move_to_end(path)
+        try:
+            os.utime(path)
+            return np.load(path, mmap_mode="r")
+        except OSError:
+            with self._lock:
+                self.total_bytes -= self._entries.pop(path, 0)
+            return None
+
+    def create(self, image_id, z, c, t, shape, dtype, region=None, level=0):
+        """
+        Returns (path, writable memmap) for a new entry; fill it, then call
+        commit(path, array) to publish it.
+        """
+        path = self.path_for(image_id, z, c, t, region, level)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        return path, np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=dtype, shape=shape
+        )
+
+    def commit(self, path, array):
+        array.flush()
+        tmp_path = array.filename
+        del array
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            self.total_bytes += size - self._entries.pop(path, 0)
+            self._entries[path] = size
+            self._evict()
+        return np.load(path, mmap_mode="r")
+
+    def put(self, image_id, z, c, t, data, region=None, level=0):
+        path, array = self.create(
+            image_id, z, c, t, data.shape, data.dtype, region, level
+        )
+        array[...] = data
+        return self.commit(path, array)
+
+    def _evict(self):
+        # Caller holds the lock; open memmaps keep working after unlink
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            path, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+# Function to open a raw pixels store on a pixels object
+def open_raw_store(conn, pixels_id):
+    rps = conn.c.sf.createRawPixelsStore()
+    rps.setPixelsId(pixels_id, True, conn.SERVICE_OPTS)
+    return rps
+
+
+# Function to get a plane or region of an image record, from the store when possible
+def get_plane(store, conn, record, z=0, c=0, t=0, region=None):
+    """
+    Returns a read-only np.memmap of plane (z, c, t) of `record` (an
+    ImageRecord from bulk_loader), or of `region` (x, y, w, h) of it. On a
+    miss the pixels are read from OMERO in blocks of rows of at most
+    CHUNK_BYTES straight into the on-disk array, so a whole plane never has
+    to fit in memory.
+    """
+    cached = store.get(record.id, z, c, t, region)
+    if cached is not None:
+        return cached
+
+    x, y, w, h = region if region is not None else (0, 0, record.size_x, record.size_y)
+    dtype = np.dtype(PIXEL_DTYPES[record.pixels_type])
+    path, array = store.create(
+        record.id, z, c, t, (h, w), dtype.newbyteorder("="), region
+    )
+    rows_per_chunk = max(1, CHUNK_BYTES // (w * dtype.itemsize))
+    rps = open_raw_store(conn, record.pixels_id)
+    try:
+        for row in range(0, h, rows_per_chunk):
+            rows = min(rows_per_chunk, h - row)
+            data = rps.getTile(z, c, t, x, y + row, w, rows, conn.SERVICE_OPTS)
+            array[row : row + rows] = np.frombuffer(data, dtype=dtype).reshape(rows, w)
+    except Exception:
+        os.remove(array.filename)
+        raise
+    finally:
+        rps.close()
+    return store.commit(path, array)
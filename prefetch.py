@@ -0,0 +1,255 @@
+import heapq
+import itertools
+import math
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+TilePosition = namedtuple("TilePosition", ["image_id", "z", "t", "x", "y", "level"])
+
+
+class TileGrid(
+    namedtuple(
+        "TileGrid",
+        ["size_x", "size_y", "size_z", "levels", "tile_width", "tile_height"],
+    )
+):
+    """
+    Extent of an image's tiles: its full resolution size and Z planes, its
+    number of resolution levels and the size of the tiles requested.
+    """
+
+    def contains(self, tile):
+        if not (0 <= tile.level < self.levels and 0 <= tile.z < self.size_z):
+            return False
+        # Level 0 is full resolution, each level up halves the plane
+        scale = 2**tile.level
+        columns = math.ceil(math.ceil(self.size_x / scale) / self.tile_width)
+        rows = math.ceil(math.ceil(self.size_y / scale) / self.tile_height)
+        return 0 <= tile.x < columns and 0 <= tile.y < rows
+
+
+# Priorities, lower runs first
+NEXT_IN_DIRECTION = 0
+NEIGHBOR = 1
+ADJACENT_Z = 2
+DIAGONAL = 3
+OTHER_LEVEL = 4
+
+
+class PrefetchScheduler:
+    """
+    Warms the tile cache ahead of a viewer. Every foreground tile request is
+    reported with record(); from the last two positions of each viewer the
+    scheduler predicts the next tiles (the tile ahead in the direction of
+    panning, the other neighbors, adjacent Z planes and the tiles one zoom
+    level up and down) and fetches them on background workers. Predictions
+    are kept within the image's TileGrid when record() is given one.
+
+    `fetch(tile, context)` fetches one tile into the cache and returns the
+    number of bytes it downloaded (0 if it was already cached). Prefetching
+    pauses while more than `max_foreground` foreground requests are in
+    flight and is limited to `max_bytes_per_second` of upstream bandwidth.
+    """
+
+    def __init__(
+        self,
+        fetch,
+        max_workers=2,
+        max_bytes_per_second=8 * 1024 * 1024,
+        max_foreground=2,
+        max_queue=512,
+        max_viewers=1024,
+    ):
+        self.fetch = fetch
+        self.max_workers = max_workers
+        self.max_bytes_per_second = max_bytes_per_second
+        self.max_foreground = max_foreground
+        self.max_queue = max_queue
+        self.max_viewers = max_viewers
+        self.prefetched = 0
+        self.dropped = 0
+        self._queue = []
+        self._queued = set()
+        self._done = OrderedDict()  # recently fetched or requested, oldest first
+        self._counter = itertools.count()
+        # Per viewer, least recently active first
+        self._last = OrderedDict()  # viewer -> last TilePosition
+        self._generation = OrderedDict()  # viewer -> int, bumped on every move
+        self._foreground = 0
+        self._budget = max_bytes_per_second
+        self._budget_time = time.monotonic()
+        self._cond = threading.Condition()
+        self._workers = []
+
+    def _start_workers(self):
+        # Caller holds the condition
+        while len(self._workers) < self.max_workers:
+            worker = threading.Thread(target=self._run, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def foreground_started(self):
+        with self._cond:
+            self._foreground += 1
+
+    def foreground_finished(self):
+        with self._cond:
+            self._foreground -= 1
+            self._cond.notify_all()
+
+    def predict(self, previous, current, grid=None):
+        """
+        Returns [(priority, TilePosition)] worth fetching after `current`,
+        only those within `grid` if given.
+        """
+        image_id, z, t, x, y, level = current
+        dx = dy = dz = 0
+        if previous is not None and previous.image_id == image_id:
+            if previous.level == level and previous.z == z:
+                dx = (x > previous.x) - (x < previous.x)
+                dy = (y > previous.y) - (y < previous.y)
+            elif previous.level == level and (previous.x, previous.y) == (x, y):
+                dz = (z > previous.z) - (z < previous.z)
+
+        predictions = []
+        for nx in (-1, 0, 1):
+            for ny in (-1, 0, 1):
+                if (nx, ny) == (0, 0) or x + nx < 0 or y + ny < 0:
+                    continue
+                if (dx or dy) and (nx, ny) == (dx, dy):
+                    priority = NEXT_IN_DIRECTION
+                elif nx == 0 or ny == 0:
+                    priority = NEIGHBOR
+                else:
+                    priority = DIAGONAL
+                predictions.append((priority, current._replace(x=x + nx, y=y + ny)))
+
+        for nz in (-1, 1):
+            if z + nz >= 0:
+                priority = NEXT_IN_DIRECTION if nz == dz else ADJACENT_Z
+                predictions.append((priority, current._replace(z=z + nz)))
+        if dz and z + 2 * dz >= 0:
+            predictions.append((ADJACENT_Z, current._replace(z=z + 2 * dz)))
+
+        # OMERO tile levels: level 0 is full resolution, so zooming in goes one
+        # level down to the four tiles covering this one, zooming out one up
+        if level > 0:
+            for cx in (0, 1):
+                for cy in (0, 1):
+                    predictions.append(
+                        (
+                            OTHER_LEVEL,
+                            current._replace(
+                                x=2 * x + cx, y=2 * y + cy, level=level - 1
+                            ),
+                        )
+                    )
+        predictions.append(
+            (OTHER_LEVEL, current._replace(x=x // 2, y=y // 2, level=level + 1))
+        )
+        if grid is not None:
+            predictions = [p for p in predictions if grid.contains(p[1])]
+        return predictions
+
+    def record(self, viewer, tile, context=None, grid=None):
+        """Reports a foreground request for `tile` by `viewer` and queues predictions."""
+        with self._cond:
+            previous = self._last.pop(viewer, None)
+            self._last[viewer] = tile
+            # Predictions made for older positions are no longer useful
+            generation = self._generation.pop(viewer, 0) + 1
+            self._generation[viewer] = generation
+            # Forget the least recently active viewers; their queued
+            # predictions are dropped as their generation is gone
+            while len(self._last) > self.max_viewers:
+                self._last.popitem(last=False)
+            while len(self._generation) > self.max_viewers:
+                self._generation.popitem(last=False)
+            self._queue = [job for job in self._queue if job[2] != viewer]
+            heapq.heapify(self._queue)
+            self._queued = {key for key in self._queued if key[0] != viewer}
+            self._mark_done((viewer, tile))
+            for priority, predicted in self.predict(previous, tile, grid):
+                key = (viewer, predicted)
+                if key in self._queued or key in self._done:
+                    continue
+                if len(self._queue) >= self.max_queue:
+                    self.dropped += 1
+                    break
+                heapq.heappush(
+                    self._queue,
+                    (
+                        priority,
+                        next(self._counter),
+                        viewer,
+                        generation,
+                        predicted,
+                        context,
+                    ),
+                )
+                self._queued.add(key)
+            self._start_workers()
+            self._cond.notify_all()
+
+    def forget(self, viewer):
+        with self._cond:
+            self._last.pop(viewer, None)
+            self._generation.pop(viewer, None)
+            for key in [key for key in self._done if key[0] == viewer]:
+                del self._done[key]
+
+    def _mark_done(self, key):
+        # Caller holds the condition; remember a bounded number of tiles
+        self._done[key] = True
+        self._done.move_to_end(key)
+        while len(self._done) > self.max_queue * 8:
+            self._done.popitem(last=False)
+
+    def _take(self):
+        with self._cond:
+            while True:
+                if self._queue and self._foreground <= self.max_foreground:
+                    _, _, viewer, generation, tile, context = heapq.heappop(self._queue)
+                    self._queued.discard((viewer, tile))
+                    if self._generation.get(viewer) != generation:
+                        self.dropped += 1
+                        continue
+                    self._mark_done((viewer, tile))
+                    return tile, context
+                self._cond.wait(timeout=1)
+
+    def _spend(self, nbytes):
+        # Token bucket: refill at max_bytes_per_second, sleep off any debt
+        with self._cond:
+            now = time.monotonic()
+            self._budget = min(
+                self.max_bytes_per_second,
+                self._budget + (now - self._budget_time) * self.max_bytes_per_second,
+            )
+            self._budget_time = now
+            self._budget -= nbytes
+            debt = -self._budget
+        if debt > 0:
+            time.sleep(debt / self.max_bytes_per_second)
+
+    def _run(self):
+        while True:
+            tile, context = self._take()
+            try:
+                nbytes = self.fetch(tile, context)
+            except Exception as e:
+                print(f"Prefetch of {tile} failed: {e}")
+                continue
+            if nbytes:
+                with self._cond:
+                    self.prefetched += 1
+                self._spend(nbytes)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queued": len(self._queue),
+                "prefetched": self.prefetched,
+                "dropped": self.dropped,
+            }
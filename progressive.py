@@ -0,0 +1,98 @@
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+# JPEG quality (OMERO's q parameter) of full tiles
+FULL_QUALITY = 0.9
+# Preview qualities, from the best (fast link, still viewport) to the cheapest
+PREVIEW_QUALITIES = (0.6, 0.4, 0.25)
+
+
+class AdaptiveQuality:
+    """
+    Picks how tiles are delivered to each viewer from an exponentially
+    weighted moving average of its full tile fetch latency.
+
+    Below `fast` seconds a still viewer gets full tiles straight away, as a
+    preview would only add a round trip. Otherwise previews are sent first,
+    at a quality that drops as the latency passes `fast` and `slow`, and one
+    step further while the viewport is moving.
+    """
+
+    def __init__(self, alpha=0.3, fast=0.1, slow=0.5, max_viewers=1024):
+        self.alpha = alpha
+        self.fast = fast
+        self.slow = slow
+        self.max_viewers = max_viewers
+        self.previews = 0
+        self.full = 0
+        self._latency = OrderedDict()  # viewer -> EWMA seconds, least recent first
+        self._lock = threading.Lock()
+
+    def observe(self, viewer, seconds):
+        """Records the latency of one full tile fetched from upstream."""
+        with self._lock:
+            previous = self._latency.pop(viewer, None)
+            if previous is None:
+                self._latency[viewer] = seconds
+            else:
+                self._latency[viewer] = previous + self.alpha * (seconds - previous)
+            while len(self._latency) > self.max_viewers:
+                self._latency.popitem(last=False)
+
+    def latency(self, viewer):
+        with self._lock:
+            return self._latency.get(viewer)
+
+    def wants_preview(self, viewer, moving=False):
+        latency = self.latency(viewer)
+        preview = moving or latency is None or latency >= self.fast
+        with self._lock:
+            if preview:
+                self.previews += 1
+            else:
+                self.full += 1
+        return preview
+
+    def preview_quality(self, viewer, moving=False):
+        latency = self.latency(viewer)
+        step = 0
+        if latency is not None:
+            step = (latency >= self.fast) + (latency >= self.slow)
+        step = min(step + moving, len(PREVIEW_QUALITIES) - 1)
+        return PREVIEW_QUALITIES[step]
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latency.values())
+            return {
+                "previews": self.previews,
+                "full": self.full,
+                "viewers": len(latencies),
+                "median_latency": latencies[len(latencies) // 2] if latencies else None,
+            }
+
+
+# Function to make a preview of a tile from the coarser tile one level up
+def upscale_quadrant(parent, quadrant_x, quadrant_y, width, height, quality):
+    """
+    `parent` is the JPEG of the tile one OMERO level up (level + 1, at half
+    the resolution, at x // 2, y // 2) whose quadrant (`quadrant_x`,
+    `quadrant_y`, i.e. x % 2, y % 2) covers the wanted tile of `width` by
+    `height`. Returns that quadrant enlarged 2x as a JPEG of `quality`
+    (0-1, as OMERO's q), or None if the parent does not reach it (an edge).
+    """
+    # PIL is only needed here, so importing this module stays cheap
+    from PIL import Image
+
+    img = Image.open(BytesIO(parent))
+    left, top = quadrant_x * width // 2, quadrant_y * height // 2
+    right = min(left + width // 2, img.width)
+    bottom = min(top + height // 2, img.height)
+    if right <= left or bottom <= top:
+        return None
+    img = img.crop((left, top, right, bottom))
+    img = img.resize((img.width * 2, img.height * 2), Image.BILINEAR)
+    buf = BytesIO()
+    img.convert("RGB").save(buf, format="JPEG", quality=int(quality * 100))
+    return buf.getvalue()
@@ -0,0 +1,171 @@
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from plane_store import open_raw_store
+from raw_pixels import PIXEL_DTYPES
+
+METHODS = ("max", "min", "sum", "mean")
+
+# Per-process connection and raw pixels stores of the pool workers
+_worker_conn = None
+_worker_stores = {}
+
+
+# Function to get the dtype a projection is accumulated and returned in
+def projection_dtype(method, pixels_type):
+    dtype = np.dtype(PIXEL_DTYPES[pixels_type]).newbyteorder("=")
+    if method in ("max", "min"):
+        return dtype
+    if method == "sum" and dtype.kind in "ui":
+        return np.dtype(np.int64)
+    return np.dtype(np.float64)
+
+
+# Function to reduce a stream of equally shaped arrays into one, in place
+def reduce_planes(planes, method="max", dtype=None):
+    """
+    Folds `planes` (any iterable of 2D arrays) into a single accumulator
+    with max, min, sum or mean, so only one plane and the accumulator are
+    in memory at a time.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown projection method {method!r}")
+    acc = None
+    count = 0
+    for plane in planes:
+        count += 1
+        if acc is None:
+            acc = np.array(plane, dtype=dtype or plane.dtype.newbyteorder("="))
+        elif method == "max":
+            np.maximum(acc, plane, out=acc)
+        elif method == "min":
+            np.minimum(acc, plane, out=acc)
+        else:
+            np.add(acc, plane, out=acc, casting="unsafe")
+    if method == "mean" and count:
+        acc /= count
+    return acc
+
+
+# Function to set up a pool worker with its own session on the same server
+def _init_worker(host, port, session_key):
+    global _worker_conn
+    import omero.clients
+    from omero.gateway import BlitzGateway
+
+    client = omero.client(host=host, port=port)
+    client.joinSession(session_key)
+    _worker_conn = BlitzGateway(client_obj=client)
+
+
+# Function to project one region, in a pool worker or in the calling process
+def _project_region(pixels_id, pixels_type, planes, region, method, conn=None):
+    conn = conn or _worker_conn
+    stores = _worker_stores if conn is _worker_conn else {}
+    rps = stores.get(pixels_id)
+    if rps is None:
+        rps = open_raw_store(conn, pixels_id)
+    source_dtype = np.dtype(PIXEL_DTYPES[pixels_type])
+    x, y, w, h = region
+
+    def read():
+        for z, c, t in planes:
+            data = rps.getTile(z, c, t, x, y, w, h, conn.SERVICE_OPTS)
+            yield np.frombuffer(data, dtype=source_dtype).reshape(h, w)
+
+    try:
+        return region, reduce_planes(
+            read(), method, projection_dtype(method, pixels_type)
+        )
+    finally:
+        if conn is _worker_conn:
+            stores[pixels_id] = rps  # reused by the next region of this image
+        else:
+            rps.close()
+
+
+# Function to project a Z range (or T range) of an image across processes
+def project(
+    conn,
+    record,
+    method="max",
+    c=0,
+    t=0,
+    z=0,
+    axis="z",
+    start=0,
+    end=None,
+    tile_size=1024,
+    processes=None,
+    out=None,
+):
+    """
+    Returns the `method` (max, min, sum or mean) projection of channel `c`
+    of `record` (an ImageRecord from bulk_loader) over planes `start` to
+    `end` (inclusive, default: the last) along `axis` ("z" at time point
+    `t`, or "t" at plane `z`).
+
+    The plane is split into tile_size regions, each reduced by streaming
+    its planes through a running accumulator, so every worker holds about
+    two tiles at a time whatever the stack depth. Regions are spread over
+    `processes` worker processes (default: one per core), each joining the
+    session of `conn`; `processes=0` works in the calling process. `out`
+    may be a preallocated (for example memory-mapped) array for planes too
+    large to hold in memory.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown projection method {method!r}")
+    size = record.size_z if axis == "z" else record.size_t
+    end = size - 1 if end is None else min(end, size - 1)
+    if axis == "z":
+        planes = [(zz, c, t) for zz in range(start, end + 1)]
+    elif axis == "t":
+        planes = [(z, c, tt) for tt in range(start, end + 1)]
+    else:
+        raise ValueError(f"Unknown projection axis {axis!r}")
+    if not planes:
+        raise ValueError(f"Empty {axis} range {start}-{end}")
+
+    if out is None:
+        out = np.empty(
+            (record.size_y, record.size_x),
+            dtype=projection_dtype(method, record.pixels_type),
+        )
+    regions = [
+        (x, y, min(tile_size, record.size_x - x), min(tile_size, record.size_y - y))
+        for y in range(0, record.size_y, tile_size)
+        for x in range(0, record.size_x, tile_size)
+    ]
+    args = (record.pixels_id, record.pixels_type, planes)
+
+    if processes == 0 or len(regions) == 1:
+        for region in regions:
+            (x, y, w, h), block = _project_region(*args, region, method, conn)
+            out[y : y + h, x : x + w] = block
+        return out
+
+    processes = min(processes or os.cpu_count() or 1, len(regions))
+    session_key = conn.c.getSessionId()
+    # Spawned, not forked: the parent's Ice runtime and its threads must not
+    # be copied into the workers, which open their own connection
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(conn.host, conn.port, session_key),
+    ) as executor:
+        # Keep a bounded number of finished tiles waiting to be copied out
+        pending = deque()
+        for region in regions:
+            pending.append(executor.submit(_project_region, *args, region, method))
+            if len(pending) >= 2 * processes:
+                (x, y, w, h), block = pending.popleft().result()
+                out[y : y + h, x : x + w] = block
+        while pending:
+            (x, y, w, h), block = pending.popleft().result()
+            out[y : y + h, x : x + w] = block
+    return out
@@ -0,0 +1,174 @@
+import math
+
+import numpy as np
+
+from plane_store import open_raw_store
+from raw_pixels import PIXEL_DTYPES
+
+
+# Function to halve a block of rows in both axes by 2x2 block reduction
+def downsample(block, method="mean"):
+    """
+    Reduces every 2x2 block of `block` to one pixel (mean or max), in a
+    single vectorized pass over a reshaped view. An odd last row or column
+    is padded by repeating the edge.
+    """
+    h, w = block.shape
+    if h % 2 or w % 2:
+        block = np.pad(block, ((0, h % 2), (0, w % 2)), mode="edge")
+    view = block.reshape(block.shape[0] // 2, 2, block.shape[1] // 2, 2)
+    if method == "max":
+        return view.max(axis=(1, 3))
+    if method != "mean":
+        raise ValueError(f"Unknown downsampling method {method!r}")
+    if np.issubdtype(block.dtype, np.integer):
+        # Sum in a wide integer type, then round, so nothing overflows
+        total = view.sum(axis=(1, 3), dtype=np.int64)
+        return ((total + 2) // 4).astype(block.dtype)
+    return view.mean(axis=(1, 3)).astype(block.dtype)
+
+
+# Function to get the (width, height) of every level of a pyramid
+def level_sizes(size_x, size_y, tile_size=512, levels=None):
+    """Level 0 is full resolution; levels stop once a level fits in one tile."""
+    sizes = [(size_x, size_y)]
+    while max(sizes[-1]) > tile_size and (levels is None or len(sizes) <= levels):
+        w, h = sizes[-1]
+        sizes.append(((w + 1) // 2, (h + 1) // 2))
+    return sizes
+
+
+# Function to build a downsampled pyramid of one plane, streaming it tile by tile
+def build_pyramid(
+    read_region,
+    store,
+    image_id,
+    size_x,
+    size_y,
+    z=0,
+    c=0,
+    t=0,
+    tile_size=512,
+    method="mean",
+    levels=None,
+):
+    """
+    Reads the full-resolution plane one row of tiles at a time through
+    `read_region(x, y, w, h)`, downsamples it into successive levels and
+    stores every level as tile_size tiles in `store` (a PlaneStore, with
+    level >= 1 in the key). Each level keeps at most about one and a half
+    tile rows pending, so memory does not depend on the image size.
+    Returns the (width, height) of every level, level 0 included.
+    """
+    sizes = level_sizes(size_x, size_y, tile_size, levels)
+    pending = [None] * len(sizes)  # rows of each level not yet stored
+    stored_rows = [0] * len(sizes)
+
+    def write_rows(level, rows):
+        width = sizes[level][0]
+        y = stored_rows[level]
+        for x in range(0, width, tile_size):
+            tile = rows[:, x : x + tile_size]
+            region = (x, y, tile.shape[1], tile.shape[0])
+            store.put(image_id, z, c, t, tile, region=region, level=level)
+        stored_rows[level] += rows.shape[0]
+
+    def feed(level, rows, final):
+        if level >= len(sizes):
+            return
+        if pending[level] is not None and len(pending[level]):
+            rows = (
+                np.concatenate([pending[level], rows]) if len(rows) else pending[level]
+            )
+        while rows.shape[0] >= tile_size:
+            write_rows(level, rows[:tile_size])
+            feed(level + 1, downsample(rows[:tile_size], method), False)
+            rows = rows[tile_size:]
+        if final and rows.shape[0]:
+            write_rows(level, rows)
+            feed(level + 1, downsample(rows, method), True)
+        elif final:
+            feed(level + 1, rows[:0], True)
+        pending[level] = rows if not final else None
+
+    for y in range(0, size_y, tile_size):
+        h = min(tile_size, size_y - y)
+        band = np.concatenate(
+            [
+                read_region(x, y, min(tile_size, size_x - x), h)
+                for x in range(0, size_x, tile_size)
+            ],
+            axis=1,
+        )
+        final = y + h >= size_y
+        feed(1, downsample(band, method), final)
+    return sizes
+
+
+# Function to read one stored pyramid tile
+def pyramid_tile(store, image_id, sizes, level, col, row, z=0, c=0, t=0, tile_size=512):
+    width, height = sizes[level]
+    x, y = col * tile_size, row * tile_size
+    region = (x, y, min(tile_size, width - x), min(tile_size, height - y))
+    return store.get(image_id, z, c, t, region=region, level=level)
+
+
+# Function to assemble a whole (small) pyramid level from its stored tiles
+def read_level(store, image_id, sizes, level, z=0, c=0, t=0, tile_size=512):
+    width, height = sizes[level]
+    out = None
+    for row in range(math.ceil(height / tile_size)):
+        for col in range(math.ceil(width / tile_size)):
+            tile = pyramid_tile(
+                store, image_id, sizes, level, col, row, z, c, t, tile_size
+            )
+            if tile is None:
+                return None
+            if out is None:
+                out = np.empty((height, width), dtype=tile.dtype)
+            y, x = row * tile_size, col * tile_size
+            out[y : y + tile.shape[0], x : x + tile.shape[1]] = tile
+    return out
+
+
+# Function to get a level that fits `max_size`, building the pyramid if needed
+def overview(store, conn, record, max_size=2048, z=0, c=0, t=0, tile_size=512):
+    """
+    Returns the largest pyramid level of plane (z, c, t) of `record` (an
+    ImageRecord from bulk_loader) whose sides are at most `max_size`.
+    Levels are built from the raw pixels store the first time.
+    """
+    sizes = level_sizes(record.size_x, record.size_y, tile_size)
+    level = next(
+        (i for i, size in enumerate(sizes) if max(size) <= max_size), len(sizes) - 1
+    )
+    if level > 0:
+        plane = read_level(store, record.id, sizes, level, z, c, t, tile_size)
+        if plane is not None:
+            return plane
+
+    dtype = np.dtype(PIXEL_DTYPES[record.pixels_type])
+    native = dtype.newbyteorder("=")
+    rps = open_raw_store(conn, record.pixels_id)
+
+    def read_region(x, y, w, h):
+        data = rps.getTile(z, c, t, x, y, w, h, conn.SERVICE_OPTS)
+        return np.frombuffer(data, dtype=dtype).reshape(h, w).astype(native)
+
+    try:
+        if level == 0:
+            return read_region(0, 0, record.size_x, record.size_y)
+        build_pyramid(
+            read_region,
+            store,
+            record.id,
+            record.size_x,
+            record.size_y,
+            z,
+            c,
+            t,
+            tile_size,
+        )
+    finally:
+        rps.close()
+    return read_level(store, record.id, sizes, level, z, c, t, tile_size)
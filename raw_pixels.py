@@ -0,0 +1,92 @@
+import numpy as np
+
+# numpy dtypes of OMERO pixel types; raw pixel data is always big-endian
+PIXEL_DTYPES = {
+    "int8": ">i1",
+    "uint8": ">u1",
+    "int16": ">i2",
+    "uint16": ">u2",
+    "int32": ">i4",
+    "uint32": ">u4",
+    "float": ">f4",
+    "double": ">f8",
+}
+
+# Bytes per read from the response into the pixel buffer
+READ_CHUNK_BYTES = 1024 * 1024
+
+
+# Function to get the numpy dtype of an image from its JSON API "Pixels" object
+def pixels_dtype(pixels):
+    pixels_type = pixels.get("Type", {})
+    if isinstance(pixels_type, dict):
+        pixels_type = pixels_type.get("value")
+    return np.dtype(PIXEL_DTYPES[pixels_type])
+
+
+# Function to fetch a raw plane or region as a numpy array without decoding
+def fetch_raw_region(
+    sess,
+    pixel_url,
+    image_id,
+    z,
+    c,
+    t,
+    dtype,
+    size,
+    region=None,
+    resolution=None,
+    **request_kwargs,
+):
+    """
+    Fetches plane (z, c, t) of an image, or `region` (x, y, w, h) of it, as
+    raw binary pixels from the OMERO pixel buffer service
+    (`{pixel_url}/tile/{image_id}/{z}/{c}/{t}`), which authenticates with
+    the OMERO.web session cookie of `sess`.
+
+    The body is streamed into one preallocated buffer and wrapped with
+    np.frombuffer, so the pixels are never copied or turned into Python
+    objects. The body is asked for without Content-Encoding; a server that
+    compresses it anyway is decoded in one read instead. The array keeps the
+    server's big-endian `dtype`; `size` is the (width, height) of the plane.
+    Returns None on failure.
+    """
+    dtype = np.dtype(dtype)
+    x, y, w, h = region if region is not None else (0, 0, size[0], size[1])
+    params = {"x": x, "y": y, "w": w, "h": h}
+    if resolution is not None:
+        params["resolution"] = resolution
+    request_kwargs.setdefault("verify", False)
+    # readinto() reads the undecoded body, so it must not be compressed
+    request_kwargs["headers"] = dict(
+        request_kwargs.get("headers") or {}, **{"Accept-Encoding": "identity"}
+    )
+    url = f"{pixel_url}/tile/{image_id}/{z}/{c}/{t}"
+    res = sess.get(url, params=params, stream=True, **request_kwargs)
+    try:
+        if res.status_code != 200:
+            print("Failed to get raw pixels:", res.status_code, res.text[:200])
+            return None
+        expected = w * h * dtype.itemsize
+        if res.headers.get("Content-Encoding", "identity") != "identity":
+            res.raw.decode_content = True
+            buffer = res.raw.read()
+            filled = len(buffer)
+            if filled != expected:
+                print(f"Unexpected raw pixel size for image {image_id}: {filled} bytes")
+                return None
+            return np.frombuffer(buffer, dtype=dtype).reshape(h, w)
+        buffer = bytearray(expected)
+        view = memoryview(buffer)
+        filled = 0
+        while filled < len(buffer):
+            read = res.raw.readinto(view[filled : filled + READ_CHUNK_BYTES])
+            if not read:
+                break
+            filled += read
+        if filled != len(buffer) or res.raw.read(1):
+            print(f"Unexpected raw pixel size for image {image_id}: {filled} bytes")
+            return None
+    finally:
+        res.close()
+    return np.frombuffer(buffer, dtype=dtype).reshape(h, w)
@@ -0,0 +1,366 @@
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+
+import requests
+
+# (connect, read) timeouts in seconds per kind of OMERO.web endpoint
+DEFAULT_TIMEOUTS = {
+    "login": (3.05, 10),
+    "list": (3.05, 15),
+    "metadata": (3.05, 10),
+    "tile": (3.05, 10),
+    "thumbnail": (3.05, 10),
+    "render": (3.05, 30),
+    "pixels": (3.05, 30),
+    "other": (3.05, 30),
+}
+
+# Responses that mean the server is struggling, worth retrying elsewhere/later
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+
+
+# Function to classify an upstream URL into one of the DEFAULT_TIMEOUTS kinds
+def endpoint_kind(url):
+    path = urlparse(url).path
+    if re.search(r"/api/v0/(servers|token|login)/$", path):
+        return "login"
+    if "/webgateway/render_image_region/" in path:
+        return "tile"
+    if "/webgateway/get_thumbnails/" in path or "/render_thumbnail/" in path:
+        return "thumbnail"
+    if "/webgateway/render_image/" in path:
+        return "render"
+    if path.startswith("/tile/"):
+        return "pixels"
+    if re.search(r"/api/v0/m/\w+/\d+/$", path) or "/webgateway/imgData/" in path:
+        return "metadata"
+    if "/api/v0/m/" in path:
+        return "list"
+    return "other"
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of calling an endpoint whose circuit is open."""
+
+    def __init__(self, kind, retry_after, last_error=None):
+        message = f"Circuit for {kind} requests is open"
+        if last_error is not None:
+            message += f" (last error: {last_error})"
+        super().__init__(message)
+        self.kind = kind
+        self.retry_after = retry_after
+        self.last_error = last_error
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures, failing every call
+    fast for `reset_timeout` seconds. Then one trial call is let through:
+    its success closes the circuit again, its failure reopens it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=10.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.last_error = None
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self.state = "half-open"
+                self._trial = False
+            # Half-open: a single trial call at a time
+            if self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def retry_after(self):
+        with self._lock:
+            return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def success(self):
+        with self._lock:
+            self.state = "closed"
+            self._failures = 0
+            self._trial = False
+
+    def cancel(self):
+        # A call that failed before reaching the server says nothing either way
+        with self._lock:
+            self._trial = False
+
+    def failure(self, error=None):
+        with self._lock:
+            self.last_error = error
+            self._failures += 1
+            self._trial = False
+            if self.state == "half-open" or self._failures >= self.failure_threshold:
+                if self.state != "open":
+                    self._opened_at = time.monotonic()
+                self.state = "open"
+
+
+class RetryBudget:
+    """
+    Token bucket that caps retries (and hedges) at `ratio` of requests, plus
+    `min_per_second` so that a quiet process can still retry. When OMERO is
+    down, retries stop multiplying the load instead of piling up.
+    """
+
+    def __init__(self, ratio=0.1, min_per_second=1.0, max_tokens=10.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, amount):
+        # Caller holds the lock
+        now = time.monotonic()
+        amount += (now - self._time) * self.min_per_second
+        self._time = now
+        self._tokens = min(self.max_tokens, self._tokens + amount)
+
+    def deposit(self):
+        with self._lock:
+            self._refill(self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            self._refill(0)
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class LatencyWindow:
+    """The last `size` latencies of one kind of request, for percentiles."""
+
+    def __init__(self, size=200, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q):
+        """Returns the q-th percentile, or None with too few samples."""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+
+class Resilience:
+    """
+    Policy wrapped around every upstream request: a timeout per kind of
+    endpoint, a circuit breaker per kind, and for idempotent requests
+    retries with full-jitter exponential backoff drawn from a shared
+    RetryBudget. Requests of the `hedge` kinds (tiles by default) that take
+    longer than the `hedge_percentile` of their recent latencies get a
+    duplicate request, and whichever answers first wins.
+    """
+
+    def __init__(
+        self,
+        timeouts=None,
+        retries=2,
+        backoff=0.1,
+        max_backoff=2.0,
+        retry_budget=None,
+        failure_threshold=5,
+        reset_timeout=10.0,
+        hedge=("tile",),
+        hedge_percentile=95,
+        min_hedge_delay=0.02,
+        max_hedge_workers=32,
+    ):
+        self.timeouts = dict(DEFAULT_TIMEOUTS, **(timeouts or {}))
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_budget = retry_budget or RetryBudget()
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.hedge = frozenset(hedge)
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.max_hedge_workers = max_hedge_workers
+        self.counts = {
+            "requests": 0,
+            "retries": 0,
+            "hedged": 0,
+            "hedge_wins": 0,
+            "failed_fast": 0,
+            "budget_exhausted": 0,
+        }
+        self._breakers = {}
+        self._latencies = {}
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def breaker(self, kind):
+        with self._lock:
+            breaker = self._breakers.get(kind)
+            if breaker is None:
+                breaker = self._breakers[kind] = CircuitBreaker(
+                    self.failure_threshold, self.reset_timeout
+                )
+            return breaker
+
+    def _latency(self, kind):
+        with self._lock:
+            window = self._latencies.get(kind)
+            if window is None:
+                window = self._latencies[kind] = LatencyWindow()
+            return window
+
+    def call(self, send, method, url, **kwargs):
+        """
+        Sends `send(method, url, **kwargs)` (e.g. Session.request) under
+        the policy. Returns the response, which may still be an error
+        status once retries are exhausted. Raises CircuitOpenError while
+        the endpoint's circuit is open, or the last requests exception.
+        """
+        kind = endpoint_kind(url)
+        kwargs.setdefault("timeout", self.timeouts.get(kind, self.timeouts["other"]))
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        hedged = idempotent and kind in self.hedge
+        breaker = self.breaker(kind)
+        self._count("requests")
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                self._count("failed_fast")
+                raise CircuitOpenError(kind, breaker.retry_after(), breaker.last_error)
+            res = error = None
+            try:
+                if hedged:
+                    res = self._hedged(send, kind, method, url, **kwargs)
+                else:
+                    res = self._timed(send, kind, method, url, **kwargs)
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ) as e:
+                error = e
+            except Exception:
+                breaker.cancel()
+                raise
+            if res is not None and res.status_code not in RETRY_STATUSES:
+                breaker.success()
+                return res
+            breaker.failure(error or f"HTTP {res.status_code}")
+
+            if not idempotent or attempt >= self.retries:
+                break
+            if not self.retry_budget.withdraw():
+                self._count("budget_exhausted")
+                break
+            attempt += 1
+            self._count("retries")
+            if res is not None:
+                res.close()
+            time.sleep(
+                random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+            )
+        if res is not None:
+            return res
+        raise error
+
+    def _timed(self, send, kind, method, url, **kwargs):
+        start = time.perf_counter()
+        res = send(method, url, **kwargs)
+        if res.status_code not in RETRY_STATUSES:
+            self._latency(kind).add(time.perf_counter() - start)
+        return res
+
+    def _hedged(self, send, kind, method, url, **kwargs):
+        delay = self._latency(kind).percentile(self.hedge_percentile)
+        if delay is None:
+            # Not enough history to know what slow is yet
+            return self._timed(send, kind, method, url, **kwargs)
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_hedge_workers)
+            executor = self._executor
+        first = executor.submit(self._timed, send, kind, method, url, **kwargs)
+        done, _ = wait([first], timeout=max(delay, self.min_hedge_delay))
+        # Hedges are extra load, so they come out of the retry budget too
+        if done or not self.retry_budget.withdraw():
+            return first.result()
+        self._count("hedged")
+        second = executor.submit(self._timed, send, kind, method, url, **kwargs)
+
+        pending, res, error = {first, second}, None, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    res = future.result()
+                except requests.exceptions.RequestException as e:
+                    error = e
+                    continue
+                if res.status_code not in RETRY_STATUSES:
+                    if future is second:
+                        self._count("hedge_wins")
+                    for loser in pending:
+                        loser.add_done_callback(_close_response)
+                    return res
+        if res is not None:
+            return res
+        raise error
+
+    def stats(self):
+        with self._lock:
+            breakers = dict(self._breakers)
+            latencies = dict(self._latencies)
+            stats = dict(self.counts)
+        stats["circuits"] = {kind: breaker.state for kind, breaker in breakers.items()}
+        stats["p95"] = {
+            kind: window.percentile(95) for kind, window in latencies.items()
+        }
+        return stats
+
+
+# Function to release the connection of a hedged request that lost the race
+def _close_response(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+class ResilientSession(requests.Session):
+    """requests.Session whose requests all go through a Resilience policy."""
+
+    def __init__(self, resilience=None):
+        super().__init__()
+        self.resilience = resilience or Resilience()
+
+    def request(self, method, url, **kwargs):
+        return self.resilience.call(super().request, method, url, **kwargs)
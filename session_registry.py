@@ -0,0 +1,232 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class SessionExpired(Exception):
+    """The session id is unknown, or its session was dropped; log in again."""
+
+
+class UserSession:
+    """
+    Requests-style view of one registered user's pooled session. Calls go
+    through the registry so that an expired OMERO session is re-established
+    transparently.
+    """
+
+    def __init__(self, registry, sid):
+        self.registry = registry
+        self.sid = sid
+
+    def get(self, url, **kwargs):
+        return self.registry.request(self.sid, "GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.registry.request(self.sid, "POST", url, **kwargs)
+
+    @property
+    def login_context(self):
+        """What the login returned (e.g. the OMERO event context), or {}."""
+        return self.registry.login_context(self.sid)
+
+
+class SessionRegistry:
+    """
+    Server-side map from a Flask session id to a long-lived, pooled
+    requests.Session logged in to OMERO.web for that user.
+
+    `login(sess, username, password)` performs the OMERO login on a fresh
+    session and returns a true value on success; a dict (such as the OMERO
+    event context) is kept as the session's login context. Sessions idle
+    for longer than `idle_timeout` seconds are closed (keep it below the
+    OMERO session timeout, so that a session can still be rejoined by its
+    key when it is used again), and once
+    `max_sessions` is reached the least recently used one is dropped. If
+    given, `observer(method, url, response, seconds)` is called after every
+    upstream request. Sessions are made by `session_factory` (e.g. a
+    requests.Session subclass adding timeouts and retries).
+
+    Passwords are not kept. When a request is refused (401/403) and
+    `logged_in(sess)` says the session is no longer logged in,
+    `reauth(sess, username, login_context)` is given a fresh session to
+    log in again from the login context (e.g. by joining the OMERO session
+    by its key) and returns the new context, or a false value. Without
+    `reauth`, or if it fails, the user has to log in again.
+    """
+
+    def __init__(
+        self,
+        login,
+        pool_size=10,
+        idle_timeout=540,
+        max_sessions=500,
+        observer=None,
+        session_factory=requests.Session,
+        logged_in=None,
+        reauth=None,
+    ):
+        self.login = login
+        self.logged_in = logged_in
+        self.reauth = reauth
+        self.observer = observer
+        self.session_factory = session_factory
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _new_session(self):
+        sess = self.session_factory()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        sess.mount("https://", adapter)
+        sess.mount("http://", adapter)
+        return sess
+
+    def create(self, username, password):
+        """Logs in and returns the new session id, or None if login failed."""
+        sess = self._new_session()
+        context = self.login(sess, username, password)
+        if not context:
+            sess.close()
+            return None
+        sid = secrets.token_urlsafe(32)
+        entry = {
+            "session": sess,
+            "username": username,
+            "last_used": time.monotonic(),
+            "relogin_lock": threading.Lock(),
+            "login_context": context if isinstance(context, dict) else {},
+            "expired": False,
+            "closed": False,
+            # Requests in progress per session; a replaced or dropped session
+            # is only closed once its last request has finished
+            "in_flight": {},
+        }
+        with self._lock:
+            self._entries[sid] = entry
+            self._evict()
+        return sid
+
+    def _evict(self):
+        # Caller holds the lock; entries are kept in least recently used order
+        cutoff = time.monotonic() - self.idle_timeout
+        while self._entries:
+            sid, entry = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_sessions and entry["last_used"] > cutoff:
+                break
+            del self._entries[sid]
+            self._close(entry)
+
+    def _close(self, entry):
+        # Caller holds the lock and has removed the entry
+        entry["closed"] = True
+        self._close_when_idle(entry, entry["session"])
+
+    def _close_when_idle(self, entry, sess):
+        # Caller holds the lock; otherwise the last request using `sess` closes it
+        if sess not in entry["in_flight"]:
+            sess.close()
+
+    def get(self, sid):
+        """Returns a UserSession for `sid`, or None if it is unknown or expired."""
+        with self._lock:
+            self._evict()
+            entry = self._entries.get(sid)
+            if entry is not None and entry["expired"]:
+                del self._entries[sid]
+                self._close(entry)
+                entry = None
+            if entry is None:
+                return None
+            entry["last_used"] = time.monotonic()
+            self._entries.move_to_end(sid)
+        return UserSession(self, sid)
+
+    def remove(self, sid):
+        with self._lock:
+            entry = self._entries.pop(sid, None)
+            if entry is not None:
+                self._close(entry)
+
+    def login_context(self, sid):
+        with self._lock:
+            entry = self._entries.get(sid)
+        return entry["login_context"] if entry is not None else {}
+
+    def _send(self, sess, method, url, **kwargs):
+        start = time.perf_counter()
+        res = sess.request(method, url, **kwargs)
+        if self.observer is not None:
+            self.observer(method, url, res, time.perf_counter() - start)
+        return res
+
+    def _acquire(self, sid):
+        with self._lock:
+            entry = self._entries.get(sid)
+            if entry is None:
+                raise SessionExpired(f"Unknown session {sid!r}")
+            sess = entry["session"]
+            entry["in_flight"][sess] = entry["in_flight"].get(sess, 0) + 1
+        return entry, sess
+
+    def _release(self, entry, sess):
+        with self._lock:
+            count = entry["in_flight"].pop(sess) - 1
+            if count:
+                entry["in_flight"][sess] = count
+                return
+            retired = entry["closed"] or sess is not entry["session"]
+        if retired:
+            sess.close()
+
+    def _send_on(self, sid, method, url, **kwargs):
+        entry, sess = self._acquire(sid)
+        try:
+            return entry, sess, self._send(sess, method, url, **kwargs)
+        finally:
+            self._release(entry, sess)
+
+    def request(self, sid, method, url, **kwargs):
+        entry, sess, res = self._send_on(sid, method, url, **kwargs)
+        if res.status_code not in (401, 403) or entry["expired"]:
+            return res
+
+        with entry["relogin_lock"]:
+            if entry["expired"]:
+                return res
+            # Another thread may already have logged in again
+            if entry["session"] is sess:
+                # A refusal from a live session is a permission error, not expiry
+                if self.logged_in is not None and self.logged_in(sess):
+                    return res
+                if not self._relogin(entry, sess):
+                    return res
+        return self._send_on(sid, method, url, **kwargs)[2]
+
+    def _relogin(self, entry, sess):
+        # Caller holds the entry's relogin lock
+        context = None
+        if self.reauth is not None:
+            print(f" > Session expired, logging in again as {entry['username']}")
+            fresh = self._new_session()
+            context = self.reauth(fresh, entry["username"], entry["login_context"])
+            if not context:
+                fresh.close()
+        if not context:
+            print(f" > Session of {entry['username']} expired")
+            entry["expired"] = True
+            return False
+        with self._lock:
+            entry["session"] = fresh
+            entry["login_context"] = context if isinstance(context, dict) else {}
+            self._close_when_idle(entry, sess)
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {"sessions": len(self._entries), "max_sessions": self.max_sessions}
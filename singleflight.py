@@ -0,0 +1,91 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls: while do(key, fn, ...) is running
+    for a key, other threads calling do() with the same key wait for it and
+    get its result (or its exception) instead of calling `fn` again. The key
+    must identify everything the result depends on, including who may see it.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._calls = {}  # key -> Future of the call in flight
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self.calls += 1
+            else:
+                self.shared += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "shared": self.shared,
+                "in_flight": len(self._calls),
+            }
+
+
+class AsyncSingleFlight:
+    """
+    asyncio version of SingleFlight: the shared call runs as its own task,
+    so one caller being cancelled does not cancel it for the others. It is
+    cancelled only once every caller waiting on it has been.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._calls = {}  # key -> [task, number of callers waiting]
+
+    async def do(self, key, fn, *args, **kwargs):
+        entry = self._calls.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            entry = self._calls[key] = [task, 0]
+            task.add_done_callback(lambda _: self._forget(key, entry))
+            self.calls += 1
+        else:
+            self.shared += 1
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0])
+        finally:
+            entry[1] -= 1
+            if not entry[1] and not entry[0].done():
+                entry[0].cancel()
+
+    def _forget(self, key, entry):
+        if self._calls.get(key) is entry:
+            del self._calls[key]
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "shared": self.shared,
+            "in_flight": len(self._calls),
+        }
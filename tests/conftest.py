@@ -0,0 +1,47 @@
+import pytest
+import requests
+
+import omero_login
+from metadata_cache import MetadataCache
+from mock_omero import MockOmero
+from tile_cache import TileCache
+
+
+@pytest.fixture
+def omero():
+    with MockOmero(projects=3, datasets=6, images=30, page_size=10) as server:
+        yield server
+
+
+@pytest.fixture
+def omero_session(omero):
+    """A requests.Session logged in to the mock server."""
+    sess = requests.Session()
+    res, _ = omero_login.login(sess, omero.url, "test", "test")
+    assert res.status_code == 200
+    yield sess
+    sess.close()
+
+
+@pytest.fixture
+def flask_app(monkeypatch, tmp_path):
+    """
+    loginflask2's app with fresh caches in `tmp_path` and no prefetching;
+    point it at a server with monkeypatch.setattr(app, "my_omero_instance_url").
+    Every module global changed here is restored after the test.
+    """
+    import loginflask2
+
+    monkeypatch.setattr(loginflask2, "tile_cache", TileCache(str(tmp_path / "tiles")))
+    monkeypatch.setattr(
+        loginflask2, "thumbnail_cache", TileCache(str(tmp_path / "thumbnails"))
+    )
+    # User ids of the mock server are the same on every run
+    monkeypatch.setattr(
+        loginflask2, "image_data_cache", MetadataCache(loginflask2.RENDER_SETTINGS_TTL)
+    )
+    monkeypatch.setattr(loginflask2, "metadata_cache", MetadataCache())
+    monkeypatch.setattr(loginflask2, "PREFETCH_WORKERS", 0)
+    monkeypatch.setattr(loginflask2, "METADATA_INDEX_DIR", str(tmp_path / "index"))
+    monkeypatch.setattr(loginflask2, "metadata_indexes", {})
+    return loginflask2
@@ -0,0 +1,92 @@
+import time
+
+import pytest
+
+from metadata_index import MetadataIndex, epoch_ms
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = MetadataIndex(str(tmp_path / "index.sqlite"))
+    yield index
+    index.close()
+
+
+def test_first_sync_indexes_everything(omero, omero_session, index):
+    assert index.last_sync() is None
+    stats = index.sync(omero_session, omero.url)
+    assert stats["projects"]["total"] == 3
+    assert stats["datasets"]["total"] == 6
+    assert stats["images"] == {
+        "changed": 30,
+        "removed": 0,
+        "total": 30,
+        "complete": True,
+    }
+    assert index.last_sync() is not None
+    assert len(index.search_images(limit=100)) == 30
+    assert [c["name"] for c in index.channels(1)] == ["ch0", "ch1", "ch2"]
+
+
+def test_second_sync_only_writes_changes(omero, omero_session, index):
+    index.sync(omero_session, omero.url)
+    omero.counts["images"] = 25
+    before = omero.requests
+    stats = index.sync(omero_session, omero.url)
+    assert stats["images"]["changed"] == 0
+    assert stats["images"]["removed"] == 5
+    # Listings only: none of the 25 unchanged images is fetched again
+    assert omero.requests - before < 25
+    assert len(index.search_images(limit=100)) == 25
+
+
+def test_search_filters(omero, omero_session, index):
+    index.sync(omero_session, omero.url)
+    assert [i["id"] for i in index.search_images(name="image_1")] == [1] + list(
+        range(10, 20)
+    )
+    # Images of dataset 1: every sixth image, round-robin
+    assert [i["id"] for i in index.search_images(dataset_id=1)] == [1, 7, 13, 19, 25]
+    assert index.search_images(min_size_x=5000) == []
+
+
+def test_dates_are_compared_in_utc(omero, omero_session, index):
+    index.sync(omero_session, omero.url)
+    # Image n was acquired at 2020-09-13T12:26:40Z + n seconds
+    after = index.search_images(acquired_after="2020-09-13T12:27:00", limit=100)
+    assert [i["id"] for i in after] == list(range(20, 31))
+    offset = index.search_images(acquired_after="2020-09-13T14:27:00+02:00", limit=100)
+    assert offset == after
+    assert index.search_images(acquired_before=1600000000000 + 2000) == [
+        index.search_images(limit=2)[0],
+        index.search_images(limit=2)[1],
+    ]
+
+
+def test_epoch_ms():
+    assert epoch_ms(None) is None
+    assert epoch_ms("") is None
+    assert epoch_ms(1600000000000) == 1600000000000
+    assert epoch_ms("1600000000000") == 1600000000000
+    assert epoch_ms("2020-09-13T12:26:40") == 1600000000000
+    assert epoch_ms("2020-09-13T12:26:40Z") == 1600000000000
+    with pytest.raises(ValueError):
+        epoch_ms("yesterday")
+
+
+def test_search_waits_for_the_first_sync(omero, flask_app, monkeypatch):
+    monkeypatch.setattr(flask_app, "my_omero_instance_url", omero.url)
+    client = flask_app.app.test_client()
+    client.post("/login", data={"username": "test", "password": "test"})
+    res = client.get("/search")
+    assert res.status_code == 503
+    assert res.headers["Retry-After"]
+    assert res.get_json() == {"status": "syncing"}
+
+    for _ in range(100):
+        res = client.get("/search?limit=100")
+        if res.status_code == 200:
+            break
+        time.sleep(0.05)
+    assert res.status_code == 200
+    assert len(res.get_json()["images"]) == 30
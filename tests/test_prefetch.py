@@ -0,0 +1,73 @@
+import threading
+
+from prefetch import (
+    NEXT_IN_DIRECTION,
+    PrefetchScheduler,
+    TileGrid,
+    TilePosition,
+)
+
+
+def test_grid_contains_tiles_within_each_level():
+    grid = TileGrid(1000, 600, 2, 3, 256, 256)
+    assert grid.contains(TilePosition(1, 0, 0, 3, 2, 0))
+    assert not grid.contains(TilePosition(1, 0, 0, 4, 0, 0))
+    # Level 1 is half the size: 500 x 300, 2 x 2 tiles
+    assert grid.contains(TilePosition(1, 1, 0, 1, 1, 1))
+    assert not grid.contains(TilePosition(1, 0, 0, 2, 0, 1))
+    assert not grid.contains(TilePosition(1, 2, 0, 0, 0, 0))
+    assert not grid.contains(TilePosition(1, 0, 0, 0, 0, 3))
+
+
+def test_tile_ahead_while_panning_comes_first():
+    scheduler = PrefetchScheduler(lambda tile, context: 0, max_workers=0)
+    previous = TilePosition(1, 0, 0, 4, 4, 0)
+    current = TilePosition(1, 0, 0, 5, 4, 0)
+    predictions = scheduler.predict(previous, current)
+    ahead = [tile for priority, tile in predictions if priority == NEXT_IN_DIRECTION]
+    assert ahead == [TilePosition(1, 0, 0, 6, 4, 0)]
+    # The parent is one level up, the children one level down
+    tiles = [tile for _, tile in predictions]
+    assert TilePosition(1, 0, 0, 2, 2, 1) in tiles
+
+
+def test_predictions_stay_within_the_grid():
+    scheduler = PrefetchScheduler(lambda tile, context: 0, max_workers=0)
+    grid = TileGrid(512, 512, 1, 1, 256, 256)
+    corner = TilePosition(1, 0, 0, 1, 1, 0)
+    predictions = scheduler.predict(None, corner, grid)
+    assert predictions
+    assert all(grid.contains(tile) for _, tile in predictions)
+
+
+def test_recorded_tile_neighbors_are_fetched():
+    fetched = []
+    done = threading.Event()
+
+    def fetch(tile, context):
+        fetched.append((tile, context))
+        if len(fetched) == 3:
+            done.set()
+        return 100
+
+    scheduler = PrefetchScheduler(fetch, max_workers=1)
+    grid = TileGrid(512, 512, 1, 1, 256, 256)
+    scheduler.record("viewer", TilePosition(1, 0, 0, 0, 0, 0), "context", grid)
+    assert done.wait(5)
+    tiles = {tile for tile, _ in fetched}
+    assert tiles == {
+        TilePosition(1, 0, 0, 1, 0, 0),
+        TilePosition(1, 0, 0, 0, 1, 0),
+        TilePosition(1, 0, 0, 1, 1, 0),
+    }
+    assert all(context == "context" for _, context in fetched)
+
+
+def test_moving_on_drops_stale_predictions():
+    scheduler = PrefetchScheduler(lambda tile, context: 0, max_workers=0)
+    previous = TilePosition(1, 0, 0, 5, 5, 0)
+    current = TilePosition(1, 0, 0, 9, 9, 0)
+    scheduler.record("viewer", previous)
+    scheduler.record("viewer", current)
+    # Only the predictions for where the viewer is now are left
+    assert scheduler.stats()["queued"] == len(scheduler.predict(previous, current))
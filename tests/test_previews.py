@@ -0,0 +1,68 @@
+from io import BytesIO
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from mock_omero import MockOmero
+
+TILE_SIZE = 256
+
+
+@pytest.fixture
+def patterned_omero():
+    with MockOmero(
+        image_size=(2048, 2048), tile_size=TILE_SIZE, patterned=True
+    ) as server:
+        yield server
+
+
+@pytest.fixture
+def client(patterned_omero, flask_app, monkeypatch):
+    monkeypatch.setattr(flask_app, "my_omero_instance_url", patterned_omero.url)
+    client = flask_app.app.test_client()
+    client.post("/login", data={"username": "test", "password": "test"})
+    return client
+
+
+def pixels(res):
+    return np.asarray(Image.open(BytesIO(res.data)).convert("L"), dtype=float)
+
+
+@pytest.fixture
+def query(client):
+    query = f"w={TILE_SIZE}&h={TILE_SIZE}"
+    # Tile URLs carry the render settings version, as the viewer makes them
+    redirect = client.get(f"/tile/1/0/0/0/0/0?{query}")
+    assert redirect.status_code == 302
+    return query + "&v=" + parse_qs(urlsplit(redirect.location).query)["v"][0]
+
+
+@pytest.mark.parametrize("x, y", [(0, 0), (2, 3), (5, 6), (6, 1)])
+def test_preview_is_derived_from_the_cached_parent(
+    patterned_omero, client, query, x, y
+):
+    # Level 0 is full resolution; the parent one level up covers four tiles
+    client.get(f"/tile/1/0/0/{x // 2}/{y // 2}/1?{query}")
+    before = patterned_omero.requests
+    preview = client.get(f"/tile/1/0/0/{x}/{y}/0?{query}&quality=preview&moving=1")
+    assert preview.headers["X-Tile-Quality"] == "preview"
+    assert patterned_omero.requests == before
+
+    # The preview resembles its own tile more than the neighboring one
+    preview = pixels(preview)
+    full = pixels(client.get(f"/tile/1/0/0/{x}/{y}/0?{query}"))
+    neighbor = pixels(client.get(f"/tile/1/0/0/{x ^ 1}/{y}/0?{query}"))
+    assert np.abs(preview - full).mean() < np.abs(preview - neighbor).mean()
+
+
+def test_versioned_tile_is_revalidated_without_omero(patterned_omero, client, query):
+    url = f"/tile/1/0/0/1/1/0?{query}"
+    res = client.get(url)
+    assert res.status_code == 200
+    assert "immutable" in res.headers["Cache-Control"]
+    before = patterned_omero.requests
+    res = client.get(url, headers={"If-None-Match": res.headers["ETag"]})
+    assert res.status_code == 304
+    assert patterned_omero.requests == before
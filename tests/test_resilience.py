@@ -0,0 +1,102 @@
+import time
+
+import pytest
+
+import omero_login
+from resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    Resilience,
+    ResilientSession,
+    RetryBudget,
+    endpoint_kind,
+)
+
+
+def test_endpoint_kinds():
+    assert endpoint_kind("http://h/webgateway/render_image_region/1/0/0/") == "tile"
+    assert endpoint_kind("http://h/webgateway/imgData/1/") == "metadata"
+    assert endpoint_kind("http://h/api/v0/m/images/") == "list"
+    assert endpoint_kind("http://h/api/v0/login/") == "login"
+
+
+def test_circuit_opens_then_lets_one_trial_through():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    breaker.failure("boom")
+    assert breaker.allow()
+    breaker.failure("boom")
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == "half-open"
+    # Only one trial at a time
+    assert not breaker.allow()
+    breaker.success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+def test_failed_trial_reopens_the_circuit():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == "open"
+    assert breaker.retry_after() > 0
+
+
+def test_retry_budget_runs_out():
+    budget = RetryBudget(ratio=0.5, min_per_second=0, max_tokens=2)
+    assert budget.withdraw()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    budget.deposit()
+    budget.deposit()
+    assert budget.withdraw()
+
+
+@pytest.fixture
+def failing_session(omero):
+    resilience = Resilience(
+        retries=2,
+        backoff=0,
+        failure_threshold=3,
+        reset_timeout=60,
+        retry_budget=RetryBudget(min_per_second=0),
+    )
+    sess = ResilientSession(resilience)
+    omero_login.login(sess, omero.url, "test", "test")
+    omero.failure_rate = 1.0
+    yield sess
+    sess.close()
+
+
+def test_retries_then_fails_fast_once_the_circuit_opens(omero, failing_session):
+    url = f"{omero.url}/api/v0/m/projects/"
+    before = omero.requests
+    res = failing_session.get(url)
+    assert res.status_code == 503
+    # The first attempt and two retries
+    assert omero.requests - before == 3
+
+    before = omero.requests
+    with pytest.raises(CircuitOpenError) as e:
+        failing_session.get(url)
+    assert omero.requests == before
+    assert e.value.kind == "list"
+    assert e.value.retry_after > 0
+    assert failing_session.resilience.counts["failed_fast"] == 1
+
+
+def test_retries_stop_when_the_budget_is_spent(omero, failing_session):
+    resilience = failing_session.resilience
+    resilience.retries = 5
+    resilience.failure_threshold = 100
+    resilience.retry_budget = RetryBudget(ratio=0, min_per_second=0, max_tokens=2)
+    before = omero.requests
+    assert failing_session.get(f"{omero.url}/api/v0/m/images/").status_code == 503
+    assert omero.requests - before == 3
+    assert resilience.counts["budget_exhausted"] == 1
@@ -0,0 +1,83 @@
+import time
+
+import pytest
+
+import omero_login
+from session_registry import SessionExpired, SessionRegistry
+
+
+@pytest.fixture
+def registry(omero):
+    def login(sess, username, password):
+        res, _ = omero_login.login(sess, omero.url, username, password)
+        if res.status_code != 200:
+            return None
+        return res.json().get("eventContext")
+
+    def logged_in(sess):
+        res = sess.get(f"{omero.url}/api/v0/m/projects/", params={"limit": 1})
+        return res.status_code not in (401, 403)
+
+    def reauth(sess, username, context):
+        res = sess.get(
+            f"{omero.url}/api/v0/m/projects/",
+            params={"limit": 1, "bsession": context["sessionUuid"]},
+        )
+        return context if res.status_code == 200 else None
+
+    return SessionRegistry(login, logged_in=logged_in, reauth=reauth)
+
+
+def test_login_and_request(omero, registry):
+    sid = registry.create("test", "test")
+    user_sess = registry.get(sid)
+    assert user_sess.login_context["userName"] == "test"
+    assert user_sess.get(f"{omero.url}/api/v0/m/images/").status_code == 200
+
+
+def test_failed_login_returns_no_session(registry):
+    assert registry.create("test", "") is None
+    assert registry.stats()["sessions"] == 0
+
+
+def test_expired_web_session_is_rejoined_by_its_key(omero, registry):
+    sid = registry.create("test", "test")
+    omero.sessions.clear()
+    res = registry.get(sid).get(f"{omero.url}/api/v0/m/images/")
+    assert res.status_code == 200
+
+
+def test_session_that_cannot_be_rejoined_is_dropped(omero, registry):
+    sid = registry.create("test", "test")
+    omero.sessions.clear()
+    omero.session_keys.clear()
+    res = registry.get(sid).get(f"{omero.url}/api/v0/m/images/")
+    assert res.status_code == 403
+    assert registry.get(sid) is None
+
+
+def test_dropped_session_raises_session_expired(omero, registry):
+    sid = registry.create("test", "test")
+    user_sess = registry.get(sid)
+    registry.remove(sid)
+    with pytest.raises(SessionExpired):
+        user_sess.get(f"{omero.url}/api/v0/m/images/")
+
+
+def test_idle_and_least_recently_used_sessions_are_evicted(registry):
+    registry.max_sessions = 2
+    first = registry.create("a", "a")
+    second = registry.create("b", "b")
+    registry.get(first)
+    registry.create("c", "c")
+    assert registry.get(second) is None
+    assert registry.get(first) is not None
+
+    registry.idle_timeout = 0.01
+    time.sleep(0.02)
+    assert registry.get(first) is None
+    assert registry.stats()["sessions"] == 0
+
+
+def test_idle_timeout_defaults_below_omero_session_timeout(registry):
+    assert registry.idle_timeout < 600
@@ -0,0 +1,52 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_result():
+    flights = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "tile"
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        leader = executor.submit(flights.do, "key", fetch)
+        started.wait(5)
+        followers = [executor.submit(flights.do, "key", fetch) for _ in range(7)]
+        # Followers have joined once they are counted as shared
+        while flights.stats()["shared"] < 7:
+            threading.Event().wait(0.01)
+        release.set()
+        results = [leader.result()] + [f.result() for f in followers]
+
+    assert results == ["tile"] * 8
+    assert len(calls) == 1
+    assert flights.stats() == {"calls": 1, "shared": 7, "in_flight": 0}
+
+
+def test_exception_reaches_every_caller_and_key_is_released():
+    flights = SingleFlight()
+
+    def fail():
+        raise ValueError("upstream failed")
+
+    with pytest.raises(ValueError):
+        flights.do("key", fail)
+    # A later call runs again instead of getting the old failure
+    assert flights.do("key", lambda: 42) == 42
+    assert flights.stats()["in_flight"] == 0
+
+
+def test_different_keys_are_not_shared():
+    flights = SingleFlight()
+    assert flights.do(("user", 1), lambda: 1) == 1
+    assert flights.do(("user", 2), lambda: 2) == 2
+    assert flights.stats()["calls"] == 2
@@ -0,0 +1,170 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+
+# Function to build a stable cache key from image/plane/tile/render settings
+def make_tile_key(image_id, z, t, x, y, level, render_params=None, scope=None):
+    """
+    Returns a string key for a rendered tile. Render settings (channels,
+    model, projection, quality, ...) are sorted so that the same settings
+    given in a different order map to the same entry. `scope` (e.g. the
+    user or group the tile was rendered for) keeps entries of users who
+    may see different images apart.
+    """
+    params = "&".join(f"{k}={v}" for k, v in sorted((render_params or {}).items()))
+    return f"{_scope_prefix(scope)}{image_id}/{z}/{t}/{x}/{y}/{level}?{params}"
+
+
+# Function to build a cache key for a whole rendered image
+def make_image_key(image_id, render_params=None, scope=None):
+    params = "&".join(f"{k}={v}" for k, v in sorted((render_params or {}).items()))
+    return f"{_scope_prefix(scope)}{image_id}/full?{params}"
+
+
+# Function to build a cache key for a thumbnail
+def make_thumbnail_key(image_id, size, version, scope=None):
+    return f"{_scope_prefix(scope)}thumbnail/{image_id}/{size}/v{version}"
+
+
+def _scope_prefix(scope):
+    if scope is None:
+        return ""
+    if isinstance(scope, (tuple, list)):
+        scope = "-".join(str(part) for part in scope)
+    return f"{scope}:"
+
+
+class TileCache:
+    """
+    Two-tier cache for rendered tiles: an in-memory LRU capped by total
+    bytes in front of a disk cache. Values are raw encoded image bytes.
+    Least recently used files are deleted once the disk cache grows past
+    `max_disk_bytes`.
+    """
+
+    def __init__(
+        self,
+        cache_dir,
+        max_memory_bytes=64 * 1024 * 1024,
+        max_disk_bytes=1024**3,
+    ):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._files = OrderedDict()  # disk path -> size, least recently used first
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        # Rebuild the LRU order from modification times left by earlier runs;
+        # only the two-character fan-out directories belong to this cache
+        found = []
+        for name in os.listdir(self.cache_dir):
+            directory = os.path.join(self.cache_dir, name)
+            if len(name) != 2 or not os.path.isdir(directory):
+                continue
+            for filename in os.listdir(directory):
+                if filename.endswith(".tmp"):
+                    continue
+                stat = os.stat(os.path.join(directory, filename))
+                found.append(
+                    (stat.st_mtime, os.path.join(directory, filename), stat.st_size)
+                )
+        for _, path, size in sorted(found):
+            self._files[path] = size
+            self.disk_bytes += size
+
+    def _disk_path(self, key):
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def _remember(self, key, data):
+        # Caller holds the lock
+        if len(data) > self.max_memory_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.memory_bytes -= len(old)
+        self._entries[key] = data
+        self.memory_bytes += len(data)
+        while self.memory_bytes > self.max_memory_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+                self.disk_bytes -= self._files.pop(path, 0)
+            return None
+        with self._lock:
+            self.disk_hits += 1
+            if path in self._files:
+                self._files.move_to_end(path)
+            self._remember(key, data)
+        return data
+
+    def contains(self, key):
+        # Does not count towards the hit/miss statistics
+        with self._lock:
+            if key in self._entries:
+                return True
+        return os.path.exists(self._disk_path(key))
+
+    def put(self, key, data):
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see partial tiles
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.disk_bytes += len(data) - self._files.pop(path, 0)
+            self._files[path] = len(data)
+            self._evict_files()
+            self._remember(key, data)
+
+    def _evict_files(self):
+        # Caller holds the lock; evicted keys may stay in the memory tier
+        while self.disk_bytes > self.max_disk_bytes and len(self._files) > 1:
+            path, size = self._files.popitem(last=False)
+            self.disk_bytes -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "memory_hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self._entries),
+                "memory_bytes": self.memory_bytes,
+                "max_memory_bytes": self.max_memory_bytes,
+                "disk_entries": len(self._files),
+                "disk_bytes": self.disk_bytes,
+                "max_disk_bytes": self.max_disk_bytes,
+            }